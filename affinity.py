@@ -0,0 +1,196 @@
+# CPU and NUMA pinning of containers. Apptainer runs the container with
+# whatever affinity the caller has and the OpenMP, MKL and torch thread
+# pools inside it default to one thread per cpu on the node, so several
+# containers (or one on a share of a node) oversubscribe the cores and
+# their memory ends up spread over every NUMA domain. The command is
+# wrapped in numactl (or taskset if numactl is not installed) to pin it,
+# and the thread counts are passed in with apptainer --env.
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+from typing import List, Optional
+from history import run_with_rusage
+
+# where linux describes the NUMA topology
+NODE_DIR = "/sys/devices/system/node"
+# thread pools sized from the environment: OpenMP (and so torch, which
+# sizes its intra-op pool from OMP_NUM_THREADS), MKL, OpenBLAS and numexpr
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """
+    Function to turn a cpu (or NUMA node) list in the format linux and
+    taskset use, e.g. 0-3,8,10-11, into a sorted list of numbers.
+    Raises ValueError if it is not valid.
+    """
+    numbers = set()
+    for part in text.replace(" ", "").split(","):
+        first, _, last = part.partition("-")
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise ValueError(f"cpu list {text} is not valid, give numbers and ranges e.g. 0-3,8")
+        if first < 0 or last < first:
+            raise ValueError(f"cpu list {text} is not valid, give numbers and ranges e.g. 0-3,8")
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)
+
+
+def format_cpu_list(cpus) -> str:
+    """
+    Function to turn a list of numbers into the shortest cpu list e.g. 0-3,8.
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def numa_nodes() -> dict:
+    """
+    Function to get the cpus we are allowed to use in each NUMA node, as a
+    dict of node number to list of cpus. Nodes where we can't use any cpus
+    (e.g. outside of a slurm allocation) are left out. If the topology is
+    not known everything is treated as one node, node 0.
+    """
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    for P in Path(NODE_DIR).glob("node[0-9]*"):
+        try:
+            cpus = [cpu for cpu in parse_cpu_list((P / "cpulist").read_text().strip()) if cpu in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes[int(P.name[len("node"):])] = cpus
+    if not nodes:
+        nodes = {0: sorted(allowed)}
+    return dict(sorted(nodes.items()))
+
+
+def pinned_cpus(cpus: str = "", numa_node: str = "") -> Optional[List[int]]:
+    """
+    Function to get the cpus a container is pinned to by its cpus and
+    numa_node, or None if it is not pinned.
+    """
+    if not cpus and not numa_node:
+        return None
+    if not numa_node:
+        return parse_cpu_list(cpus)
+    nodes = numa_nodes()
+    found = [cpu for node in parse_cpu_list(numa_node) for cpu in nodes.get(node, [])]
+    if cpus:
+        found = [cpu for cpu in found if cpu in parse_cpu_list(cpus)]
+    return sorted(found)
+
+
+def have_numactl() -> bool:
+    return shutil.which("numactl") is not None
+
+
+def pin_prefix(cpus: str = "", numa_node: str = "") -> List[str]:
+    """
+    Function to get the command to put in front of apptainer to pin the
+    container to the given cpus and/or NUMA node(s). With numactl memory
+    is allocated on the node(s) as well, taskset only pins the cpus.
+    """
+    if not cpus and not numa_node:
+        return []
+    if numa_node and have_numactl():
+        cpu_flag = f"--physcpubind={cpus}" if cpus else f"--cpunodebind={numa_node}"
+        return ["numactl", cpu_flag, f"--membind={numa_node}"]
+    if numa_node:
+        logging.info("numactl is not installed, pinning the cpus of the NUMA node(s) without binding memory")
+        found = pinned_cpus(cpus, numa_node)
+        if not found:
+            raise ValueError(f"there are no cpus we can use in NUMA node(s) {numa_node}")
+        cpus = format_cpu_list(found)
+    return ["taskset", "-c", cpus]
+
+
+def thread_env(threads: int = 0, cpus: str = "", numa_node: str = "") -> dict:
+    """
+    Function to get the environment variables that size the thread pools
+    inside the container. If threads is 0 a pinned container gets one
+    thread per cpu it is pinned to, otherwise they are left alone.
+    """
+    if not threads:
+        pinned = pinned_cpus(cpus, numa_node)
+        if not pinned:
+            return {}
+        threads = len(pinned)
+    return {name: str(threads) for name in THREAD_ENV_VARS}
+
+
+def env_flags(env: dict) -> List[str]:
+    """
+    Function to get the apptainer flags to set env inside the container.
+    """
+    flags = []
+    for key, value in env.items():
+        flags += ["--env", f"{key}={value}"]
+    return flags
+
+
+def split_domains(n: int, cpus: str = "", numa_node: str = "") -> List[tuple]:
+    """
+    Function to share out the cpus (optionally only those in cpus and/or
+    numa_node) between n copies of a container. Returns a list of (NUMA
+    node, cpus) for each copy. Copies go round the NUMA nodes in turn and
+    the cpus of each node are divided evenly between the copies on it, so
+    no copy spans two nodes. Raises ValueError if there are not enough.
+    """
+    nodes = numa_nodes()
+    if numa_node:
+        nodes = {node: nodes[node] for node in parse_cpu_list(numa_node) if node in nodes}
+    if cpus:
+        allowed = parse_cpu_list(cpus)
+        nodes = {node: [cpu for cpu in found if cpu in allowed] for node, found in nodes.items()}
+    nodes = {node: found for node, found in nodes.items() if found}
+    if n < 1 or not nodes:
+        raise ValueError(f"can't split into {n} copies, no cpus are available")
+    node_list = list(nodes)
+    copies = {node: [I for I in range(n) if node_list[I % len(node_list)] == node] for node in node_list}
+    domains = [None] * n
+    for node, indices in copies.items():
+        found = nodes[node]
+        if len(indices) > len(found):
+            raise ValueError(
+                f"can't split into {n} copies, NUMA node {node} only has {len(found)} cpus for {len(indices)} copies"
+            )
+        for J, I in enumerate(indices):
+            share = found[J * len(found) // len(indices):(J + 1) * len(found) // len(indices)]
+            domains[I] = (node, share)
+    return domains
+
+
+def run_copies(commands: List[List[str]], usage: bool = True) -> List[tuple]:
+    """
+    Function to run several commands at once and wait for all of them.
+    Returns a (exit code, resources used) tuple for each, see
+    run_with_rusage, the resources are None unless usage is set.
+    """
+    results = [(127, None)] * len(commands)
+
+    def run(I: int, argv: List[str]):
+        try:
+            if usage:
+                results[I] = run_with_rusage(argv)
+            else:
+                results[I] = (subprocess.run(argv).returncode, None)
+        except OSError as e:
+            logging.error(f"Could not run {argv[0]}: {e}")
+
+    threads = [threading.Thread(target=run, args=(I, argv)) for I, argv in enumerate(commands)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
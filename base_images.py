@@ -0,0 +1,91 @@
+# Layered builds. A container can name a base definition holding the slow,
+# rarely changed part of its image (e.g. the apt-get install of everything
+# it needs). The base is built once into its own sif file, and rebuilt only
+# when the content of the base definition changes, then the container's own
+# definition is built on top of it with "Bootstrap: localimage". That way
+# editing a %post line of the container only re-runs that definition.
+import hashlib
+import os
+from pathlib import Path
+from build_manifest import definition_hash, make_manifest
+from builds import BuildJob, build_log_file
+
+# base images are stored in a directory next to the images built on them
+# e.g. Images/base/ubuntu_ml_1a2b3c4d.sif for Definitions/ubuntu_ml.def
+BASE_DIR = "base"
+# the definitions actually built for layered containers are written here
+LAYERED_DEF_DIR = ".cache/definitions"
+
+
+def base_name(base: str) -> str:
+    """
+    Function to get the name of the base image (and its build log), the
+    name of the definition followed by a short hash of its full path so
+    that e.g. a/base.def and b/base.def are built into different images.
+    """
+    digest = hashlib.sha256(str(Path(base).resolve()).encode()).hexdigest()[:8]
+    return f"{Path(base).stem}_{digest}"
+
+
+def base_image(image_file, base: str) -> str:
+    """
+    Function to get the sif file the base definition is built into.
+    """
+    return str(Path(image_file).parent / BASE_DIR / f"{base_name(base)}.sif")
+
+
+def base_build_job(model_name: str, image_file, base: str, version=None, layer_cache=None) -> BuildJob:
+    """
+    Function to get the BuildJob for the base image of a container. Its
+    manifest only depends on the base definition, so run_build skips it
+    unless that has changed.
+    """
+    image = base_image(image_file, base)
+    return BuildJob(
+        f"{model_name} (base)",
+        image,
+        # --force as the base is only rebuilt when it is out of date
+        ["apptainer", "build", "--force", image, base],
+        make_manifest(base, "", version=version),
+        build_log_file(f"base_{base_name(base)}"),
+        layer_cache,
+    )
+
+
+def strip_header(text: str) -> str:
+    """
+    Function to remove the header (Bootstrap:, From: etc.) of a definition,
+    i.e. everything before the first section, as the base replaces it.
+    """
+    lines = text.splitlines(keepends=True)
+    for I, line in enumerate(lines):
+        if line.lstrip().startswith("%"):
+            return "".join(lines[I:])
+    return ""
+
+
+def layered_definition(model_name: str, definition: str, image_file, base: str) -> str:
+    """
+    Function to write the definition that builds a container on top of
+    its base image and return its path. The hash of the base definition
+    is written into it, so the container counts as out of date (see
+    build_manifest) whenever either definition changes. The file is only
+    rewritten if its contents change.
+    """
+    text = (
+        f"# generated from {definition} on top of {base} (sha256 {definition_hash(base)})\n"
+        f"Bootstrap: localimage\n"
+        f"From: {os.path.abspath(base_image(image_file, base))}\n\n"
+        + strip_header(Path(definition).read_text())
+    )
+    P = Path(LAYERED_DEF_DIR) / f"{model_name}.def"
+    try:
+        if P.read_text() == text:
+            return str(P)
+    except OSError:
+        pass
+    P.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = P.with_name(f"{P.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(text)
+    os.replace(tmp_file, P)
+    return str(P)
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import queue
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+from defaults import DEFAULT_RESULTS_FILE
+
+# exit code given to a command that runs for longer than its timeout,
+# the same as timeout(1)
+TIMEOUT_EXIT_CODE = 124
+
+
+def read_batch_commands(batch_file: str) -> list:
+    """
+    Function to read the commands for a batch run, one per line. Blank
+    lines and lines starting with # are ignored. Use "-" to read stdin.
+    """
+    if batch_file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(batch_file, "r") as file:
+            lines = file.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+class ContainerSession:
+    """
+    A long running shell inside a container that commands are fed to one
+    at a time, so that the cost of starting the container is only paid
+    once rather than once per command. Each command is run by its own
+    sh -c, so a syntax error only fails that command, with its output
+    (stdout and stderr) captured, followed by a marker line giving its
+    exit code. A command that runs for longer than its timeout is killed
+    along with the session, which is restarted for the next command.
+
+    Attributes:
+        command -- argv list of the command that starts the session, this
+                   should run /bin/sh inside the container e.g.
+                   ["apptainer", "exec", "image.sif", "/bin/sh"]
+    """
+
+    def __init__(self, command: list):
+        self.command = command
+        self.marker = f"__BEDE_BATCH_{os.urandom(16).hex()}__"
+        self.proc = None
+        self.starts = 0
+        self.timed_out = False
+
+    def start(self):
+        logging.info(f"Starting batch session: {' '.join(self.command)}")
+        self.proc = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            # so the session and everything it runs can be killed on a timeout
+            start_new_session=True,
+        )
+        self.starts += 1
+
+    def run(self, cmd: str, timeout: Optional[float] = None):
+        """
+        Run a command in the session, returns its exit code and output.
+        If the session has died (or the command timed out) it is restarted
+        for the next command.
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            try:
+                self.start()
+            except OSError as e:
+                # same exit code a shell would give for a missing command
+                self.proc = None
+                return 127, f"{e}\n"
+        try:
+            # stdin is /dev/null so the command can't eat the commands after it.
+            # The marker is printed after a newline so that it is on a line of
+            # its own even if the output of the command doesn't end with one.
+            self.proc.stdin.write(
+                f"sh -c {shlex.quote(cmd)} </dev/null 2>&1\nprintf '\\n%s %d\\n' {self.marker} $?\n"
+            )
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.timed_out = False
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._kill, args=(self.proc,))
+            timer.start()
+        output = []
+        try:
+            for line in self.proc.stdout:
+                if line.startswith(self.marker):
+                    # drop the newline printed before the marker
+                    return int(line.split()[1]), "".join(output)[:-1]
+                output.append(line)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        # the session exited before the command finished
+        returncode = self.proc.wait()
+        self.proc = None
+        if self.timed_out:
+            output.append(f"Command timed out after {timeout} seconds\n")
+            return TIMEOUT_EXIT_CODE, "".join(output)
+        return returncode or 255, "".join(output)
+
+    def _kill(self, proc):
+        self.timed_out = True
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+
+def run_batch(
+    commands: list,
+    session_command: list,
+    n_sessions: int = 1,
+    results_file=DEFAULT_RESULTS_FILE,
+    timeout: Optional[float] = None
+) -> list:
+    """
+    Function to run a list of commands through a pool of n_sessions
+    ContainerSessions, each command is killed if it runs for longer than
+    timeout seconds. The result of each command is appended to
+    results_file as a json line as soon as it finishes. Returns the
+    list of results (as dicts) in the same order as commands.
+    """
+    todo = queue.Queue()
+    for index, cmd in enumerate(commands):
+        todo.put((index, cmd))
+    results = [None] * len(commands)
+    write_lock = threading.Lock()
+
+    def worker(results_out):
+        session = ContainerSession(session_command)
+        try:
+            while True:
+                try:
+                    index, cmd = todo.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                returncode, output = session.run(cmd, timeout)
+                result = {
+                    "index": index,
+                    "command": cmd,
+                    "returncode": returncode,
+                    "seconds": round(time.perf_counter() - start, 6),
+                    "output": output,
+                }
+                results[index] = result
+                with write_lock:
+                    results_out.write(json.dumps(result) + "\n")
+                    results_out.flush()
+        finally:
+            session.close()
+
+    with open(results_file, "a") as results_out:
+        threads = [
+            threading.Thread(target=worker, args=(results_out,))
+            for I in range(max(1, min(n_sessions, len(commands))))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results
@@ -0,0 +1,146 @@
+# Benchmark of cpu/NUMA pinning.
+#
+# Runs N copies of a cpu bound workload at once in three ways and reports
+# the throughput (work items per second, over all copies) of each:
+#
+#   unpinned  N copies with the caller's affinity and thread pools sized
+#             to the whole machine, as run did before pinning
+#   threads   N unpinned copies, each with --threads set to its share
+#   split     run --split N, each copy pinned to its share of the cpus
+#             (and NUMA node) with its thread pool sized to match
+#
+# The workload sizes its pool of workers from OMP_NUM_THREADS the way
+# OpenMP (and so torch and MKL) does, defaulting to one per cpu, so the
+# unpinned copies oversubscribe the cores just like the models do.
+#
+# By default the "container" is the stub apptainer from the tests, which
+# runs the workload on the host, so this measures the effect of pinning
+# without needing apptainer or an image. Give --config_file and --model
+# to run it in a real container instead (it needs python3 inside).
+#
+# usage: python benchmarks/bench_pinning.py [--copies N] [--items N] [--repeats N]
+#                                           [--config_file PATH --model NAME]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+SCRIPT = REPO / "run_container.py"
+STUB_APPTAINER = REPO / "tests" / "stub_apptainer.py"
+
+# each work item is a fixed amount of pure python arithmetic, shared out
+# between a pool of worker processes sized like an OpenMP thread pool
+WORKLOAD = """
+import os, sys
+from multiprocessing import Pool
+
+def item(n):
+    total = 0
+    for I in range(200_000):
+        total += I * I % 7
+    return total
+
+if __name__ == "__main__":
+    workers = int(os.environ.get("OMP_NUM_THREADS", 0)) or len(os.sched_getaffinity(0))
+    with Pool(workers) as pool:
+        pool.map(item, range(int(sys.argv[1])), chunksize=1)
+"""
+
+
+def make_stub_config(root: Path) -> tuple:
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "apptainer").write_text(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_APPTAINER}" "$@"\n')
+    (bin_dir / "apptainer").chmod(0o755)
+    (root / "Bench.sif").write_text("not a real image")
+    conf_file = root / "bench.yaml"
+    conf_file.write_text(
+        f"Bench:\n  description: 'pinning benchmark'\n"
+        f"  container_definition: 'alpine:latest'\n  image_file: '{root / 'Bench.sif'}'\n"
+    )
+    return conf_file, "Bench", {"PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}", "STUB_APPTAINER_LOG": str(root / "calls.log")}
+
+
+def time_commands(commands: list, cwd: Path, env: dict) -> float:
+    '''
+    Wall clock time in seconds to run all the commands at once.
+    '''
+    start = time.perf_counter()
+    procs = [subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL) for command in commands]
+    for proc in procs:
+        if proc.wait() != 0:
+            raise RuntimeError(f"{' '.join(map(str, proc.args))} failed with exit code {proc.returncode}")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cpu/NUMA pinning of containers.")
+    parser.add_argument("--copies", type=int, default=None,
+                        help="number of copies to run at once (default: the number of NUMA nodes, at least 2 if there are enough cpus)")
+    parser.add_argument("--items", type=int, default=None,
+                        help="work items per copy (default: 4 per cpu)")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="number of times to run each (default 3), the median is reported")
+    parser.add_argument("--config_file", type=str, default=None,
+                        help="config file of a real container to run the workload in")
+    parser.add_argument("--model", type=str, default=None,
+                        help="model in --config_file to run the workload in")
+    args = parser.parse_args()
+    if (args.config_file is None) != (args.model is None):
+        parser.error("give both --config_file and --model, or neither")
+
+    sys.path.insert(0, str(REPO))
+    from affinity import numa_nodes
+    nodes = numa_nodes()
+    n_cpus = sum(len(cpus) for cpus in nodes.values())
+    copies = args.copies or min(n_cpus, max(2, len(nodes)))
+    items = args.items or 4 * n_cpus
+    print(f"{n_cpus} cpus in {len(nodes)} NUMA node(s), {copies} copies of {items} items each")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        env = dict(
+            os.environ,
+            BEDE_CONTAINERS_SOCKET=str(root / "no_daemon.sock"),
+            BEDE_CONTAINERS_HISTORY=str(root / "history.sqlite"),
+            BEDE_CONTAINERS_IMAGE_STORE=str(root / "images.sqlite"),
+        )
+        if args.model is None:
+            conf_file, model, stub_env = make_stub_config(root)
+            env.update(stub_env)
+        else:
+            conf_file, model = Path(args.config_file).resolve(), args.model
+        for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+            env.pop(name, None)
+        (root / "logs").mkdir()
+
+        def cli(*extra) -> list:
+            return [sys.executable, str(SCRIPT), "--no_cache", "--config_file", str(conf_file),
+                    "run", "--cold", *extra, model, "--", "python3", "-c", WORKLOAD, str(items)]
+
+        share = max(1, n_cpus // copies)
+        layouts = {
+            "unpinned": [cli() for I in range(copies)],
+            "threads": [cli(f"--threads={share}") for I in range(copies)],
+            "split": [cli(f"--split={copies}")],
+        }
+        results = {}
+        for name, commands in layouts.items():
+            times = [time_commands(commands, root, env) for I in range(args.repeats)]
+            results[name] = statistics.median(times)
+
+    baseline = copies * items / results["unpinned"]
+    print(f"{'Layout:':<12} {'Time (s):':>10} {'Items/s:':>10} {'Speedup:':>9}")
+    for name, seconds in results.items():
+        throughput = copies * items / seconds
+        print(f"{name:<12} {seconds:10.2f} {throughput:10.1f} {throughput / baseline:8.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
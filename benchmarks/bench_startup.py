@@ -0,0 +1,98 @@
+# Benchmark of cli startup time.
+#
+# Reports the total import time of run_container (from python -X importtime)
+# and the median wall clock time of a few cheap invocations of the cli
+# (--help, list and run --debug) against a small synthetic config.
+# These are the commands users type interactively so they should stay fast.
+#
+# Give --max_ms to exit with a non-zero status if any of the timings is
+# over that many milliseconds, so this can be used to catch regressions in CI.
+#
+# usage: python benchmarks/bench_startup.py [--repeats N] [--max_ms MS]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+SCRIPT = REPO / "run_container.py"
+
+
+def import_time_ms() -> float:
+    '''
+    Total time to import run_container as reported by -X importtime.
+    '''
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import run_container"],
+        cwd=REPO, capture_output=True, text=True, check=True,
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) == 3 and fields[2] == "run_container":
+            return int(fields[1]) / 1000
+    raise RuntimeError("run_container not found in -X importtime output")
+
+
+def make_config(root: Path) -> Path:
+    conf_dir = root / "configs"
+    conf_dir.mkdir()
+    (root / "logs").mkdir()
+    (root / "Bench.sif").write_text("not a real image")
+    (conf_dir / "bench.yaml").write_text(
+        f"Bench:\n  description: 'startup benchmark'\n  group: Bench\n"
+        f"  container_definition: 'alpine:latest'\n  image_file: '{root / 'Bench.sif'}'\n"
+    )
+    return conf_dir
+
+
+def time_command(args: list, cwd: Path, repeats: int) -> float:
+    '''
+    Median wall clock time in ms to run the cli with the given arguments.
+    '''
+    env = dict(os.environ, BEDE_CONTAINERS_SOCKET=str(cwd / "no_daemon.sock"))
+    times = []
+    for I in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(SCRIPT)] + args, cwd=cwd, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cli startup time.")
+    parser.add_argument("--repeats", type=int, default=10,
+                        help="number of times to run each command (default 10)")
+    parser.add_argument("--max_ms", type=float, default=None,
+                        help="fail if any timing is over this many milliseconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        conf_dir = make_config(root)
+        timings = {"import run_container": import_time_ms()}
+        commands = {
+            "--help": ["--help"],
+            "list": ["--config_file", str(conf_dir), "list"],
+            "run --debug": ["--config_file", str(conf_dir), "--debug", "run", "Bench", "hostname"],
+        }
+        # run each command once first so the config cache is warm
+        for name, command in commands.items():
+            time_command(command, root, 1)
+            timings[name] = time_command(command, root, args.repeats)
+
+    failed = False
+    for name, ms in timings.items():
+        over = args.max_ms is not None and ms > args.max_ms
+        failed |= over
+        print(f"{name:<22} {ms:8.1f} ms{'  <-- over limit' if over else ''}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# Benchmark comparing serial and parallel deep validation of config files.
+#
+# Creates a directory of synthetic config files (a few thousand containers
+# by default) and times the deep (filesystem) validation of them, first
+# serially with no stat cache (i.e. one stat round trip per check, as the
+# checks used to be done) and then with the stat cache and a thread pool.
+#
+# On a local disk stat calls are very fast so the difference is small,
+# to get a realistic picture either point --root at a directory on the
+# parallel filesystem or use --latency to add an artificial delay to
+# every stat.
+#
+# usage: python benchmarks/bench_validation.py [--containers N] [--jobs N]
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import stat_cache
+from config_cache import ConfigCache
+from run_container import find_config_files, validate_container_configs
+
+
+def make_configs(root: Path, n_containers: int, per_file: int, n_shared: int):
+    '''
+    Write synthetic config files to root. Containers share a small number
+    of definition files and shared directories, as they do in practice.
+    '''
+    conf_dir = root / "configs"
+    conf_dir.mkdir()
+    for I in range(n_shared):
+        (root / f"shared{I}").mkdir()
+        (root / f"model{I}.def").write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+
+    for start in range(0, n_containers, per_file):
+        lines = []
+        for J in range(start, min(start + per_file, n_containers)):
+            lines.append(
+                f"Model_{J}:\n"
+                f"  description: 'synthetic model {J}'\n"
+                f"  container_definition: '{root / f'model{J % n_shared}.def'}'\n"
+                f"  shared_directories: '{root / f'shared{J % n_shared}'}'\n"
+            )
+        (conf_dir / f"conf{start // per_file:05d}.yaml").write_text("".join(lines))
+    return conf_dir
+
+
+def add_latency(seconds: float):
+    # wrap os.stat to simulate a network filesystem
+    real_stat = os.stat
+
+    def slow_stat(path, *args, **kwargs):
+        time.sleep(seconds)
+        return real_stat(path, *args, **kwargs)
+
+    os.stat = slow_stat
+
+
+def time_validation(config_files, cache, jobs: int, cached: bool) -> float:
+    stat_cache.clear_stat_cache()
+    start = time.perf_counter()
+    if cached:
+        errors = validate_container_configs(config_files, cache, deep=True, jobs=jobs)
+    else:
+        # bypass the stat cache so every check costs a stat
+        real_path_kind = stat_cache.path_kind.__wrapped__
+        import run_container, check_URI
+        run_container.path_kind = real_path_kind
+        check_URI.path_kind = real_path_kind
+        try:
+            errors = validate_container_configs(config_files, cache, deep=True, jobs=1)
+        finally:
+            run_container.path_kind = stat_cache.path_kind
+            check_URI.path_kind = stat_cache.path_kind
+    elapsed = time.perf_counter() - start
+    assert errors == [], errors
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serial vs parallel config validation")
+    parser.add_argument("--containers", type=int, default=4000, help="number of synthetic containers")
+    parser.add_argument("--per_file", type=int, default=20, help="containers per config file")
+    parser.add_argument("--shared", type=int, default=200, help="number of distinct definitions/shared dirs")
+    parser.add_argument("--jobs", type=int, default=stat_cache.DEFAULT_JOBS, help="threads for parallel run")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra ms added to every stat")
+    parser.add_argument("--root", type=str, default=None, help="directory to create test files in")
+    args = parser.parse_args()
+
+    if args.latency > 0:
+        add_latency(args.latency / 1000)
+
+    with tempfile.TemporaryDirectory(dir=args.root) as tmp:
+        conf_dir = make_configs(Path(tmp), args.containers, args.per_file, args.shared)
+        config_files = find_config_files(conf_dir)
+        # parse once first so both runs only time the deep checks
+        cache = ConfigCache(Path(tmp) / "config_cache.json")
+        validate_container_configs(config_files, cache)
+
+        serial = time_validation(config_files, cache, jobs=1, cached=False)
+        parallel = time_validation(config_files, cache, jobs=args.jobs, cached=True)
+
+    print(f"containers: {args.containers}  files: {len(config_files)}  jobs: {args.jobs}  latency: {args.latency}ms")
+    print(f"serial, uncached : {serial:8.3f} s")
+    print(f"parallel, cached : {parallel:8.3f} s")
+    print(f"speedup          : {serial / parallel:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from processes import STALE_SECONDS, pid_alive
+
+# lock files are stored next to the image e.g. Images/model.sif.lock
+LOCK_SUFFIX = ".lock"
+# how often to check if a lock has been released
+POLL_SECONDS = 0.5
+# while a lock is held its mtime is refreshed this often
+HEARTBEAT_SECONDS = 30
+
+
+class BuildLockTimeout(Exception):
+    """
+    Custom Exception to be raised when we give up waiting for another
+    process to finish building an image.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def lock_path(image_file) -> Path:
+    """
+    Function to get the path of the lock file for an image.
+    """
+    return Path(f"{image_file}{LOCK_SUFFIX}")
+
+
+class BuildLock:
+    """
+    Cross-process lock around building an image, so that only one
+    process builds (and pulls the layers for) a given image at a time.
+    This is a lock file created with O_EXCL, which works across users
+    and on shared filesystems, containing the pid and host of the holder.
+
+    A lock is treated as stale, and removed, if the holder is on this
+    host and is no longer running, or if it is on another host (or the
+    lock can't be read) and the lock has not been refreshed for
+    STALE_SECONDS.
+
+    Attributes:
+        image_file -- image the lock is for
+        timeout -- seconds to wait for the lock, None to wait forever
+        waited -- True if another process held the lock when we tried
+                  to take it, i.e. it may have just built the image
+    """
+
+    def __init__(self, image_file, timeout: Optional[float] = None):
+        self.image_file = image_file
+        self.path = lock_path(image_file)
+        self.timeout = timeout
+        self.waited = False
+        self._info = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _try_create(self) -> bool:
+        info = {"pid": os.getpid(), "host": socket.gethostname(), "started": time.time()}
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o664)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as file:
+            json.dump(info, file)
+        self._info = info
+        return True
+
+    def _read_holder(self):
+        try:
+            text = self.path.read_text()
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return None, None
+        try:
+            return json.loads(text), mtime
+        except ValueError:
+            # lock is still being written
+            return {}, mtime
+
+    def _is_stale(self, holder: dict, mtime: float) -> bool:
+        if holder.get("host") == socket.gethostname() and "pid" in holder:
+            return not pid_alive(holder["pid"])
+        return time.time() - mtime > STALE_SECONDS
+
+    def _remove_stale(self, holder: dict):
+        # move the lock out of the way first so that only one waiting
+        # process can remove it, then check it was the lock we looked at.
+        stale_path = self.path.with_name(f"{self.path.name}.stale.{os.getpid()}")
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return
+        try:
+            if json.loads(stale_path.read_text()) != holder:
+                # someone else replaced the lock in the meantime, put it back
+                try:
+                    os.link(stale_path, self.path)
+                except FileExistsError:
+                    pass
+                return
+        except ValueError:
+            pass
+        finally:
+            stale_path.unlink(missing_ok=True)
+        logging.warning(f"Removed stale build lock {self.path} held by {holder}")
+
+    def acquire(self):
+        start = time.monotonic()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while not self._try_create():
+            holder, mtime = self._read_holder()
+            if holder is None:
+                # released between our attempt and reading it
+                continue
+            # a lock that can't be read (the holder died before it finished
+            # writing it) is stale once it is as old as one from another host
+            if self._is_stale(holder, mtime):
+                self._remove_stale(holder)
+                continue
+            if not self.waited:
+                print(f"Waiting for another build of {self.image_file} "
+                      f"(pid {holder.get('pid')} on {holder.get('host')}) to finish")
+                self.waited = True
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                raise BuildLockTimeout(f"Timed out waiting for build lock {self.path}")
+            time.sleep(POLL_SECONDS)
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def _refresh(self):
+        # keep touching the lock so other hosts know we are still alive
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        holder, _ = self._read_holder()
+        if holder == self._info:
+            self.path.unlink(missing_ok=True)
+        self._info = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
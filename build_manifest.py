@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import subprocess
+from pathlib import Path
+from typing import Optional
+from check_URI import validate_uri
+
+# manifest files are stored next to the image e.g. Images/model.sif.manifest.json
+MANIFEST_SUFFIX = ".manifest.json"
+# fields of the manifest that must match for an image to be up to date
+MANIFEST_KEYS = ["definition", "definition_sha256", "apptainer_version", "build_flags"]
+
+
+def manifest_path(image_file) -> Path:
+    """
+    Function to get the path of the build manifest for an image.
+    """
+    return Path(f"{image_file}{MANIFEST_SUFFIX}")
+
+
+def definition_hash(definition: str):
+    """
+    Function to hash the contents of a definition file. URIs
+    (docker://, library:// etc.) have no local contents so
+    return None, the URI itself is recorded in the manifest.
+    """
+    if validate_uri(definition):
+        return None
+    return hashlib.sha256(Path(definition).read_bytes()).hexdigest()
+
+
+def apptainer_version(runtime: str = "apptainer") -> str:
+    """
+    Function to get the version string of the installed apptainer.
+    """
+    try:
+        proc = subprocess.run([runtime, "--version"], capture_output=True, text=True)
+    except OSError:
+        return "unknown"
+    if proc.returncode != 0:
+        return "unknown"
+    return proc.stdout.strip()
+
+
+def make_manifest(
+    definition: str,
+    build_flags: str,
+    runtime: str = "apptainer",
+    version: Optional[str] = None
+) -> dict:
+    """
+    Function to create the build manifest describing everything
+    that goes into building an image. The apptainer version can
+    be given to save looking it up, e.g. when building many images.
+    """
+    if version is None:
+        version = apptainer_version(runtime)
+    return {
+        "definition": definition,
+        "definition_sha256": definition_hash(definition),
+        "apptainer_version": version,
+        "build_flags": build_flags.strip(),
+    }
+
+
+def read_manifest(image_file):
+    """
+    Function to read the build manifest for an image,
+    returns None if there isn't one (or it can't be read).
+    """
+    P = manifest_path(image_file)
+    try:
+        return json.loads(P.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(image_file, manifest: dict):
+    """
+    Function to record the manifest for a freshly built image.
+    """
+    from datetime import datetime, timezone
+    manifest = dict(manifest)
+    manifest["built_at"] = datetime.now(timezone.utc).isoformat()
+    manifest_path(image_file).write_text(json.dumps(manifest, indent=2) + "\n")
+    logging.info(f"Wrote build manifest for {image_file}")
+
+
+def is_up_to_date(image_file, manifest: dict) -> bool:
+    """
+    Function to check if an image needs to be rebuilt. An image is up
+    to date if it exists and its manifest matches the given manifest
+    in all of MANIFEST_KEYS.
+    """
+    if not Path(image_file).exists():
+        return False
+    old_manifest = read_manifest(image_file)
+    if old_manifest is None:
+        return False
+    stale = [key for key in MANIFEST_KEYS if old_manifest.get(key) != manifest.get(key)]
+    if stale:
+        logging.info(f"{image_file} is out of date, changed: {stale}")
+        return False
+    return True
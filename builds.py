@@ -0,0 +1,156 @@
+import contextlib
+import logging
+import os
+import subprocess
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from build_manifest import is_up_to_date, write_manifest
+from build_lock import BuildLock
+from layer_cache import CACHE_UMASK, CacheLock, record_build, snapshot_blobs
+from defaults import DEFAULT_BUILD_JOBS
+
+# directory for the output of each build when running many builds at once
+BUILD_LOG_DIR = "logs"
+# sandboxes are stored next to the image e.g. Images/model.sandbox
+SANDBOX_SUFFIX = ".sandbox"
+
+
+def sandbox_path(image_file) -> str:
+    """
+    Function to get the path of the (directory) sandbox for an image.
+    """
+    return str(Path(image_file).with_suffix(SANDBOX_SUFFIX))
+
+
+def build_log_file(model_name: str) -> str:
+    """
+    Function to get the file the output of a bulk build is written to.
+    """
+    return str(Path(BUILD_LOG_DIR) / f"build_{model_name}.log")
+
+
+@dataclass
+class BuildJob:
+    """
+    Everything needed to build the image for one model. If layer_cache
+    is set it is used as apptainer's cache, shared with other builds.
+    """
+    model_name: str
+    image_file: str
+    command: list
+    manifest: dict
+    log_file: Optional[str] = field(default=None)
+    layer_cache: Optional[str] = field(default=None)
+
+
+@dataclass
+class BuildResult:
+    """
+    Outcome of a single build, status is one of "built",
+    "skipped" (already up to date), "failed" or "duplicate"
+    (another model builds the same image).
+    """
+    model_name: str
+    status: str
+    returncode: int = field(default=0)
+    seconds: float = field(default=0.0)
+    message: str = field(default="")
+
+
+def run_build(job: BuildJob, force: bool = False) -> BuildResult:
+    """
+    Function to build a single image, unless it is already up to date
+    (and force is False). If the job has a log_file the output of
+    apptainer is written there rather than to the terminal. The build
+    holds a BuildLock on the image so if another process is already
+    building it we wait for that build and reuse the result.
+    """
+    start = time.perf_counter()
+    with BuildLock(job.image_file) as lock:
+        # if we had to wait for another process it has probably just built
+        # this image, so reuse it even if a rebuild was forced.
+        if (lock.waited or not force) and is_up_to_date(job.image_file, job.manifest):
+            logging.info(f"{job.image_file} is up to date, skipping build")
+            return BuildResult(job.model_name, "skipped", 0, time.perf_counter() - start)
+
+        logging.info(f"Building {job.model_name}: {' '.join(job.command)}")
+        with contextlib.ExitStack() as stack:
+            kwargs = {}
+            if job.layer_cache is not None:
+                # hold the cache so prune can't remove layers we are using
+                stack.enter_context(CacheLock(job.layer_cache))
+                before = snapshot_blobs(job.layer_cache)
+                kwargs = {"env": dict(os.environ, APPTAINER_CACHEDIR=job.layer_cache), "umask": CACHE_UMASK}
+            try:
+                if job.log_file is None:
+                    returncode = subprocess.run(job.command, **kwargs).returncode
+                else:
+                    Path(job.log_file).parent.mkdir(parents=True, exist_ok=True)
+                    with open(job.log_file, "w") as log:
+                        returncode = subprocess.run(
+                            job.command, stdout=log, stderr=subprocess.STDOUT, **kwargs
+                        ).returncode
+            except OSError as e:
+                # same exit code a shell would give for a missing command
+                logging.error(f"Could not run {job.command[0]}: {e}")
+                returncode = 127
+            if job.layer_cache is not None:
+                record_build(job.layer_cache, job.model_name, before, snapshot_blobs(job.layer_cache), returncode)
+        seconds = time.perf_counter() - start
+
+        if returncode != 0:
+            logging.error(f"Build of {job.model_name} failed with exit code {returncode}")
+            return BuildResult(job.model_name, "failed", returncode, seconds)
+        write_manifest(job.image_file, job.manifest)
+    return BuildResult(job.model_name, "built", 0, seconds)
+
+
+def run_builds(jobs: list, max_jobs: int = DEFAULT_BUILD_JOBS, force: bool = False) -> list:
+    """
+    Function to run many builds using a pool of at most max_jobs workers.
+    Jobs that build the same image file are only built once. Returns a
+    list of BuildResults in the same order as jobs.
+    """
+    unique = {}
+    for job in jobs:
+        unique.setdefault(Path(job.image_file).resolve(), job)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, max_jobs)) as pool:
+        futures = {
+            image: pool.submit(run_build, job, force) for image, job in unique.items()
+        }
+        results = {image: future.result() for image, future in futures.items()}
+
+    all_results = []
+    for job in jobs:
+        image = Path(job.image_file).resolve()
+        result = results[image]
+        if unique[image] is not job:
+            result = BuildResult(
+                job.model_name,
+                "duplicate",
+                result.returncode,
+                0.0,
+                f"same image as {unique[image].model_name}",
+            )
+        all_results.append(result)
+    return all_results
+
+
+def print_build_summary(results: list):
+    """
+    Function to print a table summarising the results of run_builds.
+    """
+    print("*********************************************************************")
+    print("Build summary:")
+    print("*********************************************************************")
+    print(f"{'Name:':<30} {'Status:':<10} {'Time (s):':>10}  Exit code:")
+    print("-----------------------------")
+    for result in results:
+        line = f"{result.model_name:<30} {result.status:<10} {result.seconds:>10.1f}  {result.returncode}"
+        if result.message:
+            line += f"  ({result.message})"
+        print(line)
@@ -1,5 +1,5 @@
 import re
-from pathlib import Path
+from stat_cache import path_kind
 # define regex's to check 3 common types of URI used by Apptainer
 LIBRARY_RE = re.compile(
     r"^library://([A-Za-z0-9_.-]*)"
@@ -39,8 +39,13 @@ def validate_uri(v):
     return False
 
 
-def check_container_def(definition:str)->str:
-            
+def normalise_container_def(definition:str)->str:
+    """
+    Cheap structural check of a container definition that does not touch
+    the filesystem. Returns the definition as an Apptainer URI (adding
+    docker:// if needed) or, if it is not a URI, as a path to a .def file.
+    Whether that file actually exists is checked by check_container_def.
+    """
     # first check if string is a valid uri,
     # that is it starts with: docker://, 
     # library:// or oras:// 
@@ -52,17 +57,34 @@ def check_container_def(definition:str)->str:
     # not a valid uri so check once more to see if we need to add docker://
     elif validate_uri(f"docker://{definition}"):
         return f"docker://{definition}"
-    
-    else:
-        # still not a uri so check if its a valid path to a file
-        p = Path(definition)
-        if p.exists() and p.is_file() and definition.endswith(".def"):
-            return definition
-        # no idea what this is so raise error
-        msg = f" Container definition: {definition} is not valid. \n \
-            This must be a path to an existing file, or an Apptainer URI \n \
-                (with tag if required)"
-        
-        raise ValueError(msg)
+
+    # still not a uri so check if it looks like a path to a definition file
+    elif definition.endswith(".def"):
+        return definition
+
+    # no idea what this is so raise error
+    msg = f" Container definition: {definition} is not valid. \n \
+        This must be a path to an existing file, or an Apptainer URI \n \
+            (with tag if required)"
+
+    raise ValueError(msg)
 
 
+def check_container_def(definition:str)->str:
+    """
+    Full check of a container definition, as normalise_container_def
+    but also checks that definition files actually exist. The result
+    of the stat is cached (see stat_cache.path_kind).
+    """
+    definition = normalise_container_def(definition)
+    if validate_uri(definition):
+        return definition
+
+    if path_kind(definition) == "file":
+        return definition
+    # no idea what this is so raise error
+    msg = f" Container definition: {definition} is not valid. \n \
+        This must be a path to an existing file, or an Apptainer URI \n \
+            (with tag if required)"
+    
+    raise ValueError(msg)
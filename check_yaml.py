@@ -14,10 +14,20 @@ class DuplicateKeyError(Exception):
         super().__init__(self.message)
 
 
-class DuplicateKeyDetector(yaml.SafeLoader):
+# use the much faster libyaml based loader if pyyaml was built with it
+try:
+    from yaml import CSafeLoader as _FastSafeLoader
+    HAVE_LIBYAML = True
+except ImportError:
+    _FastSafeLoader = yaml.SafeLoader
+    HAVE_LIBYAML = False
+
+
+class _DuplicateKeyMixin:
     """
     The standard python yaml loader silently overwrites keys if a duplicate value occurs.
-    This is a custom YAML loader that raises an error when duplicate keys are found.
+    This mixin replaces construct_mapping so that an error is raised when duplicate keys
+    are found. It is shared by both the pure python and libyaml based loaders below.
     """
 
     def construct_mapping(self, node, deep=False):
@@ -32,6 +42,21 @@ class DuplicateKeyDetector(yaml.SafeLoader):
         return mapping
 
 
+class DuplicateKeyDetector(_DuplicateKeyMixin, yaml.SafeLoader):
+    """
+    The standard python yaml loader silently overwrites keys if a duplicate value occurs.
+    This is a custom YAML loader that raises an error when duplicate keys are found.
+    """
+
+
+class FastDuplicateKeyDetector(_DuplicateKeyMixin, _FastSafeLoader):
+    """
+    Same as DuplicateKeyDetector but built on libyaml's CSafeLoader, which is
+    several times faster. Falls back to the pure python SafeLoader if pyyaml
+    was installed without libyaml.
+    """
+
+
 def is_valid_name(ModelName: str) -> bool:
     """
     Function to check if container name is valid
@@ -0,0 +1,117 @@
+# Choice of squashfs compression for sif images. apptainer builds images
+# with gzip by default, which keeps them small but makes every container
+# start pay for decompression. Faster algorithms (or none at all) give
+# bigger images that start quicker, which is the better trade for models
+# that are started often, see the benchmark operation to compare them.
+import time
+from typing import List, Tuple
+from defaults import DEFAULT_BENCH_REPEATS
+
+# compression algorithms mksquashfs understands, plus none for no compression
+COMPRESSION_ALGORITHMS = ["gzip", "lzo", "lz4", "xz", "zstd", "none"]
+# range of -Xcompression-level for the algorithms that take one
+COMPRESSION_LEVELS = {"gzip": (1, 9), "lzo": (1, 9), "zstd": (1, 22)}
+
+
+def check_compression(algorithm: str, level: int = 0):
+    """
+    Function to check a compression algorithm and level are valid,
+    raises ValueError if not. An empty algorithm means apptainer's
+    default and a level of 0 means the algorithm's default.
+    """
+    if algorithm == "":
+        if level != 0:
+            raise ValueError("compression_level needs compression to be set")
+        return
+    if algorithm not in COMPRESSION_ALGORITHMS:
+        raise ValueError(
+            f"compression {algorithm} is not valid, must be one of {COMPRESSION_ALGORITHMS}"
+        )
+    if level == 0:
+        return
+    if algorithm not in COMPRESSION_LEVELS:
+        raise ValueError(f"compression {algorithm} does not take a compression_level")
+    low, high = COMPRESSION_LEVELS[algorithm]
+    if not low <= level <= high:
+        raise ValueError(f"compression_level for {algorithm} must be between {low} and {high}")
+
+
+def parse_compression(spec: str) -> Tuple[str, int]:
+    """
+    Function to turn a compression given on the command line, e.g. zstd
+    or zstd:3, into an (algorithm, level) pair. Raises ValueError if it
+    is not valid.
+    """
+    algorithm, _, level = spec.partition(":")
+    try:
+        level = int(level) if level else 0
+    except ValueError:
+        raise ValueError(f"compression level in {spec} must be a whole number")
+    check_compression(algorithm, level)
+    return algorithm, level
+
+
+def compression_label(algorithm: str, level: int = 0) -> str:
+    """
+    Function to get a short name for a compression e.g. zstd-3,
+    used in listings and in the file names of benchmark images.
+    """
+    if algorithm == "":
+        return "default"
+    if level:
+        return f"{algorithm}-{level}"
+    return algorithm
+
+
+def mksquashfs_args(algorithm: str, level: int = 0) -> List[str]:
+    """
+    Function to get the apptainer build flags that select a compression.
+    """
+    if algorithm == "":
+        return []
+    if algorithm == "none":
+        args = "-noI -noD -noF -noX"
+    else:
+        args = f"-comp {algorithm}"
+        if level:
+            args += f" -Xcompression-level {level}"
+    return ["--mksquashfs-args", args]
+
+
+def time_command(argv: list, repeats: int = DEFAULT_BENCH_REPEATS) -> List[float]:
+    """
+    Function to run a command repeats times and return the wall clock
+    time of each run in seconds. Raises CalledProcessError if it fails.
+    """
+    # this and statistics are only needed by the benchmark operation, whereas
+    # the rest of this module is used every time a config file is checked
+    import subprocess
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def print_benchmark(model_name: str, results: dict):
+    """
+    Function to print a table of the results of the benchmark operation,
+    results is a dict of compression label to (image size in bytes, list
+    of times), the size is None if the image could not be built.
+    The first run is shown separately as it is the only one that may not
+    find the image in the page cache.
+    """
+    import statistics
+    print("*********************************************************************")
+    print(f"Start up time of {model_name}:")
+    print("*********************************************************************")
+    print(f"{'Compression:':<15} {'Size (MB):':>10} {'First (s):':>10} {'Median (s):':>12} {'Min (s):':>10}")
+    print("-----------------------------")
+    for label, (size, times) in results.items():
+        size = size / 2**20 if size is not None else float("nan")
+        if times:
+            print(f"{label:<15} {size:>10.1f} {times[0]:>10.3f} "
+                  f"{statistics.median(times):>12.3f} {min(times):>10.3f}")
+        else:
+            print(f"{label:<15} {size:>10.1f} {'failed':>10}")
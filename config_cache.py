@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from defaults import DEFAULT_CACHE_FILE
+
+# bump this if the layout of the cache file (or of ContainerConfig) changes
+# so that old caches are silently thrown away rather than misread.
+CACHE_VERSION = 7
+
+# regex to pick out the top level keys (i.e. model names) of a config
+# file without parsing it. Top level keys are any line that does not
+# start with whitespace, a comment or a yaml document marker.
+TOP_LEVEL_KEY_RE = re.compile(r"""^(?![#\s-])['"]?([^'":#]+?)['"]?\s*:(?:\s|$)""", re.MULTILINE)
+
+
+def file_signature(conf_file) -> dict:
+    """
+    Function to compute the signature used as the cache key for a
+    config file, that is its size, modification time and a hash
+    of its contents.
+    """
+    P = Path(conf_file)
+    stat = P.stat()
+    digest = hashlib.sha256(P.read_bytes()).hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+
+
+def stat_signature(conf_file) -> dict:
+    """
+    Cheaper version of file_signature that only uses a single stat call,
+    used to check if the model index for a file is still valid.
+    """
+    stat = Path(conf_file).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def scan_model_names(conf_file) -> list:
+    """
+    Function to find the names of all the models defined in a config
+    file by scanning for top level keys rather than parsing the yaml.
+    """
+    text = Path(conf_file).read_text()
+    return TOP_LEVEL_KEY_RE.findall(text)
+
+
+def build_index(config_files: list, cache=None) -> dict:
+    """
+    Function to create a dict mapping model names to the config file
+    they are defined in. If a ConfigCache is given the names found in
+    each file are stored in it, so the index can be rebuilt with only
+    a stat per file. Model names must be unique across all files so
+    a DuplicateKeyError is raised if the same name is found twice.
+    """
+    index = {}
+    for conf_file in config_files:
+        names = cache.get_names(conf_file) if cache is not None else None
+        if names is None:
+            names = scan_model_names(conf_file)
+            if cache is not None:
+                cache.put_names(conf_file, names)
+
+        for name in names:
+            if name in index:
+                from check_yaml import DuplicateKeyError
+                raise DuplicateKeyError(
+                    f"Error in config of model {name} in {conf_file} \
+                        this appears to have the same \n \
+                        name as another model in {index[name]}. Two models must \
+                        not share the same name."
+                )
+            index[name] = Path(conf_file)
+    return index
+
+
+class ConfigCache:
+    """
+    On-disk cache of validated container configs. Entries are stored
+    per yaml file (keyed by absolute path) along with the files size,
+    mtime and content hash. An entry is only used if all of these still
+    match the file on disk, so only files that have changed are re-parsed.
+
+    Configs are stored as plain dicts (i.e. dataclasses.asdict of each
+    ContainerConfig) so the cache file is human readable json.
+
+    Attributes:
+        cache_file -- path to the json file used to store the cache
+        rebuild -- if True ignore any existing entries and rebuild the cache
+    """
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, rebuild: bool = False):
+        self.cache_file = Path(cache_file)
+        self.entries = {}
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if rebuild:
+            logging.info(f"Rebuilding config cache {self.cache_file}")
+            self._dirty = True
+        else:
+            self._read()
+
+    def _read(self):
+        if not self.cache_file.exists():
+            return
+        try:
+            data = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable config cache {self.cache_file}: {e}")
+            return
+        if data.get("version") != CACHE_VERSION:
+            logging.info(f"Config cache {self.cache_file} is out of date, ignoring it.")
+            return
+        self.entries = data.get("files", {})
+        self.index = data.get("index", {})
+
+    def get(self, conf_file):
+        """
+        Return the cached dict of container configs for conf_file
+        or None if there is no valid entry for it.
+        """
+        key = str(Path(conf_file).resolve())
+        entry = self.entries.get(key)
+        if entry is not None and entry["signature"] == file_signature(conf_file):
+            self.hits += 1
+            logging.info(f"Using cached config for {conf_file}")
+            return entry["containers"]
+        self.misses += 1
+        return None
+
+    def put(self, conf_file, containers: dict):
+        """
+        Store dict of container configs (as plain dicts) for conf_file.
+        """
+        key = str(Path(conf_file).resolve())
+        self.entries[key] = {
+            "signature": file_signature(conf_file),
+            "containers": containers,
+        }
+        self._dirty = True
+
+    def get_names(self, conf_file):
+        """
+        Return the cached list of model names defined in conf_file
+        or None if the file has changed since they were recorded.
+        """
+        key = str(Path(conf_file).resolve())
+        entry = self.index.get(key)
+        if entry is not None and entry["signature"] == stat_signature(conf_file):
+            return entry["names"]
+        return None
+
+    def put_names(self, conf_file, names: list):
+        """
+        Store the list of model names defined in conf_file.
+        """
+        key = str(Path(conf_file).resolve())
+        self.index[key] = {"signature": stat_signature(conf_file), "names": names}
+        self._dirty = True
+
+    def save(self):
+        """
+        Write the cache back to disk if anything has changed. Entries for
+        files that no longer exist are dropped. The file is written to a
+        temporary file first and then moved into place so that concurrent
+        invocations never see a half written cache.
+        """
+        for table in (self.entries, self.index):
+            stale = [key for key in table if not Path(key).exists()]
+            for key in stale:
+                del table[key]
+                self._dirty = True
+
+        if not self._dirty:
+            return
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_name(f"{self.cache_file.name}.{os.getpid()}.tmp")
+            tmp_file.write_text(json.dumps(
+                {"version": CACHE_VERSION, "files": self.entries, "index": self.index}
+            ))
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            # the cache is only an optimisation so never fail because of it
+            logging.warning(f"Could not write config cache {self.cache_file}: {e}")
+            return
+        self._dirty = False
@@ -0,0 +1,2290 @@
+import argparse
+from pathlib import Path
+import contextlib, io, os, shlex, sys
+from dataclasses import dataclass, field, asdict, replace
+from typing import Optional, List, TYPE_CHECKING
+from check_URI import check_container_def, normalise_container_def, validate_uri
+from stat_cache import DEFAULT_JOBS, path_kind, prefetch
+from defaults import DEFAULT_BUILD_JOBS, DEFAULT_IDLE_MINUTES, DEFAULT_INSTANCE_JOBS, DEFAULT_RESULTS_FILE
+from defaults import DEFAULT_SOCKET, METRICS_ENV, DEFAULT_LOG_DIR, LOG_DIR_ENV, LOG_FORMAT_ENV, LOG_FORMATS
+from defaults import DEFAULT_HISTORY_FILE, HISTORY_ENV, SCRATCH_ENV, DEFAULT_CACHE_FILE
+from defaults import DEFAULT_BENCH_COMPRESSIONS, DEFAULT_BENCH_REPEATS, QUOTA_ENV, STORE_ENV, DEFAULT_STORE_FILE
+from defaults import AUTO_PREFETCH_ENV, DEFAULT_PREFETCH_JOBS, DEFAULT_STATUS_FILE, DEFAULT_CACHE_DAYS
+from defaults import LAYER_CACHE_ENV, SPLIT_COUNT_ENV, SPLIT_INDEX_ENV
+import logging
+
+if TYPE_CHECKING:
+    from builds import BuildJob
+    from config_cache import ConfigCache
+    from metrics import Metrics
+
+# only start worker processes to parse config files if there are at least
+# this many to parse, otherwise starting the processes costs more than it saves.
+PARALLEL_PARSE_MIN_FILES = 16
+
+# Note: yaml, dacite and check_yaml are slow to import and are only needed
+# when a config file actually has to be parsed (i.e. it is not in the cache)
+# so they are imported inside the functions that use them rather than here,
+# as are multiprocessing and concurrent.futures, which are only needed to
+# parse config files or run jobs in parallel (tests/test_startup.py checks
+# this). Likewise the modules for each operation (builds, instances, batch
+# etc.) are only imported by the functions (and branches of _main) that
+# need them, the defaults the argument parser shows come from defaults.py.
+# See benchmarks/bench_startup.py for what starting the cli costs.
+
+def config_errors() -> tuple:
+    """
+    Function to get the exceptions that indicate a problem with a config
+    file, for use in except clauses. This is a function so that yaml and
+    dacite are only imported if an exception is actually raised.
+    """
+    import yaml
+    from dacite import DaciteError
+    from check_yaml import DuplicateKeyError
+    return (ValueError, FileNotFoundError, DuplicateKeyError, DaciteError, yaml.YAMLError)
+
+@dataclass
+class ContainerConfig:
+    description: str
+    image_file: str = field(default="")
+    container_definition: str = field(default="")
+    encryption_key: str = field(default="")
+    shared_directories: str = field(default="")
+    group: str = field(default="None")
+    encrypted: bool= field(default=False)
+    registry: str = field(default="docker")
+    read_only: bool = field(default=False)
+    use_GPU: bool = field(default=True)
+    sandbox: bool = field(default=False)
+    # squashfs compression of the sif file e.g. zstd, "" for apptainer's
+    # default, and its level, 0 for the default level of the algorithm.
+    compression: str = field(default="")
+    compression_level: int = field(default=0)
+    # pinned images are never removed to keep Images/ under the quota
+    pinned: bool = field(default=False)
+    # directory shared with other users to cache the layers of docker://
+    # etc. images in, "" for $BEDE_CONTAINERS_LAYER_CACHE (if set)
+    layer_cache: str = field(default="")
+    # definition of a base image that container_definition is built on
+    # top of, so the base is only rebuilt when its definition changes
+    base: str = field(default="")
+    # copy shared_directories to node-local scratch before run and
+    # copy stage_outputs (paths relative to it) back afterwards.
+    stage_shared: bool = field(default=False)
+    stage_outputs: List[str] = field(default_factory=list)
+    # cpus (e.g. "0-15") and/or NUMA node(s) (e.g. "0") to pin run and
+    # start to, and the number of threads for OpenMP, MKL, torch etc.
+    # inside the container, 0 for one per pinned cpu.
+    cpus: str = field(default="")
+    numa_node: str = field(default="")
+    threads: int = field(default=0)
+    
+class CMD_FormatError(Exception):
+    """
+    Custom Exception to be raised when using an operation that
+    is not valid or that has not been implemented. This should 
+    not normally be raised as its handled in the command line 
+    options but this is here in case someone adds an option 
+    in the future but forgets to handle it in format_command.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+def parse_config_file(conf_file) -> dict:
+    """
+    Function to load configs from a single yaml file, check for errors
+    and create dict of container configs with names as keys.
+    """
+    from compression import check_compression
+    from staging import check_output_path
+    import yaml
+    from dacite import from_dict
+    from check_yaml import FastDuplicateKeyDetector, is_valid_name
+
+    Containers = {}
+    with open(conf_file, "r") as file:
+        logging.info(f"Reading config from file: {file.name}")
+        # an empty file defines no containers
+        all_containers = yaml.load(file, Loader=FastDuplicateKeyDetector) or {}
+
+    for key in all_containers:
+        # check model name does not contain anything surprising.
+        if not is_valid_name(key):
+            raise ValueError(
+                f"Model name {key} in {file.name} is not valid \
+                             model names must contain only, letter number and/or underscores"
+            )
+
+        result = from_dict(data_class=ContainerConfig, data=all_containers[key])
+        Containers[key] = result
+        # if no image file is given set default image file name as "model_name.sif"
+        if result.image_file == "":
+            result.image_file = f"Images/{key}.sif"
+        elif result.image_file.endswith(".sif"):
+            pass
+        else:
+            raise ValueError(
+                f"Error in config of Model name {key} in {file.name}:\n\
+                             image file name {result.image_file} must end in .sif"
+            )
+        # if no definition file is given set default definition file name as "model_name.def"
+        if result.container_definition == "":
+            result.container_definition = f"Definitions/{key}.def"
+        else:
+            result.container_definition = normalise_container_def(result.container_definition)
+        if result.stage_shared and result.shared_directories == "":
+            raise ValueError(
+                f"Error in config of Model name {key} in {file.name}:\n\
+                             stage_shared needs shared_directories to be set"
+            )
+        for output in result.stage_outputs:
+            try:
+                check_output_path(output)
+            except ValueError as e:
+                raise ValueError(f"Error in config of Model name {key} in {file.name}:\n{e}")
+        try:
+            check_compression(result.compression, result.compression_level)
+        except ValueError as e:
+            raise ValueError(f"Error in config of Model name {key} in {file.name}:\n{e}")
+        try:
+            check_pinning(result.cpus, result.numa_node, result.threads)
+        except ValueError as e:
+            raise ValueError(f"Error in config of Model name {key} in {file.name}:\n{e}")
+        if result.base != "" and not (result.base.endswith(".def") and result.container_definition.endswith(".def")):
+            raise ValueError(
+                f"Error in config of Model name {key} in {file.name}:\n\
+                             base {result.base} must be a .def file and the container must be built from a .def file too"
+            )
+    logging.info(f"{file.name} OK")
+    return Containers
+
+def check_container_paths(
+    model_name: str,
+    Container: ContainerConfig,
+    conf_file="",
+    definition: bool = True,
+    shared: bool = True,
+):
+    """
+    Function to do the deep (i.e. filesystem) checks on a single container
+    config. These are kept separate from the cheap structural checks done in
+    parse_config_file as every check here needs at least one stat, which is
+    slow on the parallel filesystem, so they are only done for the model
+    being used and only for the paths the operation actually needs.
+
+    Results of each stat are cached for the life of the process, see
+    prefetch_container_paths to warm the cache for lots of containers.
+
+    definition -- check the definition file (and base) exists (if not using a URI)
+    shared -- check the shared directory exists and is a directory
+    """
+    # do some checks for shared directory if defined
+    if shared and Container.shared_directories != "":
+        kind = path_kind(Container.shared_directories)
+        if kind == "missing":
+            err_msg = f"The shared directory {Container.shared_directories} \n \
+                defined in {conf_file} does not exist. "
+            raise FileNotFoundError(err_msg)
+        if kind == "file":
+            err_msg = f"The shared directory {Container.shared_directories} \n \
+            defined in {conf_file} should be directory not a file."
+            raise FileNotFoundError(err_msg)
+
+    if definition:
+        try:
+            check_container_def(Container.container_definition)
+            if Container.base != "":
+                check_container_def(Container.base)
+        except ValueError as e:
+            raise FileNotFoundError(
+                f"Error in config of Model name {model_name} in {conf_file}:{e}"
+            )
+    return
+
+def load_config_file(conf_file, cache: Optional["ConfigCache"] = None) -> dict:
+    """
+    Function to get the dict of container configs defined in a single
+    file, either from the cache (if given and the file has not changed)
+    or by parsing and checking the file.
+    """
+    [(_, file_containers)] = load_config_files([conf_file], cache, workers=1)
+    if isinstance(file_containers, Exception):
+        raise file_containers
+    return file_containers
+
+def _parse_or_error(conf_file):
+    # wrapper so that errors are returned rather than raised
+    # and one bad file does not stop the others from being parsed.
+    try:
+        return parse_config_file(conf_file)
+    except config_errors() as e:
+        return e
+
+def _parse_in_worker(conf_file):
+    # not all exceptions (e.g. from dacite) can be sent back from a worker
+    # process so just return None on errors, the file is then re-parsed in
+    # the main process to get the real exception.
+    try:
+        return parse_config_file(conf_file)
+    except config_errors():
+        return None
+
+def load_config_files(
+    config_files: list,
+    cache: Optional["ConfigCache"] = None,
+    workers: Optional[int] = None
+) -> list:
+    """
+    Function to get the container configs defined in several files. Files
+    that are not in the cache are parsed, in parallel worker processes if
+    there are at least PARALLEL_PARSE_MIN_FILES of them.
+
+    Returns a list of (config file, result) pairs in the same order as
+    config_files, where result is either the dict of container configs
+    defined in that file or, if the file is not valid, the exception
+    that was raised when parsing it.
+
+    workers -- number of processes to use, defaults to the number of cpus
+    """
+    results = [None] * len(config_files)
+    to_parse = []
+    for I, conf_file in enumerate(config_files):
+        cached = cache.get(conf_file) if cache is not None else None
+        if cached is not None:
+            results[I] = {key: ContainerConfig(**value) for key, value in cached.items()}
+        else:
+            to_parse.append(I)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(to_parse))
+    if workers > 1 and len(to_parse) >= PARALLEL_PARSE_MIN_FILES:
+        logging.info(f"Parsing {len(to_parse)} config files with {workers} processes")
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = list(pool.map(
+                _parse_in_worker,
+                [config_files[I] for I in to_parse],
+                chunksize=4
+            ))
+    else:
+        parsed = [_parse_or_error(config_files[I]) for I in to_parse]
+
+    for I, file_containers in zip(to_parse, parsed):
+        if file_containers is None:
+            file_containers = _parse_or_error(config_files[I])
+        results[I] = file_containers
+        if cache is not None and not isinstance(file_containers, Exception):
+            cache.put(config_files[I], {key: asdict(value) for key, value in file_containers.items()})
+    return list(zip(config_files, results))
+
+def prefetch_container_paths(Containers, jobs: int = DEFAULT_JOBS):
+    """
+    Function to stat every definition file and shared directory used by
+    a collection of container configs concurrently, so that the deep
+    checks in check_container_paths are then just cache lookups.
+    """
+    paths = []
+    for result in Containers:
+        if result.shared_directories != "":
+            paths.append(result.shared_directories)
+        if not validate_uri(result.container_definition):
+            paths.append(result.container_definition)
+    prefetch(paths, jobs)
+
+def check_container_config(
+    config_files: list,
+    cache: Optional["ConfigCache"] = None,
+    deep: bool = False,
+    jobs: int = DEFAULT_JOBS,
+    workers: Optional[int] = None
+):
+    """
+    Function to load configs from list of yaml files, check for errors
+    and create dict of all container configs with names as keys.
+
+    If a ConfigCache is given, files that have not changed since they
+    were last checked are taken from the cache rather than re-parsed.
+    By default only the cheap structural checks are done, set deep to
+    also check that all definition files and shared directories exist
+    (using up to jobs threads to stat them). Files are parsed using up
+    to workers processes, see load_config_files.
+    """
+
+    Containers = {}
+    sources = {}
+    for conf_file, file_containers in load_config_files(config_files, cache, workers):
+        if isinstance(file_containers, Exception):
+            raise file_containers
+
+        for key, result in file_containers.items():
+            # check for duplicate model names
+            if key not in Containers:
+                Containers[key] = result
+                sources[key] = conf_file
+            else:
+                from check_yaml import DuplicateKeyError
+                raise DuplicateKeyError(
+                    f"Error in config of model {key} in {conf_file} \
+                        this appears to have the same \n \
+                        name as another model. Two models must \
+                        not share the same name."
+                )
+    if deep:
+        prefetch_container_paths(Containers.values(), jobs)
+        for key, result in Containers.items():
+            check_container_paths(key, result, sources[key])
+    if cache is not None:
+        cache.save()
+    print(f"All config files look OK")
+    return Containers
+
+class ContainerRegistry:
+    """
+    Lazily loaded, dict like collection of container configs. An index
+    of model names to config files is built when the registry is created
+    (which also checks for duplicate names across files) but a config
+    file is only parsed and checked when a model defined in it is
+    requested. This means looking up a single model only costs parsing
+    one file no matter how many config files there are.
+
+    Attributes:
+        config_files -- list of yaml config files
+        cache -- optional ConfigCache used for both the index and the configs
+    """
+
+    def __init__(self, config_files: list, cache: Optional["ConfigCache"] = None):
+        from config_cache import build_index
+        self.config_files = config_files
+        self.cache = cache
+        self.index = build_index(config_files, cache)
+        self._loaded = {}
+        if cache is not None:
+            cache.save()
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, model_name):
+        return model_name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, model_name):
+        if model_name not in self._loaded:
+            if model_name not in self.index:
+                raise KeyError(model_name)
+            conf_file = self.index[model_name]
+            self._loaded.update(load_config_file(conf_file, self.cache))
+            if self.cache is not None:
+                self.cache.save()
+            if model_name not in self._loaded:
+                # the index and the parsed file disagree, this should only happen
+                # for odd yaml (e.g. flow style mappings) that the index can't scan.
+                raise KeyError(f"{model_name} was not found when parsing {conf_file}")
+        return self._loaded[model_name]
+
+def find_config_files(container_config) -> list:
+    """
+    Function to get the list of config files to use from the
+    given path, which can either be a single yaml file or a
+    directory containing yaml files.
+    """
+    container_config = Path(container_config)
+
+    if container_config.is_dir():
+        # directory containing config files, sorted so that files
+        # are always read (and errors reported) in the same order
+        config_files = []
+        for file in sorted(container_config.glob("*.yaml")):
+            config_files.append(Path(file))
+    else:
+        # single named config file
+        if not container_config.exists():
+            raise FileNotFoundError(f"Could not find config file {container_config}")
+
+        if container_config.suffix not in [".yml", ".yaml"]:
+            raise ValueError(
+                f"config file {container_config} is not a \
+                yaml file, \n the filename must end in .yml \
+                or .yaml"
+            )
+        # create list with single container config file in it
+        config_files = [container_config]
+    return config_files
+
+def load_container_config_file(
+    container_config,
+    cache: Optional["ConfigCache"] = None,
+    deep: bool = False,
+    jobs: int = DEFAULT_JOBS,
+    workers: Optional[int] = None
+):
+    """
+    Load the config file, do some basic sanity checks
+    and then return a dict of containers with model names
+    as the keys. An optional ConfigCache can be given to
+    avoid re-parsing files that have not changed. Set deep
+    to also check all the paths in the configs exist.
+    """
+    config_files = find_config_files(container_config)
+
+    Containers = check_container_config(config_files, cache, deep, jobs, workers)
+
+    return Containers
+
+def validate_container_configs(
+    config_files: list,
+    cache: Optional["ConfigCache"] = None,
+    deep: bool = False,
+    jobs: int = DEFAULT_JOBS,
+    workers: Optional[int] = None
+) -> list:
+    """
+    Function to check every config file and report all the errors found
+    rather than stopping at the first one, for use in CI. Returns a list
+    of error messages which is empty if everything is valid. Errors are
+    always grouped by file (in the order given) then by model.
+    """
+    errors = {conf_file: [] for conf_file in config_files}
+    Containers = {}
+    for conf_file, file_containers in load_config_files(config_files, cache, workers):
+        if isinstance(file_containers, Exception):
+            errors[conf_file].append(f"{conf_file}: {file_containers}")
+            continue
+
+        for key, result in file_containers.items():
+            if key in Containers:
+                errors[conf_file].append(
+                    f"{conf_file}: {key}: model name is already used in {Containers[key][0]}"
+                )
+                continue
+            Containers[key] = (conf_file, result)
+
+    if deep:
+        prefetch_container_paths([result for _, result in Containers.values()], jobs)
+        for key, (conf_file, result) in Containers.items():
+            try:
+                check_container_paths(key, result, conf_file)
+            except config_errors() as e:
+                errors[conf_file].append(f"{conf_file}: {key}: {e}")
+    if cache is not None:
+        cache.save()
+    return [err for conf_file in config_files for err in errors[conf_file]]
+
+def image_exists(image_file:str):
+    if not Path(image_file).exists():
+        msg = f"A container with the name {image_file} \
+            \n could not be found please run build first."
+        raise FileNotFoundError(msg)
+    return
+
+def image_path(Container: ContainerConfig) -> str:
+    """
+    Function to get the image that run, start and build use, that is
+    the sandbox directory if the container uses one or the sif file.
+    """
+    from builds import sandbox_path
+    if Container.sandbox:
+        return sandbox_path(Container.image_file)
+    return Container.image_file
+
+def build_flags(Container: ContainerConfig) -> List[str]:
+    """
+    Function to get the flags that change what apptainer build produces.
+    Sandboxes can't be encrypted or compressed, the image is encrypted and
+    compressed by finalize instead.
+    """
+    from compression import mksquashfs_args
+    if Container.sandbox:
+        return ['--sandbox']
+    return encryption_flags(Container) + mksquashfs_args(Container.compression, Container.compression_level)
+
+def layered(model_name: str, Container: ContainerConfig) -> ContainerConfig:
+    """
+    Function to get the container to build, for containers with a base
+    this builds the definition on top of the base image instead.
+    """
+    from base_images import layered_definition
+    if Container.base == "":
+        return Container
+    definition = layered_definition(model_name, Container.container_definition, Container.image_file, Container.base)
+    return replace(Container, container_definition=definition)
+
+def base_job(model_name: str, Container: ContainerConfig, version: Optional[str] = None) -> Optional["BuildJob"]:
+    """
+    Function to get the BuildJob for the base image of a container,
+    or None if it doesn't have one.
+    """
+    from base_images import base_build_job
+    from layer_cache import layer_cache_dir
+    if Container.base == "":
+        return None
+    return base_build_job(
+        model_name, Container.image_file, Container.base, version, layer_cache_dir(Container.layer_cache)
+    )
+
+def build_base(model_name: str, Container: ContainerConfig, debug: bool = False) -> int:
+    """
+    Function to build the base image of a container, if it has one and
+    the base definition has changed since it was last built.
+    """
+    from build_manifest import is_up_to_date
+    from builds import run_build
+    job = base_job(model_name, Container)
+    if job is None:
+        return 0
+    if debug:
+        if not is_up_to_date(job.image_file, job.manifest):
+            print(f"the base image would be built first with: {command_string(job.command)}")
+        return 0
+    # show the output as for any other single build
+    job.log_file = None
+    result = run_build(job)
+    if result.status == "failed":
+        print(f"An error occurred. Build of the base image exited with the exit code {result.returncode}:")
+    return result.returncode
+
+def container_manifest(Container: ContainerConfig, version: Optional[str] = None) -> dict:
+    """
+    Function to get the build manifest for the image of a container, which
+    also records the compression used so that list --show_compression can show it.
+    """
+    from build_manifest import make_manifest
+    from compression import compression_label
+    manifest = make_manifest(Container.container_definition, command_string(build_flags(Container)), version=version)
+    if not Container.sandbox:
+        manifest["compression"] = compression_label(Container.compression, Container.compression_level)
+    return manifest
+
+def image_compression(Container: ContainerConfig) -> str:
+    """
+    Function to get the compression the image of a container was built
+    with, from its build manifest, or "-" if it has not been built.
+    """
+    from build_manifest import read_manifest
+    manifest = read_manifest(image_path(Container))
+    if manifest is None:
+        return "-"
+    if Container.sandbox:
+        return "sandbox"
+    # images built before the compression was recorded used the default
+    return manifest.get("compression", "default")
+
+def encryption_flags(Container: ContainerConfig) -> List[str]:
+    """
+    Function to get the apptainer flags needed for encrypted containers.
+    """
+    # check for encryption and add appropriate flags
+    if Container.encrypted:
+        if Container.encryption_key != "":
+            enc_flag = ['--passkey']
+        else:
+            enc_flag = ['--pem-path', Container.encryption_key]
+    else:
+        enc_flag = []
+    return enc_flag
+
+def check_pinning(cpus: str = "", numa_node: str = "", threads: int = 0):
+    """
+    Function to check the cpus, NUMA node(s) and thread count a container
+    is pinned to are valid, raises ValueError if not.
+    """
+    from affinity import parse_cpu_list
+    if cpus:
+        parse_cpu_list(cpus)
+    if numa_node:
+        parse_cpu_list(numa_node)
+    if threads < 0:
+        raise ValueError(f"threads must be 0 (one per pinned cpu) or more, not {threads}")
+
+def pinning_flags(Container: ContainerConfig, env: Optional[dict] = None) -> tuple:
+    """
+    Function to get the command to put in front of apptainer to pin the
+    container (if it is pinned) and the apptainer flags that set the
+    thread counts, plus any other variables in env, inside it.
+    """
+    from affinity import env_flags, pin_prefix, thread_env
+    env = {**thread_env(Container.threads, Container.cpus, Container.numa_node), **(env or {})}
+    return pin_prefix(Container.cpus, Container.numa_node), env_flags(env)
+
+def format_command(
+    operation: str,
+    model_name:str, 
+    Container:ContainerConfig, 
+    cmd_list: List[str] = ["hostname"],
+    instance: bool = False,
+    shared_source: Optional[str] = None,
+    env: Optional[dict] = None
+) -> List[str]:
+    """
+    Function to create appropriate Apptainer command based on the
+    operation requested. For run, set instance to run the command
+    inside the already running instance of the model rather than
+    starting a new container.
+
+    The shared directory (if any) is bound into the container at the
+    same path, shared_source can be given to bind a different directory
+    there instead (e.g. a copy of it on node-local scratch).
+
+    run and start are pinned to the cpus and/or NUMA node(s) of the
+    container (if any) and get its thread counts, along with any other
+    environment variables in env.
+
+    The command is returned as an argv list so it can be run without
+    a shell, use command_string to get a printable version of it.
+    """
+    from builds import sandbox_path
+
+    image = image_path(Container)
+    definition = Container.container_definition
+    enc_flag = encryption_flags(Container)
+    bind_flag = []
+    if Container.shared_directories != "":
+        source = shared_source or Container.shared_directories
+        bind_flag = ["--bind", f"{source}:{Container.shared_directories}"]
+
+    if operation == "run" and instance:
+        msg = "Running"
+        pin, env_flag = pinning_flags(Container, env)
+        apptainer_command = [*pin, "apptainer", "exec", *env_flag, f"instance://{model_name}", *cmd_list]
+
+    elif operation == "run":
+        msg = "Running"
+        image_exists(image)
+        pin, env_flag = pinning_flags(Container, env)
+        apptainer_command = [*pin, "apptainer", "exec", *enc_flag, *bind_flag, *env_flag, image, *cmd_list]
+
+    elif operation == "build" or operation == "load":
+        msg = "Building sandbox" if Container.sandbox else "Building"
+        # --force as otherwise apptainer asks before overwriting an existing
+        # image (which hangs, or fails, when there is no one to answer). We
+        # only get here if it is out of date (or a rebuild was asked for).
+        apptainer_command = ["apptainer", "build", "--force", *build_flags(Container), image, definition]
+
+    elif operation == "finalize":
+        msg = "Finalizing"
+        sandbox = sandbox_path(Container.image_file)
+        image_exists(sandbox)
+        # --force as finalize always replaces the sif file
+        apptainer_command = ["apptainer", "build", "--force", *build_flags(Container), Container.image_file, sandbox]
+
+    elif operation == "start":
+        msg = "Starting"
+        image_exists(image)
+        pin, env_flag = pinning_flags(Container, env)
+        apptainer_command = [
+            *pin, "apptainer", "instance", "start", *enc_flag, *bind_flag, *env_flag, image, model_name
+        ]
+
+    elif operation == "stop":
+        msg = "Stopping"
+        image_exists(image)
+        apptainer_command = ["apptainer", "instance", "stop", model_name]
+
+    else:
+        # this path should not happen but just in case.
+        apptainer_command = []
+        raise CMD_FormatError(f"{operation} is Not a valid operation," + \
+                               "This should not happen. Did you add an option" + \
+                               "and forget to update format_command?")
+
+    print("*********************************************************************")
+    print(f"***************** {msg}: {model_name} *********************")
+    print("*********************************************************************")
+    return apptainer_command
+
+def command_string(argv: List[str]) -> str:
+    """
+    Function to turn an argv list from format_command into a string
+    that can be printed, or pasted into a shell, to run the same command.
+    """
+    return shlex.join(argv)
+
+def add_target_arguments(sub_parser, verb: str, default_jobs: int):
+    """
+    Function to add the arguments used to pick which containers an
+    operation applies to, i.e. a single model, a group or all of them.
+    """
+    sub_parser.add_argument(
+        "model_name",
+        type=str, 
+        nargs='?',
+        default=None,
+        help="Name of Model to use")
+
+    sub_parser.add_argument(
+        "--group",
+        type=str,
+        default=None,
+        help=f"{verb} every Container in this group")
+
+    sub_parser.add_argument(
+        "--all",
+        action='store_true',
+        help=f"{verb} every Container")
+
+    sub_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=default_jobs,
+        help=f"maximum number of Containers to {verb.lower()} at once with --group or --all (default: {default_jobs})")
+
+def add_build_arguments(build_parser):
+    """
+    Function to add the arguments shared by the build and load operations.
+    """
+    add_target_arguments(build_parser, "Build", DEFAULT_BUILD_JOBS)
+
+    build_parser.add_argument(
+        "--force",
+        action='store_true',
+        help="Rebuild the Container even if it is already up to date")
+
+    build_parser.add_argument(
+        "--sandbox",
+        action='store_true',
+        help="Build a writable sandbox directory instead of a sif file, " +
+             "as if sandbox was set in the config. Use finalize to turn it into a sif file")
+
+    add_compression_argument(build_parser)
+
+def add_compression_argument(sub_parser):
+    """
+    Function to add the argument to override the compression of the sif file.
+    """
+    sub_parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        help="squashfs compression of the sif file, as ALGORITHM or ALGORITHM:LEVEL e.g. zstd:3, " +
+             "overrides compression and compression_level in the config")
+
+def add_pinning_arguments(sub_parser):
+    """
+    Function to add the arguments to override the cpus, NUMA node(s) and
+    thread count the container is pinned to.
+    """
+    sub_parser.add_argument(
+        "--cpus",
+        type=str,
+        default=None,
+        help="cpus to pin the Container to e.g. 0-15,32-47, overrides cpus in the config")
+
+    sub_parser.add_argument(
+        "--numa_node",
+        type=str,
+        default=None,
+        help="NUMA node(s) to pin the Container and its memory to e.g. 0, overrides numa_node in the config")
+
+    sub_parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="number of OpenMP/MKL/torch threads inside the Container, 0 for one per pinned cpu, " +
+             "overrides threads in the config")
+
+def parse_cmd_arguments(argv: Optional[List[str]] = None):
+    """ 
+    Function to handle parsing of command line arguments, from
+    sys.argv unless a list of arguments is given.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="A CLI tool for easily running AI/ML containers on Bede.")
+        
+    # Subparser to create subcommands for each operation (run, build, load ect.)
+    subparsers = parser.add_subparsers(
+        dest="operation",
+        required=True,
+        help="Operation to perform."
+    )
+    # sub-parser for the run operation
+    run_parser = subparsers.add_parser(
+        "run", 
+        help="Run command(s), with the Container")
+
+    run_parser.add_argument(
+        "model_name",
+        type=str, 
+        help="Name of Model to use")
+    
+    run_parser.add_argument(
+        'cmd',
+        type=str,
+        nargs='*',
+        help="Command(s) to run")
+
+    run_parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help="file of commands to run, one per line, or - to read them from stdin")
+
+    run_parser.add_argument(
+        "--sessions",
+        type=int,
+        default=1,
+        help="with --batch, number of container sessions to run the commands through (default: 1)")
+
+    run_parser.add_argument(
+        "--results",
+        type=str,
+        default=DEFAULT_RESULTS_FILE,
+        help=f"with --batch, file the exit code and output of each command is appended to (default: {DEFAULT_RESULTS_FILE})")
+
+    run_parser.add_argument(
+        "--command_timeout",
+        type=float,
+        default=None,
+        help="with --batch, seconds each command may run for before it is killed (default: no limit)")
+
+    run_parser.add_argument(
+        "--warm",
+        action='store_true',
+        help="Run inside a background instance of the Container, starting one if needed")
+
+    run_parser.add_argument(
+        "--cold",
+        action='store_true',
+        help="Always start a new Container, even if an instance is already running")
+
+    run_parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=DEFAULT_IDLE_MINUTES,
+        help="with --warm, minutes of inactivity after which an instance started by run is stopped, " +
+             f"0 to leave it running (default: {DEFAULT_IDLE_MINUTES})")
+
+    run_parser.add_argument(
+        "--sandbox",
+        action='store_true',
+        help="Run the sandbox rather than the sif file, as if sandbox was set in the config")
+
+    stage_group = run_parser.add_mutually_exclusive_group()
+    stage_group.add_argument(
+        "--stage",
+        action='store_true',
+        help="Copy the shared directory to node-local scratch and bind the copy, " +
+             "as if stage_shared was set in the config")
+
+    stage_group.add_argument(
+        "--no_stage",
+        action='store_true',
+        help="Bind the shared directory in place, even if stage_shared is set in the config")
+
+    run_parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        default=None,
+        help=f"node-local directory to stage into (default: ${SCRATCH_ENV}, $TMPDIR or /tmp)")
+
+    add_pinning_arguments(run_parser)
+
+    run_parser.add_argument(
+        "--split",
+        type=int,
+        default=1,
+        help="Run this many copies of the command at once, each pinned to its own share of the cpus " +
+             f"with copies spread over the NUMA nodes. Each gets ${SPLIT_INDEX_ENV} and ${SPLIT_COUNT_ENV} (default: 1)")
+    
+    # sub-parser for the build operation
+    build_parser = subparsers.add_parser(
+        "build", 
+        help="Build the Container, exactly equivalent to load")
+    add_build_arguments(build_parser)
+     
+    # sub-parser for the load operation
+    load_parser = subparsers.add_parser(
+        "load",
+        help="Build the Container, exactly equivalent to build")
+    add_build_arguments(load_parser)
+    
+    # sub-parser for the finalize operation
+    finalize_parser = subparsers.add_parser(
+        "finalize",
+        help="Turn the sandbox of a Container into a compressed sif file")
+
+    finalize_parser.add_argument(
+        "model_name",
+        type=str,
+        help="Name of Model to finalize")
+
+    add_compression_argument(finalize_parser)
+
+    # sub-parser for the benchmark operation
+    benchmark_parser = subparsers.add_parser(
+        "benchmark",
+        help="Compare the start up time of a Container built with different compressions")
+
+    benchmark_parser.add_argument(
+        "model_name",
+        type=str,
+        help="Name of Model to benchmark")
+
+    benchmark_parser.add_argument(
+        "--compressions",
+        type=str,
+        nargs='+',
+        default=DEFAULT_BENCH_COMPRESSIONS,
+        help=f"compressions to compare, as ALGORITHM or ALGORITHM:LEVEL (default: {' '.join(DEFAULT_BENCH_COMPRESSIONS)})")
+
+    benchmark_parser.add_argument(
+        "--repeats",
+        type=int,
+        default=DEFAULT_BENCH_REPEATS,
+        help=f"number of times to run the Container with each compression (default: {DEFAULT_BENCH_REPEATS})")
+
+    benchmark_parser.add_argument(
+        "--keep",
+        action='store_true',
+        help="Keep the images built for the benchmark, so later benchmarks don't have to rebuild them")
+
+    # sub-parser for the prefetch operation
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        help="Pull the images of Containers defined by a docker://, library:// or oras:// URI in the background")
+
+    add_target_arguments(prefetch_parser, "Prefetch", DEFAULT_PREFETCH_JOBS)
+
+    prefetch_parser.add_argument(
+        "--wait",
+        action='store_true',
+        help="Wait for the images to be pulled rather than pulling them in the background")
+
+    prefetch_parser.add_argument(
+        "--force",
+        action='store_true',
+        help="Pull the images even if they are already up to date")
+
+    prefetch_parser.add_argument(
+        "--status",
+        action='store_true',
+        help="Show the progress of the last prefetch")
+
+    prefetch_parser.add_argument(
+        "--status_file",
+        type=str,
+        default=DEFAULT_STATUS_FILE,
+        help=f"file the progress of the prefetch is written to (default: {DEFAULT_STATUS_FILE})")
+
+    # sub-parser for the list operation
+    list_parser = subparsers.add_parser(
+        "list",
+        help="List available containers")
+
+    list_parser.add_argument(
+        "--group",
+        type=str,
+        default='', 
+        help="optional group of containers to list")
+
+    list_parser.add_argument(
+        "--show_compression",
+        action='store_true',
+        help="Also show the compression each image was built with, this reads the build manifest of every image")
+    
+# sub-parser for the start operation
+    start_parser = subparsers.add_parser(
+        "start", 
+        help="Start Container as background process")
+
+    add_target_arguments(start_parser, "Start", DEFAULT_INSTANCE_JOBS)
+
+    start_parser.add_argument(
+        "--sandbox",
+        action='store_true',
+        help="Start the sandbox rather than the sif file, as if sandbox was set in the config")
+
+    add_pinning_arguments(start_parser)
+# sub-parser for the stop operation
+    stop_parser = subparsers.add_parser(
+        "stop", 
+        help="Stop container that is running in the background")
+    add_target_arguments(stop_parser, "Stop", DEFAULT_INSTANCE_JOBS)
+
+# sub-parser for the status operation
+    subparsers.add_parser(
+        "status",
+        help="Show Containers running in the background")
+
+# sub-parser for the reap operation
+    reap_parser = subparsers.add_parser(
+        "reap",
+        help="Stop Containers running in the background that have not been used recently")
+
+    reap_parser.add_argument(
+        "--idle",
+        type=float,
+        required=True,
+        help="stop instances that have not been used for this many minutes")
+
+    reap_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_INSTANCE_JOBS,
+        help=f"maximum number of instances to stop at once (default: {DEFAULT_INSTANCE_JOBS})")
+    
+# sub-parser for the validate operation
+    validate_parser = subparsers.add_parser(
+        "validate",
+        help="Check all config files and report any errors")
+
+    validate_parser.add_argument(
+        "--deep",
+        action='store_true',
+        help="also check that definition files and shared directories exist")
+
+    validate_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"number of threads used to check paths with --deep (default: {DEFAULT_JOBS})")
+
+# sub-parser for the stats operation
+    stats_parser = subparsers.add_parser(
+        "stats",
+        help="Show the resources used by past runs of Containers, e.g. to size slurm requests")
+
+    stats_parser.add_argument(
+        "model_name",
+        nargs='?',
+        default=None,
+        help="Name of the Model to show stats for (default: all Models with recorded runs)")
+
+    stats_parser.add_argument(
+        "--group",
+        type=str,
+        default=None,
+        help="only show stats for containers in this group")
+
+# sub-parser for the images operation
+    images_parser = subparsers.add_parser(
+        "images",
+        help="Show the size and last use of the image of each Container")
+
+    images_parser.add_argument(
+        "--group",
+        type=str,
+        default=None,
+        help="only show images for containers in this group")
+
+    images_parser.add_argument(
+        "--quota",
+        type=str,
+        default=None,
+        help=f"size quota to show the images against e.g. 500G (default: ${QUOTA_ENV})")
+
+# sub-parser for the prune operation
+    prune_parser = subparsers.add_parser(
+        "prune",
+        help="Remove the least recently used images until they fit in the quota, " +
+             "removed images are rebuilt the next time they are run")
+
+    prune_parser.add_argument(
+        "--quota",
+        type=str,
+        default=None,
+        help=f"total size the images must fit in e.g. 500G (default: ${QUOTA_ENV})")
+
+    prune_parser.add_argument(
+        "--dry_run",
+        action='store_true',
+        help="Only show which images would be removed")
+
+# sub-parser for the cache operation
+    cache_parser = subparsers.add_parser(
+        "cache",
+        help="Show the hit rate and size of, or prune, the layer caches shared between builds")
+
+    cache_parser.add_argument(
+        "action",
+        choices=["stats", "prune"],
+        help="stats to show how well each cache is used, prune to remove the layers that are not")
+
+    cache_parser.add_argument(
+        "--days",
+        type=float,
+        default=DEFAULT_CACHE_DAYS,
+        help=f"layers not used for this many days can be pruned (default: {DEFAULT_CACHE_DAYS})")
+
+    cache_parser.add_argument(
+        "--dry_run",
+        action='store_true',
+        help="Only show how much prune would remove")
+
+# sub-parser for the serve operation
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a daemon that keeps the configs loaded to speed up other operations")
+
+    serve_parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help=f"path of the unix socket to listen on (default: $BEDE_CONTAINERS_SOCKET or {DEFAULT_SOCKET})")
+
+# other arguments for main parser
+    parser.add_argument(
+        "--config_file", 
+        type=str, 
+        default=None, 
+        help="path to Config file for Models"
+    )
+    parser.add_argument(
+        "--debug",
+        action='store_true',
+        help="Print generated Apptainer command instead of running container, useful for sanity checking",
+    )
+    parser.add_argument(
+        "--no_daemon",
+        action='store_true',
+        help="Don't pass the request to the daemon started with serve, even if it is running",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action='store_true',
+        help="Ignore the cache of parsed config files and re-read every config file",
+    )
+    parser.add_argument(
+        "--rebuild_cache",
+        action='store_true',
+        help="Throw away the cache of parsed config files and rebuild it from scratch",
+    )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=DEFAULT_CACHE_FILE,
+        help=f"path to the cache of parsed config files (default: {DEFAULT_CACHE_FILE})",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help=f"append the timings of this invocation as a json line to this file "
+             f"(can also be set with the {METRICS_ENV} environment variable)",
+    )
+    parser.add_argument(
+        "--log_dir",
+        type=str,
+        default=None,
+        help=f"directory for the log file of this invocation, each invocation "
+             f"gets a file of its own (default: ${LOG_DIR_ENV} or {DEFAULT_LOG_DIR})",
+    )
+    parser.add_argument(
+        "--log_format",
+        choices=LOG_FORMATS,
+        default=None,
+        help=f"format of the log file, json writes one json object per line "
+             f"(default: ${LOG_FORMAT_ENV} or text)",
+    )
+    parser.add_argument(
+        "--history_file",
+        type=str,
+        default=None,
+        help=f"path to the history of resources used by each run "
+             f"(default: ${HISTORY_ENV} or {DEFAULT_HISTORY_FILE})",
+    )
+    parser.add_argument(
+        "--image_store",
+        type=str,
+        default=None,
+        help=f"path to the record of when each image was last used "
+             f"(default: ${STORE_ENV} or {DEFAULT_STORE_FILE})",
+    )
+    parser.add_argument(
+        "--layer_cache",
+        type=str,
+        default=None,
+        help=f"directory shared between users to cache the layers of images pulled from URIs in, "
+             f"overrides layer_cache in the configs (default: ${LAYER_CACHE_ENV} or apptainer's own cache)",
+    )
+    parser.add_argument(
+        "--auto_prefetch",
+        action='store_true',
+        help=f"When running or starting a Container, pull its image if it is defined by a URI and " +
+             f"has not been built, and pull the rest of its group in the background " +
+             f"(can also be set with the {AUTO_PREFETCH_ENV} environment variable)",
+    )
+    parser.add_argument(
+        "--no_history",
+        action='store_true',
+        help="Don't record the resources used by the container in the history",
+    )
+
+    args =parser.parse_args(argv)
+
+    if args.operation in ["build", "load", "start", "stop", "prefetch"]:
+        selected = [args.model_name is not None, args.group is not None, args.all]
+        if args.operation == "prefetch" and args.status:
+            if any(selected):
+                parser.error("prefetch --status can't be given a model_name, --group or --all")
+        elif sum(selected) != 1:
+            parser.error(f"{args.operation} needs exactly one of model_name, --group or --all")
+
+    if args.operation == "run" and (args.batch is None) == (len(args.cmd) == 0):
+        parser.error("run needs either a command or --batch, but not both")
+
+    if args.operation == "run" and args.stage and args.warm:
+        parser.error("--stage needs a new container so can't be used with --warm")
+
+    specs = [spec for spec in getattr(args, "compressions", None) or [getattr(args, "compression", None)] if spec]
+    if specs:
+        from compression import parse_compression
+    for spec in specs:
+        try:
+            parse_compression(spec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.operation == "benchmark" and args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    if getattr(args, "command_timeout", None) is not None and args.command_timeout <= 0:
+        parser.error("--command_timeout must be more than 0")
+
+    if getattr(args, "quota", None) is not None:
+        from image_store import parse_size
+        try:
+            parse_size(args.quota)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.operation != "run":
+        args.cmd=""
+    return args
+
+def list_containers(Containers:dict,group:str='',compression:bool=False):
+    """
+    Function to print the containers (in a group, if given). The
+    compression of each image is only shown if asked for as it has to
+    read the build manifest of every image, which is slow on a shared
+    filesystem.
+    """
+    print("*******************************")
+    print("Currently available containers:")
+    print("*******************************")
+    if compression:
+        print(f"Name:   Group:  Compression:  Description:")
+    else:
+        print(f"Name:   Group:  Description:")
+    print("-----------------------------")  
+    for key, value in Containers.items():
+        if value.group == group or group=='':
+            if compression:
+                output = f"{key}    {value.group}   {image_compression(value)}   {value.description}"
+            else:
+                output = f"{key}    {value.group}   {value.description}"
+            print(output)
+
+
+def build_containers(
+    Containers: dict,
+    group: Optional[str] = None,
+    max_jobs: int = DEFAULT_BUILD_JOBS,
+    force: bool = False,
+    debug: bool = False,
+    store: Optional[str] = None
+) -> int:
+    """
+    Function to build every container in a group (or all containers
+    if group is None) concurrently, then print a summary. Returns 1
+    if any of the builds failed or 0 otherwise. The base images the
+    containers are built on (if out of date) are built first.
+    """
+    from build_manifest import apptainer_version, is_up_to_date
+    from builds import BuildJob, BuildResult, build_log_file, print_build_summary, run_builds
+    from image_store import record_use as record_image_use, store_file
+    from layer_cache import layer_cache_dir
+    selected = {
+        key: value for key, value in Containers.items() if group is None or value.group == group
+    }
+    if not selected:
+        print(f"No containers found in group {group}")
+        return 1
+
+    version = apptainer_version()
+    jobs = []
+    base_jobs = {}
+    bases = {}
+    invalid = {}
+    for model_name, Container in selected.items():
+        try:
+            check_container_paths(model_name, Container, definition=True, shared=False)
+        except FileNotFoundError as e:
+            invalid[model_name] = BuildResult(model_name, "failed", 1, message=str(e))
+            continue
+        job = base_job(model_name, Container, version)
+        if job is not None:
+            # containers sharing a base only build it once
+            base_jobs.setdefault(job.image_file, job)
+            bases[model_name] = job.image_file
+        Container = layered(model_name, Container)
+        jobs.append(BuildJob(
+            model_name,
+            image_path(Container),
+            format_command("build", model_name, Container),
+            container_manifest(Container, version),
+            build_log_file(model_name),
+            layer_cache_dir(Container.layer_cache),
+        ))
+
+    if debug:
+        print("Debug enabled")
+        print("current config will run the following commands:")
+        for job in base_jobs.values():
+            if not is_up_to_date(job.image_file, job.manifest):
+                print(command_string(job.command))
+        for job in jobs:
+            print(command_string(job.command))
+        return 0
+
+    base_results = dict(zip(base_jobs, run_builds(list(base_jobs.values()), max_jobs)))
+    for model_name, base in bases.items():
+        if base_results[base].status == "failed":
+            invalid[model_name] = BuildResult(model_name, "failed", 1, message=f"base image {base} failed to build")
+    jobs = [job for job in jobs if job.model_name not in invalid]
+    results = {result.model_name: result for result in run_builds(jobs, max_jobs, force)}
+    for job in jobs:
+        if results[job.model_name].status == "built":
+            record_image_use(store_file(store), job.image_file, job.model_name)
+    results.update(invalid)
+    print_build_summary(list(base_results.values()) + [results[model_name] for model_name in selected])
+    if any(result.status == "failed" for result in results.values()):
+        return 1
+    return 0
+
+def manage_instances(
+    operation: str,
+    Containers: dict,
+    group: Optional[str] = None,
+    max_jobs: int = DEFAULT_INSTANCE_JOBS,
+    debug: bool = False,
+    store: Optional[str] = None
+) -> int:
+    """
+    Function to start or stop background instances of every container
+    in a group (or all containers if group is None) at the same time.
+    Instances that are already in the requested state are skipped.
+    Returns 1 if starting or stopping any of the instances failed.
+    """
+    from image_store import record_use as record_image_use, store_file
+    from instances import record_start, remove_state, run_commands, running_instances
+    selected = {
+        key: value for key, value in Containers.items() if group is None or value.group == group
+    }
+    if not selected:
+        print(f"No containers found in group {group}")
+        return 1
+
+    running = running_instances()
+    commands = {}
+    failed = {}
+    for model_name, Container in selected.items():
+        if (model_name in running) == (operation == "start"):
+            continue
+        try:
+            commands[model_name] = format_command(operation, model_name, Container)
+        except FileNotFoundError as e:
+            failed[model_name] = str(e)
+
+    if debug:
+        print("Debug enabled")
+        print("current config will run the following commands:")
+        for command in commands.values():
+            print(command_string(command))
+        return 0
+
+    results = run_commands(commands, max_jobs)
+    running = running_instances()
+    print("*********************************************************************")
+    print(f"{operation.capitalize()} summary:")
+    print("*********************************************************************")
+    for model_name, Container in selected.items():
+        if model_name in failed:
+            print(f"{model_name:<30} failed  {failed[model_name]}")
+        elif model_name not in results:
+            print(f"{model_name:<30} already {'running' if operation == 'start' else 'stopped'}")
+        elif results[model_name].returncode != 0:
+            failed[model_name] = results[model_name].stderr.strip()
+            print(f"{model_name:<30} failed  {failed[model_name]}")
+        else:
+            if operation == "start":
+                record_start(model_name, image_path(Container), pid=running.get(model_name, {}).get("pid"))
+                record_image_use(store_file(store), image_path(Container), model_name)
+            else:
+                remove_state(model_name)
+            print(f"{model_name:<30} {'started' if operation == 'start' else 'stopped'}")
+    return 1 if failed else 0
+
+def stored_models(Containers, store: Optional[str] = None) -> list:
+    """
+    Function to get the names of the containers in Containers whose images
+    are recorded in the store (i.e. have been built, pulled or run). This
+    only needs the index of a ContainerRegistry, so none of the config
+    files are parsed.
+    """
+    from image_store import load_records, store_file
+    models = {record["model"] for record in load_records(store_file(store)).values()}
+    return [key for key in Containers.keys() if key in models]
+
+def store_images(Containers, store: Optional[str] = None, keep=()) -> list:
+    """
+    Function to get a StoredImage for the image of every container in
+    Containers, which can be a dict or a ContainerRegistry, that is in the
+    store. Only the configs of those containers are loaded, the images of
+    the rest have never been built so there is nothing to remove. Images
+    used by a running instance, or in keep, are marked as in use.
+    """
+    from image_store import collect_images, store_file
+    from instances import running_instances
+    Containers = {key: Containers[key] for key in stored_models(Containers, store)}
+    in_use = [info.get("img") for info in running_instances().values() if info.get("img")]
+    in_use += list(keep)
+    return collect_images(
+        store_file(store),
+        {key: image_path(value) for key, value in Containers.items()},
+        pinned={key for key, value in Containers.items() if value.pinned},
+        in_use=in_use,
+    )
+
+def enforce_quota(
+    Containers,
+    quota: Optional[str] = None,
+    store: Optional[str] = None,
+    dry_run: bool = False,
+    keep=()
+) -> list:
+    """
+    Function to remove the least recently used images until the images of
+    all the containers fit in the quota (if there is one). Images that are
+    pinned, in use by an instance or not in any config are never removed.
+    The images in keep (e.g. one that is just about to be run) are not
+    removed either. Returns the list of images that were (or with dry_run
+    would be) removed.
+    """
+    from image_store import evict_images, image_quota, plan_eviction, store_file
+    quota_bytes = image_quota(quota)
+    if quota_bytes is None:
+        return []
+    evict = plan_eviction(store_images(Containers, store, keep), quota_bytes)
+    if dry_run:
+        return evict
+    return evict_images(store_file(store), evict)
+
+def prune_images(Containers, quota: Optional[str] = None, store: Optional[str] = None, dry_run: bool = False) -> int:
+    """
+    Function for the prune operation, returns 1 if there is no quota
+    or the images still don't fit in it.
+    """
+    from image_store import format_size, image_quota
+    quota_bytes = image_quota(quota)
+    if quota_bytes is None:
+        print(f"No quota given, use --quota or set ${QUOTA_ENV}")
+        return 1
+    removed = enforce_quota(Containers, quota, store, dry_run)
+    for image in removed:
+        print(f"{'Would remove' if dry_run else 'Removed'} {image.image_file} ({format_size(image.size)})")
+    removed_files = {image.image_file for image in removed}
+    total = sum(
+        image.size for image in store_images(Containers, store)
+        if image.size is not None and not (dry_run and image.image_file in removed_files)
+    )
+    print(f"Images use {format_size(total)} of {format_size(quota_bytes)} quota")
+    if total > quota_bytes:
+        print("Images are still over the quota, the rest are pinned or in use")
+        return 1
+    return 0
+
+def rebuild_missing(
+    model_name: str,
+    Container: ContainerConfig,
+    conf_file="",
+    store: Optional[str] = None,
+    debug: bool = False,
+    pull_remote: bool = False
+) -> Optional[int]:
+    """
+    Function to rebuild the image of a container if it was removed to stay
+    under the quota, so that run and start work as if it was never removed.
+    If pull_remote is set, missing images of containers defined by a remote
+    URI are pulled too. If a prefetch is already pulling it, this waits for
+    it (see BuildLock). Returns None if no rebuild was needed or the exit
+    code of the build.
+    """
+    from builds import BuildJob, run_build
+    from image_store import record_use as record_image_use, store_file, was_evicted
+    from layer_cache import layer_cache_dir
+    image = image_path(Container)
+    if Path(image).exists():
+        return None
+    if was_evicted(store_file(store), image):
+        print(f"{image} was removed to stay under the image quota, rebuilding it")
+    elif pull_remote and validate_uri(Container.container_definition):
+        print(f"{image} has not been built yet, pulling it from {Container.container_definition}")
+    else:
+        return None
+    # without a definition there is nothing to rebuild from, so leave
+    # format_command to report the image is missing.
+    try:
+        check_container_paths(model_name, Container, conf_file, definition=True, shared=False)
+    except FileNotFoundError:
+        return None
+    return_code = build_base(model_name, Container, debug)
+    if return_code:
+        return return_code
+    Container = layered(model_name, Container)
+    command = format_command("build", model_name, Container)
+    if debug:
+        print(command_string(command))
+        return 0
+    result = run_build(BuildJob(
+        model_name, image, command, container_manifest(Container), layer_cache=layer_cache_dir(Container.layer_cache)
+    ))
+    if result.status == "failed":
+        print(f"An error occurred. Build exited with the exit code {result.returncode}:")
+    else:
+        record_image_use(store_file(store), image, model_name)
+    return result.returncode
+
+def prefetch_containers(
+    Containers: dict,
+    group: Optional[str] = None,
+    max_jobs: int = DEFAULT_PREFETCH_JOBS,
+    wait: bool = False,
+    status_file: str = DEFAULT_STATUS_FILE,
+    store: Optional[str] = None,
+    force: bool = False,
+    debug: bool = False
+) -> int:
+    """
+    Function to pull the images of every container in a group (or all
+    containers if group is None) that is defined by a remote URI and is
+    not already up to date. Unless wait is set the pulls are done by a
+    background process, whose progress is written to status_file.
+    Returns 1 if a prefetch is already running or any pull failed.
+    """
+    from build_manifest import apptainer_version, is_up_to_date
+    from builds import BuildJob, build_log_file
+    from layer_cache import layer_cache_dir
+    from prefetch import prefetch_running, print_prefetch_status, start_prefetch
+    if prefetch_running(status_file):
+        print(f"A prefetch is already running, see prefetch --status")
+        return 1
+    version = apptainer_version()
+    jobs = []
+    for model_name, Container in Containers.items():
+        if group is not None and Container.group != group:
+            continue
+        if not validate_uri(Container.container_definition):
+            continue
+        manifest = container_manifest(Container, version)
+        if not force and is_up_to_date(image_path(Container), manifest):
+            continue
+        jobs.append(BuildJob(
+            model_name,
+            image_path(Container),
+            format_command("build", model_name, Container),
+            manifest,
+            build_log_file(model_name),
+            layer_cache_dir(Container.layer_cache),
+        ))
+    if not jobs:
+        print("Nothing to prefetch, all remote images are up to date")
+        return 0
+    if debug:
+        print("Debug enabled")
+        print("current config will run the following commands:")
+        for job in jobs:
+            print(command_string(job.command))
+        return 0
+
+    status = start_prefetch(jobs, status_file, max_jobs, wait, store, force)
+    if status is None:
+        print(f"Prefetching {len(jobs)} image(s) in the background, see prefetch --status")
+        return 0
+    print_prefetch_status(status)
+    return 1 if any(info["status"] == "failed" for info in status["models"].values()) else 0
+
+def set_layer_cache(Container: ContainerConfig, path: Optional[str]) -> ContainerConfig:
+    """
+    Function to override the layer cache of a container with one given
+    on the command line (if any), the config itself is left alone.
+    """
+    if not path:
+        return Container
+    return replace(Container, layer_cache=path)
+
+def cache_operation(paths: list, action: str, days: float = DEFAULT_CACHE_DAYS, dry_run: bool = False) -> int:
+    """
+    Function for the cache operation, shows the stats of (or prunes) each
+    of the given layer caches. Returns 1 if there are none.
+    """
+    from image_store import format_size
+    from layer_cache import cache_stats, print_cache_stats, prune_cache
+    if not paths:
+        print(f"No layer cache is used, set layer_cache in the configs, --layer_cache or ${LAYER_CACHE_ENV}")
+        return 1
+    for path in paths:
+        if action == "prune":
+            n_files, n_bytes = prune_cache(path, days, dry_run)
+            print(f"{'Would remove' if dry_run else 'Removed'} {n_files} layers ({format_size(n_bytes)}) from {path}")
+        else:
+            print_cache_stats(cache_stats(path, days), days)
+    return 0
+
+def set_compression(Container: ContainerConfig, spec: Optional[str]) -> ContainerConfig:
+    """
+    Function to override the compression of a container with one given
+    on the command line (if any), the config itself is left alone.
+    """
+    if not spec:
+        return Container
+    from compression import parse_compression
+    algorithm, level = parse_compression(spec)
+    return replace(Container, compression=algorithm, compression_level=level)
+
+def set_pinning(
+    Container: ContainerConfig,
+    cpus: Optional[str] = None,
+    numa_node: Optional[str] = None,
+    threads: Optional[int] = None
+) -> ContainerConfig:
+    """
+    Function to override the pinning of a container with that given on
+    the command line (if any), the config itself is left alone.
+    """
+    check_pinning(cpus or "", numa_node or "", threads or 0)
+    changes = {key: value for key, value in [("cpus", cpus), ("numa_node", numa_node), ("threads", threads)]
+               if value is not None}
+    return replace(Container, **changes) if changes else Container
+
+def split_commands(
+    model_name: str,
+    Container: ContainerConfig,
+    n: int,
+    cmd_list: List[str],
+    instance: bool = False,
+    shared_source: Optional[str] = None
+) -> List[List[str]]:
+    """
+    Function to get the commands for run --split, n copies of the command
+    each pinned to its own share of the cpus (see split_domains).
+    """
+    from affinity import format_cpu_list, split_domains
+    commands = []
+    for I, (node, cpus) in enumerate(split_domains(n, Container.cpus, Container.numa_node)):
+        pinned = replace(Container, cpus=format_cpu_list(cpus), numa_node=str(node))
+        env = {SPLIT_INDEX_ENV: str(I), SPLIT_COUNT_ENV: str(n)}
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands.append(format_command("run", model_name, pinned, cmd_list, instance, shared_source, env))
+    return commands
+
+def benchmark_compressions(
+    model_name: str,
+    Container: ContainerConfig,
+    specs: List[str],
+    repeats: int = DEFAULT_BENCH_REPEATS,
+    keep: bool = False,
+    debug: bool = False
+) -> int:
+    """
+    Function to build the image of a container with each of the given
+    compressions, next to the real image e.g. Images/model.zstd-3.sif,
+    then time running a trivial command in a new container from each
+    image repeats times. Returns 1 if any of the builds or runs failed.
+
+    The images are deleted afterwards unless keep is set, kept images
+    are reused by later benchmarks if they are still up to date.
+    """
+    import subprocess
+    from build_manifest import MANIFEST_SUFFIX
+    from builds import BuildJob, run_build
+    from compression import compression_label, print_benchmark, time_command
+    from layer_cache import layer_cache_dir
+    return_code = build_base(model_name, Container, debug)
+    if return_code:
+        return return_code
+    Container = layered(model_name, Container)
+    results = {}
+    for spec in specs:
+        variant = set_compression(replace(Container, sandbox=False), spec)
+        label = compression_label(variant.compression, variant.compression_level)
+        variant.image_file = str(Path(Container.image_file).with_suffix(f".{label}.sif"))
+        build_command = format_command("build", model_name, variant)
+        if debug:
+            print("Debug enabled")
+            print("current config will run the following commands:")
+            print(command_string(build_command))
+            print(command_string(["apptainer", "exec", *encryption_flags(variant), variant.image_file, "true"]))
+            continue
+
+        result = run_build(BuildJob(
+            model_name,
+            variant.image_file,
+            build_command,
+            container_manifest(variant),
+            layer_cache=layer_cache_dir(variant.layer_cache),
+        ))
+        times = []
+        size = None
+        if result.status != "failed":
+            size = Path(variant.image_file).stat().st_size
+            try:
+                times = time_command(format_command("run", model_name, variant, ["true"]), repeats)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error(f"Running {variant.image_file} failed: {e}")
+        results[label] = (size, times)
+        if not keep:
+            for P in [Path(variant.image_file), Path(f"{variant.image_file}{MANIFEST_SUFFIX}")]:
+                P.unlink(missing_ok=True)
+
+    if debug:
+        return 0
+    print_benchmark(model_name, results)
+    return 1 if any(not times for _, times in results.values()) else 0
+
+def reap_instances(idle_minutes: float, max_jobs: int = DEFAULT_INSTANCE_JOBS, debug: bool = False) -> int:
+    """
+    Function to stop every instance that has not been used for idle_minutes.
+    """
+    from instances import idle_instances, stop_instances
+    idle = idle_instances(idle_minutes)
+    if not idle:
+        print(f"No instances have been idle for {idle_minutes} minutes")
+        return 0
+    if debug:
+        print("Debug enabled, would stop the following instances:")
+        print("\n".join(idle))
+        return 0
+    results = stop_instances(idle, max_jobs)
+    for model_name, returncode in results.items():
+        print(f"{model_name:<30} {'stopped' if returncode == 0 else 'failed'}")
+    return 1 if any(results.values()) else 0
+
+def prepare_instance(
+    model_name: str,
+    Container: ContainerConfig,
+    warm: bool = False,
+    idle_minutes: float = DEFAULT_IDLE_MINUTES,
+    debug: bool = False
+) -> bool:
+    """
+    Function to decide if run should use a background instance of the
+    container, which saves the cost of setting up a new container for
+    every command. Returns True if there is an instance running (or,
+    if warm is set, one was started) and False otherwise.
+
+    Instances started here are stopped by a background process once they
+    have been idle for idle_minutes (0 leaves them running). Instances
+    that were started some other way are only found with warm, after
+    which they are recorded like the rest.
+    """
+    import subprocess
+    from instances import instance_running, record_start, record_use, remove_state, running_instances
+    from instances import spawn_idle_watcher, state_file
+    # asking apptainer costs a process of its own, so only do it if we have a
+    # record of an instance of the model (see record_start and record_use)
+    recorded = state_file(model_name).exists()
+    if (recorded or warm) and instance_running(model_name):
+        logging.info(f"Using running instance of {model_name}")
+        record_use(model_name)
+        return True
+    if recorded and not debug:
+        # the instance has stopped since it was recorded
+        remove_state(model_name)
+    if not warm:
+        return False
+    if debug:
+        print(f"No instance of {model_name} is running, run --warm would start one")
+        return True
+
+    start_command = format_command("start", model_name, Container)
+    try:
+        returncode = subprocess.run(start_command).returncode
+    except OSError:
+        returncode = 127
+    if returncode != 0:
+        print(f"Could not start an instance of {model_name}, running without one")
+        return False
+    pid = running_instances().get(model_name, {}).get("pid")
+    record_start(model_name, image_path(Container), idle_minutes or None, pid=pid)
+    if idle_minutes:
+        spawn_idle_watcher(model_name, idle_minutes)
+    return True
+
+def run_batch_file(
+    model_name: str,
+    Container: ContainerConfig,
+    args,
+    use_instance: bool = False,
+    shared_source: Optional[str] = None
+) -> int:
+    """
+    Function to run the commands from a batch file through one or more
+    long running shells inside the container. Returns 1 if any of the
+    commands failed.
+    """
+    from batch import read_batch_commands, run_batch
+    commands = read_batch_commands(args.batch)
+    session_command = format_command("run", model_name, Container, ["/bin/sh"], use_instance, shared_source)
+    if args.debug:
+        print("Debug enabled")
+        print(f"current config will run {len(commands)} commands through {args.sessions} session(s) of:")
+        print(command_string(session_command))
+        return 0
+
+    results = run_batch(commands, session_command, args.sessions, args.results, args.command_timeout)
+    n_failed = sum(result["returncode"] != 0 for result in results)
+    print(f"Ran {len(results)} commands, {n_failed} failed. Results written to {args.results}")
+    return 1 if n_failed else 0
+
+def run_split(
+    model_name: str,
+    Container: ContainerConfig,
+    args,
+    use_instance: bool = False,
+    shared_source: Optional[str] = None
+) -> int:
+    """
+    Function to run --split copies of the command at once, each pinned to
+    its own share of the cpus, and wait for all of them. Each copy is
+    recorded in the history. Returns the first non-zero exit code, if any.
+    """
+    from affinity import run_copies
+    from history import history_file, record_run
+    commands = split_commands(model_name, Container, args.split, args.cmd, use_instance, shared_source)
+    print("*********************************************************************")
+    print(f"***************** Running {len(commands)} copies: {model_name} *********************")
+    print("*********************************************************************")
+    if args.debug:
+        print("Debug enabled")
+        print(f"current config will run the following {len(commands)} commands at once:")
+        for command in commands:
+            print(command_string(command))
+        return 0
+
+    results = run_copies(commands, usage=not args.no_history)
+    for returncode, usage in results:
+        if usage is not None:
+            record_run(history_file(args.history_file), model_name, args.operation, returncode, usage)
+    failed = [(I, returncode) for I, (returncode, _) in enumerate(results) if returncode != 0]
+    for I, returncode in failed:
+        print(f"An error occurred. Copy {I} of the Container exited with the exit code {returncode}:")
+    return failed[0][1] if failed else 0
+
+def copy_back_outputs(Container: ContainerConfig, staged=None, debug: bool = False) -> int:
+    """
+    Function to copy the outputs of a run that used a staged copy of the
+    shared directory back to the shared directory, then remove the staged
+    copy. Returns 1 if copying the outputs failed.
+    """
+    from staging import StagingError, remove_stage, stage_out
+    if staged is None:
+        return 0
+    if debug:
+        if Container.stage_outputs:
+            print(f"and copy {', '.join(Container.stage_outputs)} back to {Container.shared_directories}")
+        return 0
+    try:
+        missing = stage_out(staged, Container.shared_directories, Container.stage_outputs)
+    except StagingError as e:
+        print(f"An error occurred copying outputs back: {e}", file=sys.stderr)
+        return 1
+    finally:
+        remove_stage(staged)
+    for output in missing:
+        print(f"{output} was not created by the container, so was not copied back")
+    return 0
+
+###############################################################################
+# Main program starts here
+###############################################################################
+def main(exec_run: bool = False) -> int:
+    """
+    Main program, returns the exit code. If exec_run is set the run
+    operation replaces the current process with the container rather
+    than running it as a child process (so main does not return).
+
+    If a metrics file is given (with --metrics or the environment) the
+    timings of each phase are appended to it once we are done. In that
+    case run does not replace the process so the container can be timed.
+    """
+    from metrics import Metrics, metrics_file
+    metrics = Metrics(metrics_file(sys.argv[1:]))
+    return_code = None
+    try:
+        return_code = _main(metrics, exec_run and not metrics.enabled)
+        return return_code
+    except SystemExit as e:
+        return_code = e.code
+        raise
+    except Exception as e:
+        return_code = 1
+        metrics.update(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        metrics.record(return_code)
+
+def _main(metrics: "Metrics", exec_run: bool = False) -> int:
+    from daemon_client import exec_command, try_daemon
+    # if a daemon is running let it do the work of loading the configs
+    return_code = try_daemon(sys.argv[1:], exec_run, metrics)
+    if return_code is not None:
+        return return_code
+
+    args = parse_cmd_arguments()
+    from log_config import setup_logging
+    # this is not done when the module is imported so that e.g. --help
+    # never creates a log file.
+    setup_logging(args.log_dir, args.log_format)
+    metrics.update(operation=args.operation, model=getattr(args, "model_name", None))
+    # operations on running instances that don't need the configs
+    if args.operation == "status":
+        from instances import instance_status, print_status
+        print_status(instance_status())
+        return 0
+    if args.operation == "reap":
+        return reap_instances(args.idle, args.jobs, args.debug)
+
+    if args.config_file:
+        container_config = Path(args.config_file)
+    else:
+        container_config = Path("Container_Configs/")
+    print("*********************************************************************")
+    print(f"***************** Loading Model Config Files ************************")
+    print("*********************************************************************")
+    if args.operation == "serve":
+        from daemon import serve
+        return serve(container_config, args.socket)
+
+    if args.no_cache:
+        cache = None
+    else:
+        from config_cache import ConfigCache
+        cache = ConfigCache(args.cache_file, rebuild=args.rebuild_cache)
+    if args.operation.lower() == 'list':
+        # just list all detected containers then exit
+        with metrics.span("load"):
+            Containers = load_container_config_file(container_config, cache)
+        list_containers(Containers, args.group, args.show_compression)
+        return 0
+
+    if args.operation == "stats":
+        from history import history_file, load_runs, print_stats
+        models = None
+        if args.model_name is not None:
+            models = [args.model_name]
+        elif args.group is not None:
+            with metrics.span("load"):
+                Containers = load_container_config_file(container_config, cache)
+            models = [key for key, value in Containers.items() if value.group == args.group]
+        print_stats(load_runs(history_file(args.history_file), models))
+        return 0
+
+    if args.operation == "prefetch":
+        if args.status:
+            from prefetch import prefetch_running, print_prefetch_status, read_status
+            print_prefetch_status(read_status(args.status_file), prefetch_running(args.status_file))
+            return 0
+        with metrics.span("load"):
+            if args.model_name is None:
+                Containers = load_container_config_file(container_config, cache)
+            else:
+                Containers = ContainerRegistry(find_config_files(container_config), cache)
+                if args.model_name not in Containers:
+                    raise ValueError(
+                        f"no model named {args.model_name} was found in a config file.\n \
+                                Model must be one of \n{list(Containers.keys())}"
+                    )
+                Containers = {args.model_name: Containers[args.model_name]}
+        Containers = {key: set_layer_cache(value, args.layer_cache) for key, value in Containers.items()}
+        with metrics.span("container"):
+            return prefetch_containers(
+                Containers, args.group, args.jobs, args.wait, args.status_file,
+                args.image_store, args.force, args.debug
+            )
+
+    if args.operation == "cache":
+        if args.layer_cache:
+            paths = [args.layer_cache]
+        else:
+            # every cache used by any of the configs
+            from layer_cache import layer_cache_dir
+            with metrics.span("load"):
+                Containers = load_container_config_file(container_config, cache)
+            paths = sorted({layer_cache_dir(value.layer_cache) for value in Containers.values()} - {None})
+        return cache_operation(paths, args.action, args.days, args.dry_run)
+
+    if args.operation in ["images", "prune"]:
+        with metrics.span("load"):
+            Containers = load_container_config_file(container_config, cache)
+        if args.operation == "prune":
+            return prune_images(Containers, args.quota, args.image_store, args.dry_run)
+        if args.group is not None:
+            Containers = {key: value for key, value in Containers.items() if value.group == args.group}
+        from image_store import image_quota, print_images
+        print_images(store_images(Containers, args.image_store), image_quota(args.quota))
+        return 0
+
+    if args.operation.lower() == 'validate':
+        with metrics.span("check"):
+            errors = validate_container_configs(
+                find_config_files(container_config),
+                cache,
+                args.deep,
+                args.jobs
+            )
+        for err in errors:
+            print(err)
+        if errors:
+            print(f"Found {len(errors)} error(s) in config files")
+            return 1
+        print(f"All config files look OK")
+        return 0
+
+    if args.operation.lower() in ["build", "load"] and args.model_name is None:
+        with metrics.span("load"):
+            Containers = load_container_config_file(container_config, cache)
+        if args.sandbox:
+            Containers = {key: replace(value, sandbox=True) for key, value in Containers.items()}
+        Containers = {
+            key: set_layer_cache(set_compression(value, args.compression), args.layer_cache)
+            for key, value in Containers.items()
+        }
+        with metrics.span("container"):
+            return_code = build_containers(Containers, args.group, args.jobs, args.force, args.debug, args.image_store)
+        if not args.debug:
+            enforce_quota(Containers, store=args.image_store)
+        return return_code
+
+    if args.operation.lower() in ["start", "stop"] and args.model_name is None:
+        with metrics.span("load"):
+            Containers = load_container_config_file(container_config, cache)
+        if getattr(args, "sandbox", False):
+            Containers = {key: replace(value, sandbox=True) for key, value in Containers.items()}
+        if args.operation == "start":
+            Containers = {
+                key: set_pinning(value, args.cpus, args.numa_node, args.threads) for key, value in Containers.items()
+            }
+        with metrics.span("container"):
+            return manage_instances(args.operation, Containers, args.group, args.jobs, args.debug, args.image_store)
+
+    # all other operations only need a single model so only load the
+    # config file that it is defined in.
+    with metrics.span("load"):
+        Containers = ContainerRegistry(find_config_files(container_config), cache)
+        model_name = args.model_name
+
+        if model_name not in Containers.keys():
+            raise ValueError(
+                f"no model named {model_name} was found in a config file.\n \
+                                Model must be one of \n{list(Containers.keys())}"
+            )
+        Container = Containers[model_name]
+    # only check the paths that this operation actually uses
+    with metrics.span("check"):
+        check_container_paths(
+            model_name,
+            Container,
+            Containers.index[model_name],
+            definition=args.operation in ["build", "load", "benchmark"],
+            shared=args.operation in ["run", "start", "benchmark"],
+        )
+    print(f"All config files look OK")
+
+    if args.operation == "benchmark":
+        with metrics.span("container"):
+            return benchmark_compressions(
+                model_name, Container, args.compressions, args.repeats, args.keep, args.debug
+            )
+
+    if getattr(args, "sandbox", False):
+        # as if sandbox was set in the config, the config itself is left alone
+        Container = replace(Container, sandbox=True)
+    elif args.operation == "finalize":
+        # finalize always makes the sif file from the sandbox
+        Container = replace(Container, sandbox=False)
+    Container = set_compression(Container, getattr(args, "compression", None))
+    Container = set_layer_cache(Container, args.layer_cache)
+    if args.operation in ["run", "start"]:
+        Container = set_pinning(Container, args.cpus, args.numa_node, args.threads)
+    split = getattr(args, "split", 1)
+    if split < 1:
+        raise ValueError(f"--split must be 1 or more, not {split}")
+    if split > 1 and args.batch is not None:
+        raise ValueError("--split can't be used with --batch, use --sessions to run a batch file in parallel")
+    # finalize builds from the sandbox so never needs the base
+    layering = args.operation in ["build", "load"] and Container.base != ""
+    base_container = Container
+    if layering:
+        Container = layered(model_name, Container)
+
+    pull_remote = False
+    if args.operation in ["run", "start"]:
+        from prefetch import auto_prefetch, prefetch_running
+        pull_remote = auto_prefetch(args.auto_prefetch)
+    if pull_remote and Container.group != "None" and not args.debug and not prefetch_running():
+        # let the rest of the group be pulled while we work. Only the containers
+        # in the store or in the same config file are looked at, so that the
+        # config files of every other container don't have to be parsed.
+        candidates = set(stored_models(Containers, args.image_store))
+        candidates.update(key for key in Containers.keys() if Containers.index[key] == Containers.index[model_name])
+        group = {
+            key: set_layer_cache(Containers[key], args.layer_cache) for key in Containers.keys()
+            if key in candidates and key != model_name and Containers[key].group == Container.group
+        }
+        with contextlib.redirect_stdout(io.StringIO()):
+            prefetch_containers(group, store=args.image_store)
+
+    if args.operation in ["run", "start"]:
+        # the image may have been removed to stay under the quota, or
+        # never built if it is pulled from a URI and auto prefetch is on.
+        return_code = rebuild_missing(
+            model_name, Container, Containers.index[model_name], args.image_store, args.debug, pull_remote
+        )
+        if return_code:
+            return return_code
+        if return_code is not None and not args.debug:
+            enforce_quota(Containers, store=args.image_store, keep=[image_path(Container)])
+        if not args.debug and Path(image_path(Container)).exists():
+            from image_store import record_use as record_image_use, store_file
+            record_image_use(store_file(args.image_store), image_path(Container), model_name)
+
+    building = args.operation in ["build", "load", "finalize"]
+    if building:
+        from build_manifest import is_up_to_date
+        manifest = container_manifest(Container)
+        # finalize always rebuilds as the sandbox may have been changed by hand
+        if args.operation != "finalize" and not args.force and is_up_to_date(image_path(Container), manifest):
+            print(f"{image_path(Container)} is up to date, skipping build (use --force to rebuild)")
+            return 0
+
+    # staging binds a copy of the shared directory so needs a new container
+    staging = args.operation == "run" and not args.no_stage and (args.stage or Container.stage_shared)
+    use_instance = False
+    if args.operation == "run" and not args.cold and not staging:
+        with metrics.span("instance"):
+            use_instance = prepare_instance(model_name, Container, args.warm, args.idle_timeout, args.debug)
+        metrics.update(instance=use_instance)
+
+    staged = None
+    if staging:
+        from staging import StagingError, remove_stage, stage_in, stage_path
+    if staging and args.debug:
+        staged = stage_path(Container.shared_directories, args.scratch_dir)
+        print(f"Debug enabled, would copy {Container.shared_directories} to a new {staged}_* directory")
+    elif staging:
+        try:
+            with metrics.span("stage_in"):
+                staged = stage_in(Container.shared_directories, args.scratch_dir)
+        except StagingError as e:
+            print(f"An error occurred staging the shared directory: {e}", file=sys.stderr)
+            return 1
+
+    if args.operation == "run" and args.batch is not None:
+        with metrics.span("container"):
+            return_code = run_batch_file(model_name, Container, args, use_instance, staged)
+        if staged is not None:
+            with metrics.span("stage_out"):
+                return copy_back_outputs(Container, staged, args.debug) or return_code
+        return return_code
+
+    if split > 1:
+        with metrics.span("container"):
+            return_code = run_split(model_name, Container, args, use_instance, staged)
+        if staged is not None:
+            with metrics.span("stage_out"):
+                return copy_back_outputs(Container, staged, args.debug) or return_code
+        return return_code
+
+    with metrics.span("format"):
+        apptainer_command = format_command(
+            args.operation,
+            model_name,
+            Container,
+            args.cmd,
+            use_instance,
+            staged
+        )
+    if args.debug:
+        print("Debug enabled")
+        print("current config will run the following command:")
+        print(command_string(apptainer_command))
+        if layering:
+            build_base(model_name, base_container, args.debug)
+        copy_back_outputs(Container, staged, args.debug)
+    elif building:
+        from builds import BuildJob, run_build
+        from image_store import record_use as record_image_use, store_file
+        from layer_cache import layer_cache_dir
+        with metrics.span("container"):
+            return_code = build_base(model_name, base_container) if layering else 0
+            if return_code:
+                return return_code
+            result = run_build(
+                BuildJob(
+                    model_name,
+                    image_path(Container),
+                    apptainer_command,
+                    manifest,
+                    layer_cache=layer_cache_dir(Container.layer_cache),
+                ),
+                force=True
+            )
+        if result.status == "failed":
+            print (f"An error occurred. Build exited with the exit code {result.returncode}:")
+            return result.returncode
+        elif result.status == "skipped":
+            print(f"{image_path(Container)} was built by another process, reusing it")
+        record_image_use(store_file(args.image_store), image_path(Container), model_name)
+        enforce_quota(Containers, store=args.image_store, keep=[image_path(Container)])
+        return result.returncode
+    elif args.operation == "run" and exec_run and args.no_history and staged is None:
+        # nothing needs to happen after the container exits so replace
+        # this process with it, that way signals (e.g. Ctrl-C or from
+        # slurm) go straight to the container and its exit code is ours.
+        logging.info(f"Running {command_string(apptainer_command)}")
+        return exec_command(apptainer_command)
+    else:
+        import subprocess
+        from history import history_file, record_run, run_with_rusage
+        from instances import record_start, remove_state, running_instances
+        try:
+            with metrics.span("container"):
+                if args.operation == "run" and not args.no_history:
+                    returncode, usage = run_with_rusage(apptainer_command)
+                else:
+                    returncode, usage = subprocess.run(apptainer_command).returncode, None
+        except OSError as e:
+            print(f"Could not run {apptainer_command[0]}: {e}", file=sys.stderr)
+            if staged is not None:
+                remove_stage(staged)
+            return 127
+        if usage is not None:
+            record_run(history_file(args.history_file), model_name, args.operation, returncode, usage)
+            metrics.update(usage=usage)
+        # copy back whatever outputs there are, even if the container failed
+        copy_failed = 0
+        if staged is not None:
+            with metrics.span("stage_out"):
+                copy_failed = copy_back_outputs(Container, staged)
+        if returncode != 0:
+            print (f"An error occurred. Container exited with the exit code {returncode}:")
+            return returncode
+        if copy_failed:
+            return copy_failed
+        if args.operation == "start":
+            pid = running_instances().get(model_name, {}).get("pid")
+            record_start(model_name, image_path(Container), pid=pid)
+        elif args.operation == "stop":
+            remove_state(model_name)
+        return returncode
+    #return code is used by pytest to check code ran successfully
+    return 0
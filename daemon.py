@@ -0,0 +1,305 @@
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from typing import Optional
+from config_cache import stat_signature
+from daemon_client import socket_path
+from history import HISTORY_ENV, history_file
+from image_store import STORE_ENV, record_use as record_image_use, store_file, was_evicted
+from instances import running_instances, record_start, record_use, remove_state
+from prefetch import AUTO_PREFETCH_ENV, auto_prefetch
+from processes import pid_alive
+from stat_cache import clear_stat_cache
+import run_container
+
+# how often to check the config files for changes
+WATCH_SECONDS = 2.0
+# how often to ask apptainer which instances are running, in case
+# they have been started or stopped without going through the daemon
+INSTANCE_REFRESH_SECONDS = 30.0
+# operations the daemon can answer, anything else is run by the client as normal
+DAEMON_OPERATIONS = ["run", "start", "stop", "list"]
+# environment variables that change the reply to a request, if the client's
+# differ from the daemon's it handles the request itself
+PLAN_ENV_VARS = [HISTORY_ENV, STORE_ENV, AUTO_PREFETCH_ENV]
+
+
+class ContainerDaemon:
+    """
+    Long running server that keeps the checked container configs and the
+    table of running instances in memory and answers requests from the
+    thin client in daemon_client over a unix socket. The configs are
+    reloaded whenever a config file changes.
+
+    For run, start and stop the daemon only works out the apptainer
+    command, which the client then runs itself so that its output,
+    signals and exit code behave exactly as without the daemon.
+
+    Requests are planned (and configs reloaded) one at a time in a worker
+    thread, so the checks of the filesystem never block the event loop
+    and only one of them redirects stdout at once.
+
+    The command is planned with the daemon's own environment and cpus, so
+    a client whose environment variables (see PLAN_ENV_VARS) differ, or
+    whose cpus differ when the container is pinned to a NUMA node (e.g. a
+    slurm job step with its own cpuset), is told to fall back.
+
+    Attributes:
+        container_config -- config file or directory of config files
+        path -- path of the unix socket to listen on
+    """
+
+    def __init__(self, container_config, path=None):
+        self.container_config = Path(container_config).resolve()
+        self.path = Path(path or socket_path())
+        self.cwd = os.getcwd()
+        self.env = {key: os.environ.get(key, "") for key in PLAN_ENV_VARS}
+        self.cpus = sorted(os.sched_getaffinity(0))
+        self.Containers = {}
+        self.signatures = None
+        self.instances = {}
+        self.requests = 0
+        self._server = None
+        self._stopping = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def config_signatures(self) -> dict:
+        return {
+            str(conf_file): stat_signature(conf_file)
+            for conf_file in run_container.find_config_files(self.container_config)
+        }
+
+    def reload_if_changed(self):
+        """
+        Reload all the configs if any config file has been added,
+        removed or changed since they were last loaded.
+        """
+        signatures = self.config_signatures()
+        if signatures == self.signatures:
+            return
+        logging.info(f"Loading configs from {self.container_config}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.Containers = run_container.load_container_config_file(self.container_config)
+        self.signatures = signatures
+
+    def instance_alive(self, model_name: str) -> bool:
+        """
+        Check that the instance of a model in the instance table is still
+        running, it may have been stopped by its idle watcher or another
+        client since the table was refreshed. Dead instances are removed.
+        """
+        info = self.instances.get(model_name)
+        if info is None:
+            return False
+        pid = info.get("pid")
+        alive = pid_alive(pid) if pid else model_name in running_instances()
+        if not alive:
+            logging.info(f"Instance of {model_name} is no longer running")
+            self.instances.pop(model_name, None)
+        return alive
+
+    def plan(self, argv: list, cwd: str, env: Optional[dict] = None, cpus: Optional[list] = None) -> dict:
+        """
+        Work out the reply to a request from the client, given its working
+        directory, environment variables and cpus. Returns a dict with any
+        output to show and the apptainer command to run, or fallback if the
+        client should handle the request itself.
+        """
+        fallback = {"fallback": True}
+        # relative paths in the configs (e.g. Images/) must mean the same thing
+        if cwd != self.cwd:
+            return fallback
+        # as must e.g. the history file
+        if env is not None and {key: env.get(key, "") for key in PLAN_ENV_VARS} != self.env:
+            return fallback
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                args = run_container.parse_cmd_arguments(argv)
+        except SystemExit:
+            return fallback
+        if args.operation not in DAEMON_OPERATIONS:
+            return fallback
+        if args.config_file and Path(args.config_file).resolve() != self.container_config:
+            return fallback
+        if args.operation in ["start", "stop"] and args.model_name is None:
+            return fallback
+        if args.operation == "run" and (args.batch is not None or args.warm or args.stage or args.split != 1):
+            return fallback
+
+        output = io.StringIO()
+        reply = {"operation": args.operation}
+        with contextlib.redirect_stdout(output):
+            try:
+                reply.update(self._plan(args, cpus))
+            except run_container.config_errors() as e:
+                reply["error"] = str(e)
+        reply["output"] = output.getvalue()
+        return reply
+
+    def _plan(self, args, cpus: Optional[list] = None) -> dict:
+        # same output as without the daemon
+        print("*********************************************************************")
+        print(f"***************** Loading Model Config Files ************************")
+        print("*********************************************************************")
+        print(f"All config files look OK")
+        if args.operation == "list":
+            run_container.list_containers(self.Containers, args.group, args.show_compression)
+            return {"returncode": 0}
+
+        model_name = args.model_name
+        if model_name not in self.Containers:
+            raise ValueError(
+                f"no model named {model_name} was found in a config file.\n \
+                            Model must be one of \n{list(self.Containers.keys())}"
+            )
+        Container = self.Containers[model_name]
+        if getattr(args, "sandbox", False):
+            Container = replace(Container, sandbox=True)
+        if args.operation in ["run", "start"]:
+            Container = run_container.set_pinning(Container, args.cpus, args.numa_node, args.threads)
+            if Container.numa_node and cpus is not None and cpus != self.cpus:
+                # the cpus of a NUMA node we can use depend on the client's affinity
+                return {"fallback": True}
+        if args.operation == "run" and Container.stage_shared and not args.no_stage:
+            # staging needs to happen on the client's node so leave it to the client
+            return {"fallback": True}
+        # files can change while we are running so don't trust old stat results
+        clear_stat_cache()
+        run_container.check_container_paths(
+            model_name,
+            Container,
+            definition=False,
+            shared=args.operation in ["run", "start"],
+        )
+        use_instance = args.operation == "run" and not args.cold and self.instance_alive(model_name)
+        image = run_container.image_path(Container)
+        if args.operation in ["run", "start"] and not use_instance and not Path(image).exists():
+            if was_evicted(store_file(args.image_store), image) or auto_prefetch(args.auto_prefetch):
+                # rebuilding (or pulling) can take a long time so leave it to the client
+                return {"fallback": True}
+        command = run_container.format_command(args.operation, model_name, Container, args.cmd, use_instance)
+        if args.debug:
+            print("Debug enabled")
+            print("current config will run the following command:")
+            print(run_container.command_string(command))
+            return {"returncode": 0}
+        if args.operation in ["run", "start"]:
+            record_image_use(store_file(args.image_store), image, model_name)
+        # the client only needs to report back if we have records to update
+        report = args.operation in ["start", "stop"] or use_instance
+        reply = {
+            "command": command,
+            "model_name": model_name,
+            "image": image,
+            "instance": use_instance,
+            "report": report,
+        }
+        if args.operation == "run" and not args.no_history:
+            # the client records the resources used as it runs the command
+            reply["history"] = history_file(args.history_file)
+        return reply
+
+    def finish(self, reply: dict, returncode: int):
+        """
+        Update the instance table once the client has run a command.
+        """
+        if returncode != 0:
+            return
+        model_name = reply["model_name"]
+        if reply["operation"] == "start":
+            image = reply["image"]
+            # ask apptainer for the pid, so we can tell when it stops
+            info = running_instances().get(model_name) or {"instance": model_name, "img": image}
+            self.instances[model_name] = info
+            record_start(model_name, image, pid=info.get("pid"))
+        elif reply["operation"] == "stop":
+            self.instances.pop(model_name, None)
+            remove_state(model_name)
+        elif reply["instance"]:
+            record_use(model_name)
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline() or "null")
+            if not request:
+                return
+            self.requests += 1
+            loop = asyncio.get_running_loop()
+            reply = await loop.run_in_executor(
+                self._executor, self.plan, request["argv"], request["cwd"], request.get("env"), request.get("cpus")
+            )
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+            if reply.get("report"):
+                done = json.loads(await reader.readline() or "null")
+                if done is not None:
+                    await loop.run_in_executor(self._executor, self.finish, reply, done["returncode"])
+                    writer.write(b"{}\n")
+                    await writer.drain()
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Error handling daemon request: {e}")
+        finally:
+            writer.close()
+
+    async def watch(self):
+        last_refresh = time.monotonic()
+        while True:
+            await asyncio.sleep(WATCH_SECONDS)
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self.reload_if_changed)
+            except Exception as e:
+                # keep using the last good configs until the error is fixed
+                logging.error(f"Not reloading configs: {e}")
+            if time.monotonic() - last_refresh > INSTANCE_REFRESH_SECONDS:
+                self.instances = await asyncio.to_thread(running_instances)
+                last_refresh = time.monotonic()
+
+    async def run(self):
+        """
+        Load the configs then serve requests until stop is called.
+        """
+        self.reload_if_changed()
+        self.instances = await asyncio.to_thread(running_instances)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        self._stopping = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_unix_server(self.handle, path=str(self.path))
+        os.chmod(self.path, 0o600)
+        logging.info(f"Serving container configs on {self.path}")
+        print(f"Serving container configs on {self.path}")
+        watcher = asyncio.create_task(self.watch())
+        try:
+            await self._stopping.wait()
+        finally:
+            watcher.cancel()
+            self._server.close()
+            await self._server.wait_closed()
+            self._executor.shutdown(wait=False)
+            self.path.unlink(missing_ok=True)
+
+    def stop(self):
+        """
+        Stop the daemon, this can be called from any thread.
+        """
+        if self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+
+def serve(container_config, path=None):
+    """
+    Function to run the daemon until it is interrupted.
+    """
+    daemon = ContainerDaemon(container_config, path)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -0,0 +1,133 @@
+# Thin client for the daemon started with "run_container.py serve". This only
+# uses the standard library so that it is cheap to import, the point being
+# to skip all the work of loading and checking the config files. It is
+# imported on every launch so everything needed to talk to the daemon is
+# only imported once we know there is one.
+import os
+import sys
+from metrics import Metrics
+from defaults import DEFAULT_SOCKET
+
+# the client's environment variables starting with this are sent to the daemon
+ENV_PREFIX = "BEDE_CONTAINERS_"
+
+
+def socket_path() -> str:
+    """
+    Function to get the path of the daemon's socket, this can be
+    set with the BEDE_CONTAINERS_SOCKET environment variable.
+    """
+    return os.environ.get("BEDE_CONTAINERS_SOCKET", DEFAULT_SOCKET)
+
+
+def exec_command(argv: list) -> int:
+    """
+    Function to replace the current process with argv, used when nothing
+    needs to happen after the container exits so that signals (e.g. Ctrl-C
+    or from slurm) go straight to it and its exit code becomes ours. Only
+    returns (with the exit code a shell would give) if argv can't be run.
+    """
+    from log_config import stop_logging
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stop_logging()
+    try:
+        os.execvp(argv[0], argv)
+    except OSError as e:
+        print(f"Could not run {argv[0]}: {e}", file=sys.stderr)
+        return 127
+
+
+def send(stream, message: dict):
+    import json
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def try_daemon(argv: list, exec_run: bool = False, metrics: Metrics = None):
+    """
+    Function to pass a request to the daemon if one is running. The
+    daemon replies with any output to print and the apptainer command
+    to run, which is then run here. Returns the exit code, or None if
+    there is no daemon or it can't handle the request (in which case
+    the caller should just carry on as normal). If exec_run is set and
+    the daemon does not need to hear how the command went, this process
+    is replaced by the command (as for run_container.main). The time
+    taken by the daemon and by the command are added to metrics.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if "--no_daemon" in argv:
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    import json
+    import socket
+    import subprocess
+    from history import run_with_rusage, record_run
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile("rw") as stream:
+        try:
+            with metrics.span("daemon"):
+                # the daemon plans the command for our environment and cpus, not its own
+                send(stream, {
+                    "argv": argv,
+                    "cwd": os.getcwd(),
+                    "env": {key: value for key, value in os.environ.items() if key.startswith(ENV_PREFIX)},
+                    "cpus": sorted(os.sched_getaffinity(0)),
+                })
+                reply = json.loads(stream.readline() or "null")
+        except (OSError, ValueError):
+            return None
+        if not reply or reply.get("fallback"):
+            return None
+        metrics.update(
+            operation=reply.get("operation"),
+            model=reply.get("model_name"),
+            daemon=True,
+        )
+
+        sys.stdout.write(reply.get("output", ""))
+        sys.stdout.flush()
+        if "error" in reply:
+            print(reply["error"], file=sys.stderr)
+            return 1
+        command = reply.get("command")
+        if command is None:
+            return reply.get("returncode", 0)
+
+        history = reply.get("history")
+        if exec_run and not reply.get("report") and history is None:
+            # nothing to do afterwards so hand over to the container, as run does
+            stream.close()
+            sock.close()
+            return exec_command(command)
+        try:
+            with metrics.span("container"):
+                if history is not None:
+                    returncode, usage = run_with_rusage(command)
+                else:
+                    returncode, usage = subprocess.run(command).returncode, None
+        except OSError as e:
+            print(f"Could not run {command[0]}: {e}", file=sys.stderr)
+            returncode, usage = 127, None
+        if usage is not None:
+            record_run(history, reply["model_name"], reply["operation"], returncode, usage)
+            metrics.update(usage=usage)
+        if reply.get("report"):
+            try:
+                # tell the daemon how it went and wait for it to update its records
+                send(stream, {"returncode": returncode})
+                stream.readline()
+            except OSError:
+                pass
+        if returncode != 0:
+            print (f"An error occurred. Container exited with the exit code {returncode}:")
+        return returncode
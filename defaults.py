@@ -0,0 +1,81 @@
+# Defaults and environment variable names that run_container needs to set
+# up its argument parser. They live here, rather than in the module for each
+# operation, so that the cli can build its parser (e.g. for --help) without
+# importing those modules, which are only imported when their operation
+# actually runs. The modules import what they need from here.
+# This must not import anything as it is imported on every launch.
+
+# builds
+# default number of builds to run at once, builds are heavy on
+# both cpu and network so keep this small.
+DEFAULT_BUILD_JOBS = 2
+
+# instances
+# default minutes a warm instance is kept running with nothing using it
+DEFAULT_IDLE_MINUTES = 10
+# default number of instances to start or stop at once
+DEFAULT_INSTANCE_JOBS = 8
+
+# batch
+# default file to write the results of a batch run to
+DEFAULT_RESULTS_FILE = "batch_results.jsonl"
+
+# daemon_client
+DEFAULT_SOCKET = ".cache/bede_containers.sock"
+
+# metrics
+# environment variable giving the metrics file, --metrics takes precedence
+METRICS_ENV = "BEDE_CONTAINERS_METRICS"
+
+# log_config
+DEFAULT_LOG_DIR = "logs"
+# environment variables to set the log directory and format,
+# --log_dir and --log_format take precedence
+LOG_DIR_ENV = "BEDE_CONTAINERS_LOG_DIR"
+LOG_FORMAT_ENV = "BEDE_CONTAINERS_LOG_FORMAT"
+LOG_FORMATS = ["text", "json"]
+
+# history
+DEFAULT_HISTORY_FILE = ".cache/history.sqlite"
+# environment variable to change the history file, --history_file takes precedence
+HISTORY_ENV = "BEDE_CONTAINERS_HISTORY"
+
+# staging
+# environment variable giving the scratch directory, --scratch_dir
+# takes precedence. Otherwise $TMPDIR (set per job by slurm) is used.
+SCRATCH_ENV = "BEDE_CONTAINERS_SCRATCH"
+
+# config_cache
+DEFAULT_CACHE_FILE = ".cache/config_cache.json"
+
+# compression
+# variants compared by the benchmark operation if none are given
+DEFAULT_BENCH_COMPRESSIONS = ["gzip", "lz4", "zstd:3", "none"]
+DEFAULT_BENCH_REPEATS = 5
+
+# image_store
+DEFAULT_STORE_FILE = ".cache/images.sqlite"
+# environment variable to change the store file, --image_store takes precedence
+STORE_ENV = "BEDE_CONTAINERS_IMAGE_STORE"
+# environment variable giving the quota e.g. 500G, --quota takes precedence.
+# If neither is set images are never removed automatically.
+QUOTA_ENV = "BEDE_CONTAINERS_IMAGE_QUOTA"
+
+# prefetch
+DEFAULT_STATUS_FILE = ".cache/prefetch.json"
+# pulls are heavy on the network and on the filesystem so keep this small
+DEFAULT_PREFETCH_JOBS = 2
+# environment variable that turns on automatic prefetching, see run_container
+AUTO_PREFETCH_ENV = "BEDE_CONTAINERS_AUTO_PREFETCH"
+
+# layer_cache
+# environment variable giving the site-wide cache directory, the
+# layer_cache field of a config and --layer_cache take precedence
+LAYER_CACHE_ENV = "BEDE_CONTAINERS_LAYER_CACHE"
+# layers not used for this many days are counted as reclaimable
+DEFAULT_CACHE_DAYS = 30
+
+# affinity
+# passed to each copy of a run --split so it can pick its share of the work
+SPLIT_INDEX_ENV = "BEDE_CONTAINERS_SPLIT_INDEX"
+SPLIT_COUNT_ENV = "BEDE_CONTAINERS_SPLIT_COUNT"
@@ -0,0 +1,183 @@
+# History of the resources (memory, cpu time etc.) used by each run of
+# a container, stored in a local SQLite database. This is used by the
+# stats operation to help size slurm requests for each container.
+# This only uses the standard library as it is imported by the daemon client.
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from typing import Optional
+from defaults import DEFAULT_HISTORY_FILE, HISTORY_ENV
+from local_db import connect, write
+
+# signals passed on to the container while we wait for it. SIGINT is
+# ignored rather than passed on as Ctrl-C already goes to the whole
+# process group, so the container gets it anyway.
+FORWARD_SIGNALS = (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+# percentiles shown by stats
+STATS_PERCENTILES = (50, 90, 99)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    host TEXT NOT NULL,
+    model TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    returncode INTEGER,
+    wall_seconds REAL,
+    user_seconds REAL,
+    sys_seconds REAL,
+    max_rss_kb INTEGER,
+    major_faults INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model);
+"""
+COLUMNS = ("wall_seconds", "user_seconds", "sys_seconds", "max_rss_kb", "major_faults")
+
+
+def history_file(path: Optional[str] = None) -> str:
+    """
+    Function to get the history file, from path if given otherwise
+    from the environment or the default.
+    """
+    return path or os.environ.get(HISTORY_ENV) or DEFAULT_HISTORY_FILE
+
+
+def run_with_rusage(argv: list):
+    """
+    Function to run a command and wait for it with os.wait4 so we get
+    its resource usage (and that of any children it waited for). While
+    waiting, signals from slurm (e.g. SIGTERM) are passed on to it.
+    Returns the exit code (negative if killed by a signal, as subprocess
+    does) and a dict of the resources used, or None if they are unknown.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(argv)
+
+    def forward(signum, frame):
+        try:
+            proc.send_signal(signum)
+        except OSError:
+            pass
+
+    previous = {}
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is threading.main_thread():
+        previous[signal.SIGINT] = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in FORWARD_SIGNALS:
+            previous[signum] = signal.signal(signum, forward)
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # someone else reaped it, so there is no usage to report
+        return proc.wait(), None
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    # stop Popen from trying to wait for it again
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "wall_seconds": time.perf_counter() - start,
+        "user_seconds": rusage.ru_utime,
+        "sys_seconds": rusage.ru_stime,
+        # ru_maxrss is in kB on linux
+        "max_rss_kb": rusage.ru_maxrss,
+        "major_faults": rusage.ru_majflt,
+    }
+    return proc.returncode, usage
+
+
+def record_run(path: str, model: str, operation: str, returncode: int, usage: dict):
+    """
+    Function to add the resources used by a run to the history.
+    """
+    write(
+        path, SCHEMA,
+        f"INSERT INTO runs (time, host, model, operation, returncode, {', '.join(COLUMNS)}) "
+        f"VALUES (?, ?, ?, ?, ?{', ?' * len(COLUMNS)})",
+        (time.time(), socket.gethostname(), model, operation, returncode,
+         *(usage[column] for column in COLUMNS)),
+        "history",
+    )
+
+
+def load_runs(path: str, models: Optional[list] = None) -> dict:
+    """
+    Function to read the history, returns a dict of model name to list
+    of runs (as dicts) oldest first. If models is given only the runs of
+    those models are returned.
+    """
+    if not os.path.exists(path):
+        return {}
+    db = connect(path, SCHEMA)
+    query = f"SELECT model, time, host, operation, returncode, {', '.join(COLUMNS)} FROM runs"
+    params = ()
+    if models is not None:
+        query += f" WHERE model IN ({', '.join('?' * len(models))})"
+        params = tuple(models)
+    runs = {}
+    for row in db.execute(query + " ORDER BY time", params):
+        model, *values = row
+        keys = ("time", "host", "operation", "returncode") + COLUMNS
+        runs.setdefault(model, []).append(dict(zip(keys, values)))
+    db.close()
+    return runs
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Function to get the p-th percentile of values, interpolating
+    between the closest ranks (as numpy does by default).
+    """
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    rank = (len(values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def run_stats(runs: list) -> dict:
+    """
+    Function to summarise a list of runs from load_runs, returns a dict
+    of quantity to dict of percentile (and "max") to value.
+    """
+    quantities = {
+        "Wall time (s)": [run["wall_seconds"] for run in runs],
+        "CPU time (s)": [run["user_seconds"] + run["sys_seconds"] for run in runs],
+        # i.e. roughly how many cpus it kept busy
+        "CPU usage (cores)": [
+            (run["user_seconds"] + run["sys_seconds"]) / run["wall_seconds"]
+            for run in runs if run["wall_seconds"]
+        ],
+        "Peak memory (MB)": [run["max_rss_kb"] / 1024 for run in runs],
+        "Major faults": [run["major_faults"] for run in runs],
+    }
+    stats = {}
+    for name, values in quantities.items():
+        if values:
+            stats[name] = {f"p{p}": percentile(values, p) for p in STATS_PERCENTILES}
+            stats[name]["max"] = max(values)
+    return stats
+
+
+def print_stats(runs: dict):
+    """
+    Function to print the stats for each model in the dict from load_runs.
+    """
+    if not runs:
+        print("No runs recorded")
+        return
+    headings = [f"p{p}:" for p in STATS_PERCENTILES] + ["max:"]
+    for model, model_runs in runs.items():
+        n_failed = sum(run["returncode"] != 0 for run in model_runs)
+        print("*******************************")
+        print(f"{model}: {len(model_runs)} runs, {n_failed} failed")
+        print("*******************************")
+        print(f"{'':<20}" + "".join(f"{heading:>10}" for heading in headings))
+        for name, values in run_stats(model_runs).items():
+            print(f"{name:<20}" + "".join(f"{value:>10.2f}" for value in values.values()))
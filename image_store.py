@@ -0,0 +1,284 @@
+# Management of the images in Images/ (or wherever the configs put them).
+# Every image is several GB so the directory is kept under a size quota by
+# removing the least recently used images, which are rebuilt from their
+# definition the next time they are run. When each image was last used is
+# stored in a local SQLite database, along with which images were removed.
+# This only uses the standard library as it is imported by the daemon.
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+from build_lock import BuildLock, BuildLockTimeout
+from build_manifest import manifest_path
+from defaults import DEFAULT_STORE_FILE, QUOTA_ENV, STORE_ENV
+from local_db import connect, write
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    last_used REAL,
+    evicted REAL
+);
+"""
+
+
+@dataclass
+class StoredImage:
+    """
+    An image in the store, size is None if the image is not on disk
+    and last_used is None if it has never been used.
+    """
+    model_name: str
+    image_file: str
+    size: Optional[int] = field(default=None)
+    last_used: Optional[float] = field(default=None)
+    evicted: Optional[float] = field(default=None)
+    pinned: bool = field(default=False)
+    in_use: bool = field(default=False)
+
+
+def store_file(path: Optional[str] = None) -> str:
+    """
+    Function to get the store file, from path if given otherwise
+    from the environment or the default.
+    """
+    return path or os.environ.get(STORE_ENV) or DEFAULT_STORE_FILE
+
+
+def parse_size(text: str) -> int:
+    """
+    Function to turn a size such as 500G, 1.5T or 1024 (bytes) into
+    a number of bytes. Raises ValueError if it is not valid.
+    """
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    number, unit = text, ""
+    if text and text[-1] in SIZE_UNITS:
+        number, unit = text[:-1], text[-1]
+    try:
+        size = float(number)
+    except ValueError:
+        raise ValueError(f"size {text} is not valid, give a number with an optional K, M, G or T")
+    if size < 0:
+        raise ValueError(f"size {text} must not be negative")
+    return int(size * SIZE_UNITS[unit])
+
+
+def image_quota(quota: Optional[str] = None) -> Optional[int]:
+    """
+    Function to get the quota in bytes, from quota if given otherwise
+    from the environment, or None if there is no quota.
+    """
+    quota = quota or os.environ.get(QUOTA_ENV)
+    if not quota:
+        return None
+    return parse_size(quota)
+
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "-"
+    for unit in ["T", "G", "M", "K"]:
+        if size >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:.1f}{unit}"
+    return f"{size}B"
+
+
+def image_size(image_file) -> Optional[int]:
+    """
+    Function to get the size of an image on disk, including everything
+    in it for sandboxes, or None if it doesn't exist.
+    """
+    P = Path(image_file)
+    try:
+        if not P.is_dir():
+            return P.stat().st_size
+    except FileNotFoundError:
+        return None
+    size = 0
+    for root, _, files in os.walk(P):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _key(image_file) -> str:
+    # the same image can be reached by different relative paths
+    return os.path.abspath(image_file)
+
+
+def record_use(path: str, image_file, model_name: str):
+    """
+    Function to record that an image has just been used (or built).
+    """
+    write(
+        path, SCHEMA,
+        "INSERT INTO images (image, model, last_used, evicted) VALUES (?, ?, ?, NULL) "
+        "ON CONFLICT (image) DO UPDATE SET model = excluded.model, "
+        "last_used = excluded.last_used, evicted = NULL",
+        (_key(image_file), model_name, time.time()),
+        f"use of {image_file}",
+    )
+
+
+def record_eviction(path: str, image_file, model_name: str):
+    write(
+        path, SCHEMA,
+        "INSERT INTO images (image, model, last_used, evicted) VALUES (?, ?, NULL, ?) "
+        "ON CONFLICT (image) DO UPDATE SET evicted = excluded.evicted",
+        (_key(image_file), model_name, time.time()),
+        f"eviction of {image_file}",
+    )
+
+
+def load_records(path: str) -> dict:
+    """
+    Function to read the store, returns a dict of (absolute) image path
+    to dict of model, last_used and evicted.
+    """
+    if not os.path.exists(path):
+        return {}
+    db = connect(path, SCHEMA)
+    records = {
+        image: {"model": model, "last_used": last_used, "evicted": evicted}
+        for image, model, last_used, evicted in db.execute(
+            "SELECT image, model, last_used, evicted FROM images"
+        )
+    }
+    db.close()
+    return records
+
+
+def was_evicted(path: str, image_file) -> bool:
+    """
+    Function to check if an image is missing because it was evicted
+    (rather than never having been built).
+    """
+    if Path(image_file).exists():
+        return False
+    record = load_records(path).get(_key(image_file))
+    return record is not None and record["evicted"] is not None
+
+
+def collect_images(path: str, images: dict, pinned=(), in_use=()) -> list:
+    """
+    Function to get a StoredImage for every image, images is a dict of
+    model name to image file. Several models can share one image, in
+    which case it is pinned if any of them are. Images that have never
+    been used are treated as last used when they were built.
+    """
+    records = load_records(path)
+    in_use = {_key(image) for image in in_use}
+    found = {}
+    for model_name, image_file in images.items():
+        key = _key(image_file)
+        if key in found:
+            found[key].pinned = found[key].pinned or model_name in pinned
+            continue
+        record = records.get(key, {})
+        size = image_size(image_file)
+        last_used = record.get("last_used")
+        if last_used is None and size is not None:
+            last_used = Path(image_file).stat().st_mtime
+        found[key] = StoredImage(
+            model_name,
+            image_file,
+            size,
+            last_used,
+            record.get("evicted") if size is None else None,
+            model_name in pinned,
+            key in in_use,
+        )
+    return list(found.values())
+
+
+def plan_eviction(images: list, quota: int) -> list:
+    """
+    Function to pick the images to remove to get the total size of the
+    images under quota, least recently used first. Pinned images and
+    images in use by a running instance are never picked, so the total
+    may still be over the quota afterwards.
+    """
+    total = sum(image.size for image in images if image.size is not None)
+    candidates = sorted(
+        (image for image in images if image.size is not None and not image.pinned and not image.in_use),
+        key=lambda image: image.last_used or 0.0,
+    )
+    evict = []
+    for image in candidates:
+        if total <= quota:
+            break
+        evict.append(image)
+        total -= image.size
+    return evict
+
+
+def remove_image(image_file):
+    """
+    Function to delete an image and its build manifest. Runs that
+    already have the image open carry on as the file is only unlinked.
+    """
+    P = Path(image_file)
+    if P.is_dir():
+        shutil.rmtree(P)
+    else:
+        P.unlink(missing_ok=True)
+    manifest_path(image_file).unlink(missing_ok=True)
+
+
+def evict_images(path: str, images: list) -> list:
+    """
+    Function to remove images from the store. Images that are being built
+    are skipped. Returns the list of images that were actually removed.
+    """
+    removed = []
+    for image in images:
+        try:
+            with BuildLock(image.image_file, timeout=0):
+                remove_image(image.image_file)
+        except BuildLockTimeout:
+            logging.info(f"Not removing {image.image_file} as it is being built")
+            continue
+        except OSError as e:
+            logging.warning(f"Could not remove {image.image_file}: {e}")
+            continue
+        logging.info(f"Removed {image.image_file} ({format_size(image.size)}) to stay under the quota")
+        record_eviction(path, image.image_file, image.model_name)
+        removed.append(image)
+    return removed
+
+
+def print_images(images: list, quota: Optional[int] = None):
+    """
+    Function to print a table of the images in the store, most
+    recently used first.
+    """
+    print("*******************************")
+    print("Images:")
+    print("*******************************")
+    print(f"{'Name:':<30} {'Size:':>8}  {'Last used:':<17}  Status:")
+    print("-----------------------------")
+    for image in sorted(images, key=lambda image: -(image.last_used or 0.0)):
+        last_used = "-"
+        if image.last_used is not None:
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(image.last_used))
+        if image.size is None:
+            status = "evicted" if image.evicted is not None else "not built"
+        else:
+            status = ", ".join(
+                [name for name, flag in [("pinned", image.pinned), ("in use", image.in_use)] if flag]
+            ) or "present"
+        print(f"{image.model_name:<30} {format_size(image.size):>8}  {last_used:<17}  {status}")
+    total = sum(image.size for image in images if image.size is not None)
+    line = f"Total: {format_size(total)}"
+    if quota is not None:
+        line += f" of {format_size(quota)} quota"
+    print(line)
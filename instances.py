@@ -0,0 +1,296 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+from defaults import DEFAULT_INSTANCE_JOBS
+
+# directory used to record the instances we have started
+INSTANCE_STATE_DIR = ".cache/instances"
+
+
+def running_instances(runtime: str = "apptainer") -> dict:
+    """
+    Function to ask apptainer which instances are running, returns a
+    dict with instance names as keys and the info apptainer gives
+    about each of them (pid, image etc.) as values.
+    """
+    try:
+        proc = subprocess.run(
+            [runtime, "instance", "list", "--json"], capture_output=True, text=True
+        )
+    except OSError:
+        return {}
+    if proc.returncode != 0:
+        return {}
+    try:
+        found = json.loads(proc.stdout).get("instances") or []
+    except ValueError:
+        return {}
+    return {info["instance"]: info for info in found}
+
+
+def instance_running(model_name: str, runtime: str = "apptainer") -> bool:
+    """
+    Function to check if an instance of a model is running.
+    """
+    return model_name in running_instances(runtime)
+
+
+def state_file(model_name: str, state_dir=None) -> Path:
+    """
+    Function to get the file recording the state of an instance.
+    """
+    return Path(state_dir or INSTANCE_STATE_DIR) / f"{model_name}.json"
+
+
+def read_state(model_name: str, state_dir=None):
+    try:
+        return json.loads(state_file(model_name, state_dir).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_state(model_name: str, state: dict, state_dir=None):
+    P = state_file(model_name, state_dir)
+    P.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = P.with_name(f"{P.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(state))
+    os.replace(tmp_file, P)
+
+
+def remove_state(model_name: str, state_dir=None):
+    state_file(model_name, state_dir).unlink(missing_ok=True)
+
+
+def record_start(
+    model_name: str,
+    image_file: str,
+    idle_minutes=None,
+    state_dir=None,
+    pid: Optional[int] = None
+):
+    """
+    Function to record that we have started an instance.
+    """
+    now = time.time()
+    write_state(model_name, {
+        "name": model_name,
+        "image": image_file,
+        "pid": pid,
+        "started": now,
+        "last_used": now,
+        "idle_minutes": idle_minutes,
+    }, state_dir)
+
+
+def record_use(model_name: str, state_dir=None):
+    """
+    Function to update the last time an instance was used. Instances
+    started outside this tool are recorded the first time they are used.
+    """
+    state = read_state(model_name, state_dir) or {"name": model_name, "started": None}
+    state["last_used"] = time.time()
+    write_state(model_name, state, state_dir)
+
+
+def all_states(state_dir=None) -> dict:
+    """
+    Function to read the state of every instance we have a record of.
+    """
+    states = {}
+    for P in sorted(Path(state_dir or INSTANCE_STATE_DIR).glob("*.json")):
+        state = read_state(P.stem, state_dir)
+        if state is not None:
+            states[P.stem] = state
+    return states
+
+
+def run_commands(commands: dict, jobs: int = DEFAULT_INSTANCE_JOBS) -> dict:
+    """
+    Function to run several apptainer commands at once (e.g. to start or
+    stop many instances). commands is a dict of model name to command
+    (as an argv list), returns a dict of model name to the CompletedProcess for its command.
+    """
+    def run(command):
+        try:
+            return subprocess.run(command, capture_output=True, text=True)
+        except OSError as e:
+            # same exit code a shell would give for a missing command
+            return subprocess.CompletedProcess(command, 127, "", str(e))
+
+    if not commands:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(commands)))) as pool:
+        futures = {name: pool.submit(run, command) for name, command in commands.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def stop_instances(model_names: list, jobs: int = DEFAULT_INSTANCE_JOBS, state_dir=None) -> dict:
+    """
+    Function to stop several instances at once. Returns a dict
+    of model name to the exit code of apptainer instance stop.
+    """
+    results = run_commands(
+        {name: ["apptainer", "instance", "stop", name] for name in model_names}, jobs
+    )
+    for name, proc in results.items():
+        if proc.returncode == 0:
+            remove_state(name, state_dir)
+    return {name: proc.returncode for name, proc in results.items()}
+
+
+def _proc_children() -> dict:
+    # map of pid to list of child pids, from /proc
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # the process name is in brackets and can contain spaces
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    return children
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree_rss_kb(pid: Optional[int], children: Optional[dict] = None) -> Optional[int]:
+    """
+    Function to get the total resident memory (in kB) of a process and
+    all its descendants, or None if the process can't be found (or
+    /proc is not available).
+    """
+    if pid is None or not Path(f"/proc/{pid}").exists():
+        return None
+    if children is None:
+        children = _proc_children()
+    total = 0
+    to_visit = [pid]
+    while to_visit:
+        current = to_visit.pop()
+        total += _rss_kb(current)
+        to_visit.extend(children.get(current, []))
+    return total
+
+
+def instance_status(state_dir=None, runtime: str = "apptainer") -> list:
+    """
+    Function to get the status of every running instance, combining what
+    apptainer knows with our own records. Records of instances that are
+    no longer running are removed. Returns a list of dicts, one per instance.
+    """
+    running = running_instances(runtime)
+    states = all_states(state_dir)
+    for name in states:
+        if name not in running:
+            remove_state(name, state_dir)
+
+    children = _proc_children() if Path("/proc").is_dir() else {}
+    now = time.time()
+    rows = []
+    for name, info in sorted(running.items()):
+        state = states.get(name, {})
+        pid = info.get("pid") or state.get("pid")
+        last_used = state.get("last_used") or state.get("started")
+        rows.append({
+            "name": name,
+            "image": info.get("img") or state.get("image", ""),
+            "pid": pid,
+            "started": state.get("started"),
+            "last_used": last_used,
+            "idle_minutes": (now - last_used) / 60 if last_used else None,
+            "rss_kb": process_tree_rss_kb(pid, children),
+        })
+    return rows
+
+
+def print_status(rows: list):
+    """
+    Function to print a table of running instances as given by instance_status.
+    """
+    from datetime import datetime
+
+    def fmt_time(t):
+        return datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M") if t else "-"
+
+    print("*******************************")
+    print("Currently running instances:")
+    print("*******************************")
+    print(f"{'Name:':<30} {'PID:':>8} {'Started:':<17} {'Last used:':<17} {'Idle (min):':>11} {'Memory (MB):':>12}")
+    print("-----------------------------")
+    for row in rows:
+        idle = f"{row['idle_minutes']:.1f}" if row["idle_minutes"] is not None else "-"
+        rss = f"{row['rss_kb'] / 1024:.1f}" if row["rss_kb"] is not None else "-"
+        print(f"{row['name']:<30} {str(row['pid'] or '-'):>8} {fmt_time(row['started']):<17} "
+              f"{fmt_time(row['last_used']):<17} {idle:>11} {rss:>12}")
+
+
+def idle_instances(idle_minutes: float, state_dir=None, runtime: str = "apptainer") -> list:
+    """
+    Function to find running instances that have not been used for at
+    least idle_minutes. Instances we have no record of (i.e. that were
+    not started by this tool and never used with run) are never idle.
+    """
+    return [
+        row["name"] for row in instance_status(state_dir, runtime)
+        if row["idle_minutes"] is not None and row["idle_minutes"] >= idle_minutes
+    ]
+
+
+def spawn_idle_watcher(model_name: str, idle_minutes: float, state_dir=None):
+    """
+    Function to start a detached background process that stops the
+    instance once it has not been used for idle_minutes.
+    """
+    state_dir = str(Path(state_dir or INSTANCE_STATE_DIR).resolve())
+    subprocess.Popen(
+        [sys.executable, __file__, "watch", model_name, str(idle_minutes * 60), state_dir],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def watch_idle(model_name: str, idle_seconds: float, state_dir=None, runtime: str = "apptainer"):
+    """
+    Wait until an instance has not been used for idle_seconds then stop it.
+    Returns early if the instance is stopped by something else.
+    """
+    while True:
+        state = read_state(model_name, state_dir)
+        if state is None:
+            return
+        idle = time.time() - state["last_used"]
+        if idle >= idle_seconds:
+            break
+        time.sleep(idle_seconds - idle)
+
+    if instance_running(model_name, runtime):
+        logging.info(f"Stopping idle instance {model_name}")
+        subprocess.run([runtime, "instance", "stop", model_name], capture_output=True)
+    remove_state(model_name, state_dir)
+
+
+if __name__ == "__main__":
+    # background idle watcher, see spawn_idle_watcher
+    if len(sys.argv) == 5 and sys.argv[1] == "watch":
+        watch_idle(sys.argv[2], float(sys.argv[3]), sys.argv[4])
+    else:
+        sys.exit(f"usage: {sys.argv[0]} watch model_name idle_seconds state_dir")
@@ -0,0 +1,244 @@
+# Shared cache of the layers apptainer downloads when building from docker://
+# (and library:// or oras://) images. By default every user has a private
+# cache in ~/.apptainer/cache, so the same base layers are downloaded and
+# stored once per user. Pointing APPTAINER_CACHEDIR at a group-writable
+# directory lets every user (and every model) share them.
+#
+# Builds hold a shared lock on the cache and prune an exclusive one, so
+# prune never removes layers from under a running build. Prune only ever
+# removes layers (blobs), the rest of the cache (the OCI layout metadata,
+# the sif files converted from images in oci-tmp etc.) is left to
+# apptainer cache clean. Each build that
+# uses the cache appends a line to a log in the cache recording how many
+# new layers it had to download, which is used to work out the hit rate.
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Optional
+from defaults import DEFAULT_CACHE_DAYS, LAYER_CACHE_ENV
+from image_store import format_size
+
+LOCK_FILE = ".bede_cache.lock"
+BUILD_LOG = ".bede_cache_builds.jsonl"
+# where apptainer keeps the downloaded layers (and image configs), an OCI
+# layout in the blob directory of its cache
+BLOB_DIR = "cache/blob/blobs/sha256"
+# setgid so that everything created in the cache belongs to its group
+CACHE_DIR_MODE = 0o2775
+# used for builds so the files apptainer creates are group-writable
+CACHE_UMASK = 0o002
+
+
+def layer_cache_dir(path: Optional[str] = None) -> Optional[str]:
+    """
+    Function to get the layer cache to use, path if given otherwise the
+    site-wide one from the environment, or None to leave apptainer to use
+    its default (private) cache.
+    """
+    return path or os.environ.get(LAYER_CACHE_ENV) or None
+
+
+def prepare_cache(path: str):
+    """
+    Function to create the cache directory (if needed) so that it and
+    everything created in it can be written by the group.
+    """
+    P = Path(path)
+    P.mkdir(parents=True, exist_ok=True)
+    try:
+        if P.stat().st_uid == os.getuid() and P.stat().st_mode & 0o7777 != CACHE_DIR_MODE:
+            P.chmod(CACHE_DIR_MODE)
+    except OSError as e:
+        logging.warning(f"Could not make layer cache {path} group-writable: {e}")
+
+
+class CacheLock:
+    """
+    Lock on a layer cache, held shared by builds and exclusive by prune.
+    This uses flock, so on a parallel filesystem it needs to be mounted
+    with flock support for the lock to work across nodes.
+
+    Attributes:
+        path -- the cache directory
+        shared -- take a shared (rather than exclusive) lock
+    """
+
+    def __init__(self, path: str, shared: bool = True):
+        self.path = Path(path) / LOCK_FILE
+        self.shared = shared
+        self._file = None
+
+    def acquire(self):
+        prepare_cache(self.path.parent)
+        self._file = open(self.path, "a")
+        try:
+            os.chmod(self.path, 0o664)
+        except OSError:
+            pass
+        fcntl.flock(self._file, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def snapshot_blobs(path: str) -> dict:
+    """
+    Function to get the layers in the cache, as a dict of digest to size.
+    """
+    blobs = {}
+    try:
+        with os.scandir(Path(path) / BLOB_DIR) as entries:
+            for entry in entries:
+                try:
+                    blobs[entry.name] = entry.stat().st_size
+                except OSError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return blobs
+
+
+def record_build(path: str, model_name: str, before: dict, after: dict, returncode: int):
+    """
+    Function to log how many new layers a build had to download. A build
+    that did not add any layers is counted as a hit. Failing to record it
+    is logged but never fails the build.
+    """
+    new = [digest for digest in after if digest not in before]
+    record = {
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "user": os.environ.get("USER", str(os.getuid())),
+        "model": model_name,
+        "returncode": returncode,
+        "new_layers": len(new),
+        "new_bytes": sum(after[digest] for digest in new),
+        "cached_layers": len(before),
+    }
+    try:
+        with open(Path(path) / BUILD_LOG, "a") as file:
+            file.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logging.warning(f"Could not record build in layer cache {path}: {e}")
+
+
+def load_builds(path: str) -> list:
+    try:
+        lines = (Path(path) / BUILD_LOG).read_text().splitlines()
+    except OSError:
+        return []
+    builds = []
+    for line in lines:
+        try:
+            builds.append(json.loads(line))
+        except ValueError:
+            # a line that is still being written
+            pass
+    return builds
+
+
+def _last_used(st) -> float:
+    # many parallel filesystems are mounted noatime, in which case
+    # this is when the file was downloaded
+    return max(st.st_atime, st.st_mtime)
+
+
+def cache_files(path: str):
+    """
+    Generator of (path, stat result, layer) for every file in the cache
+    apart from our own lock and log files, layer is True for the layers
+    (blobs) that prune may remove.
+    """
+    root = Path(path)
+    for dirpath, _, files in os.walk(root):
+        relative = Path(dirpath).relative_to(root)
+        layer = relative == Path(BLOB_DIR)
+        for name in files:
+            if relative == Path(".") and name in [LOCK_FILE, BUILD_LOG]:
+                continue
+            P = Path(dirpath) / name
+            try:
+                yield P, P.lstat(), layer
+            except OSError:
+                pass
+
+
+def cache_stats(path: str, days: float = DEFAULT_CACHE_DAYS) -> dict:
+    """
+    Function to summarise a layer cache: its size, number of files (i.e.
+    inodes), hit rate of the builds that used it and how much space would
+    be freed by pruning layers that have not been used for days.
+    """
+    cutoff = time.time() - days * 86400
+    stats = {"path": str(path), "bytes": 0, "files": 0, "reclaimable_bytes": 0, "reclaimable_files": 0}
+    for _, st, layer in cache_files(path):
+        stats["bytes"] += st.st_size
+        stats["files"] += 1
+        if layer and _last_used(st) < cutoff:
+            stats["reclaimable_bytes"] += st.st_size
+            stats["reclaimable_files"] += 1
+    stats["layers"] = len(snapshot_blobs(path))
+    builds = [build for build in load_builds(path) if build["returncode"] == 0]
+    stats["builds"] = len(builds)
+    stats["hits"] = sum(build["new_layers"] == 0 for build in builds)
+    stats["hit_rate"] = stats["hits"] / len(builds) if builds else None
+    stats["downloaded_bytes"] = sum(build["new_bytes"] for build in builds)
+    stats["users"] = len({build["user"] for build in builds})
+    return stats
+
+
+def prune_cache(path: str, days: float = DEFAULT_CACHE_DAYS, dry_run: bool = False) -> tuple:
+    """
+    Function to remove the layers in the cache that have not been used
+    for days, while no builds are using the cache. Nothing else in the
+    cache is touched, so apptainer can still use it afterwards (and
+    download any removed layers again). Returns the number of layers and
+    bytes that were (or would be) removed.
+    """
+    cutoff = time.time() - days * 86400
+    n_files = n_bytes = 0
+    with CacheLock(path, shared=False):
+        for P, st, layer in list(cache_files(path)):
+            if not layer or _last_used(st) >= cutoff:
+                continue
+            if not dry_run:
+                try:
+                    P.unlink()
+                except OSError as e:
+                    logging.warning(f"Could not remove {P}: {e}")
+                    continue
+            n_files += 1
+            n_bytes += st.st_size
+    return n_files, n_bytes
+
+
+def print_cache_stats(stats: dict, days: float = DEFAULT_CACHE_DAYS):
+    """
+    Function to print the summary of a layer cache from cache_stats.
+    """
+    print("*******************************")
+    print(f"Layer cache {stats['path']}:")
+    print("*******************************")
+    print(f"{'Size:':<25} {format_size(stats['bytes'])} in {stats['files']} files ({stats['layers']} layers)")
+    if stats["hit_rate"] is None:
+        print(f"{'Hit rate:':<25} - (no builds recorded)")
+    else:
+        print(f"{'Hit rate:':<25} {100 * stats['hit_rate']:.0f}% of {stats['builds']} builds "
+              f"by {stats['users']} user(s) needed no downloads")
+    print(f"{'Downloaded:':<25} {format_size(stats['downloaded_bytes'])}")
+    print(f"{'Reclaimable:':<25} {format_size(stats['reclaimable_bytes'])} in "
+          f"{stats['reclaimable_files']} layers not used for {days:g} days")
@@ -0,0 +1,37 @@
+# Access to the local SQLite databases, that is the history of runs (see
+# history) and the image store (see image_store). Records are written on
+# the way to or from running a container, and losing one matters less than
+# the run itself, so a database that can't be written (e.g. on a full or
+# read-only filesystem) is only logged, see write.
+# sqlite3 is only imported once a database is actually used.
+import logging
+import os
+
+
+def connect(path: str, schema: str):
+    """
+    Function to open the database at path, first creating its directory
+    and the tables in schema if they do not exist yet.
+    """
+    import sqlite3
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # other invocations may be writing so wait for them rather than failing
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(schema)
+    return db
+
+
+def write(path: str, schema: str, statement: str, params: tuple, what: str):
+    """
+    Function to run a statement that changes the database at path in a
+    transaction of its own. If that fails a warning is logged, saying
+    what could not be recorded, rather than an exception being raised.
+    """
+    import sqlite3
+    try:
+        db = connect(path, schema)
+        with db:
+            db.execute(statement, params)
+        db.close()
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"Could not record {what} in {path}: {e}")
@@ -0,0 +1,173 @@
+# Logging setup for run_container. Many copies of the cli can run at the
+# same time (e.g. one per job step) so each process logs to its own file,
+# and records are written by a background thread so that logging never
+# blocks on the (often shared and slow) filesystem.
+# This only uses the standard library as it is imported on every launch.
+import atexit
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+from defaults import DEFAULT_LOG_DIR, LOG_DIR_ENV, LOG_FORMAT_ENV
+from processes import STALE_SECONDS, pid_alive
+
+# number of log files from past invocations to keep in the log directory
+DEFAULT_KEEP_LOGS = 100
+LOG_PREFIX = "run_container_"
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# listener for the current process, see setup_logging
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter that writes each record as a single json line.
+    """
+
+    def format(self, record) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "host": socket.gethostname(),
+            "pid": record.process,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LogFileHandler(logging.FileHandler):
+    """
+    FileHandler that creates the log directory when the file is first
+    opened, so that this happens on the background thread as well. Old
+    log files are also pruned then, keeping the newest keep of them.
+    """
+
+    def __init__(self, filename, keep: int = DEFAULT_KEEP_LOGS):
+        self.keep = keep
+        self.failed = False
+        super().__init__(filename, delay=True)
+
+    def emit(self, record):
+        # if the log file can't be written say so once rather than for every record
+        if self.failed:
+            return
+        try:
+            super().emit(record)
+        except OSError as e:
+            self.failed = True
+            print(f"Could not write log file {self.baseFilename}: {e}", file=sys.stderr)
+
+    def _open(self):
+        log_dir = Path(self.baseFilename).parent
+        log_dir.mkdir(parents=True, exist_ok=True)
+        stream = super()._open()
+        if self.keep:
+            prune_logs(log_dir, self.keep)
+        return stream
+
+
+def prune_logs(log_dir, keep: int):
+    """
+    Function to delete all but the newest keep log files in log_dir.
+    Long running processes (e.g. serve or the idle watcher) still have
+    their log file open, so files of processes that are still alive on
+    this host, or that another host has written to recently, are kept.
+    Other processes may be pruning at the same time so files that
+    have already gone are ignored.
+    """
+    # file names start with the time so sort oldest first
+    log_files = sorted(Path(log_dir).glob(f"{LOG_PREFIX}*.log"))
+    for P in log_files[:-keep]:
+        if log_in_use(P):
+            continue
+        try:
+            P.unlink()
+        except OSError:
+            pass
+
+
+def log_in_use(log_file: Path) -> bool:
+    """
+    Function to check if the process a log file belongs to (see
+    log_file_name) may still be writing to it.
+    """
+    host, _, pid = log_file.stem[len(LOG_PREFIX):].partition("_")[2].rpartition("_")
+    try:
+        if host == socket.gethostname():
+            return pid_alive(int(pid))
+        # we can't check processes on other hosts, so go by when it was last written
+        return time.time() - log_file.stat().st_mtime < STALE_SECONDS
+    except (OSError, ValueError):
+        return False
+
+
+def log_file_name(log_dir) -> Path:
+    """
+    Function to get a log file name that is unique to this process.
+    """
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return Path(log_dir) / f"{LOG_PREFIX}{stamp}_{socket.gethostname()}_{os.getpid()}.log"
+
+
+def setup_logging(
+    log_dir: Optional[str] = None,
+    log_format: Optional[str] = None,
+    keep: int = DEFAULT_KEEP_LOGS
+) -> Optional[Path]:
+    """
+    Function to send log records to a file of their own for this process,
+    via a queue that is emptied by a background thread. Does nothing if
+    logging has already been set up by this process. Returns the log file.
+    """
+    # logging.handlers pulls in a lot (e.g. pickle) so only import it when needed
+    import logging.handlers
+    import queue
+    global _listener
+    if _listener is not None:
+        return Path(_listener.handlers[0].baseFilename)
+
+    log_dir = log_dir or os.environ.get(LOG_DIR_ENV) or DEFAULT_LOG_DIR
+    log_format = log_format or os.environ.get(LOG_FORMAT_ENV) or "text"
+    log_file = log_file_name(log_dir)
+    handler = LogFileHandler(log_file, keep)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    # unbounded so that logging never blocks and no records are dropped
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+    return log_file
+
+
+def stop_logging():
+    """
+    Function to write any records still in the queue and close the log
+    file, e.g. at exit or before replacing the process with os.execvp.
+    """
+    import logging.handlers
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    _listener = None
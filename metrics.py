@@ -0,0 +1,95 @@
+# Timing of the phases of a single invocation (loading configs, checking
+# paths, running the container etc.), optionally appended as a json line to
+# a metrics file so launch overhead can be aggregated across the cluster.
+# This only uses the standard library as it is imported on every launch,
+# json and socket are only imported when metrics are actually written.
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Optional
+from defaults import METRICS_ENV
+
+
+def metrics_file(argv: list) -> Optional[str]:
+    """
+    Function to find the metrics file for this invocation, either from
+    --metrics in argv or the environment. Returns None if metrics are off.
+    This looks at argv directly as it is needed before the arguments
+    are parsed (e.g. when handing the request to the daemon).
+    """
+    for I, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg.startswith("--metrics="):
+            return arg.split("=", 1)[1] or None
+        if arg == "--metrics" and I + 1 < len(argv):
+            return argv[I + 1]
+    return os.environ.get(METRICS_ENV) or None
+
+
+class Metrics:
+    """
+    Timings for one invocation. Use span to time each phase, the
+    duration of each is in seconds. If a span is entered more than
+    once the durations are added up.
+
+    Attributes:
+        path -- file to append the metrics to, if None nothing is written
+        fields -- extra information to record e.g. the model and operation
+        phases -- dict of phase name to duration
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.fields = {"model": None, "operation": None}
+        self.phases = {}
+        self.start = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @contextmanager
+    def span(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - start
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def record(self, returncode) -> Optional[dict]:
+        """
+        Append the metrics for this invocation to the metrics file as a
+        single json line. Returns the record, or None if metrics are off.
+        """
+        if not self.enabled:
+            return None
+        import json
+        import socket
+        record = {
+            "time": time.time(),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            **self.fields,
+            "returncode": returncode,
+            "phases": {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            "total": round(time.perf_counter() - self.start, 6),
+        }
+        line = json.dumps(record) + "\n"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # a single write to a file opened for append so lines from
+            # invocations running at the same time don't get mixed up.
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            # the timings are only for diagnosis so carry on without them
+            print(f"Could not write metrics to {self.path}: {e}", file=sys.stderr)
+        return record
@@ -0,0 +1,186 @@
+# Background conversion of containers defined by a remote URI (docker://,
+# library:// or oras://) into sif files, so that the first run of them does
+# not have to wait for (or fail because of) the pull. The pulls run in a
+# detached process with a bounded number at once, while its progress is
+# written to a status file that prefetch --status (or anything else) reads.
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from builds import BuildJob, run_build
+from image_store import record_use, store_file
+from defaults import AUTO_PREFETCH_ENV, DEFAULT_PREFETCH_JOBS, DEFAULT_STATUS_FILE
+from processes import STALE_SECONDS, pid_alive
+
+
+def auto_prefetch(flag: bool = False) -> bool:
+    """
+    Function to check if automatic prefetching is turned on, by the
+    flag or by setting the environment variable to anything but 0.
+    """
+    return flag or os.environ.get(AUTO_PREFETCH_ENV, "0") not in ["", "0"]
+
+
+def read_status(path=DEFAULT_STATUS_FILE):
+    """
+    Function to read the status file, returns None if there isn't one.
+    """
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(status: dict, path=DEFAULT_STATUS_FILE):
+    P = Path(path)
+    P.parent.mkdir(parents=True, exist_ok=True)
+    status["updated"] = time.time()
+    tmp_file = P.with_name(f"{P.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(status, indent=2) + "\n")
+    os.replace(tmp_file, P)
+
+
+def prefetch_running(path=DEFAULT_STATUS_FILE) -> bool:
+    """
+    Function to check if the prefetch recorded in the status file is
+    still running. A prefetch on another host is assumed to have died
+    if the status file has not been updated for STALE_SECONDS.
+    """
+    status = read_status(path)
+    if status is None or status.get("finished") is not None:
+        return False
+    if status.get("host") == socket.gethostname() and status.get("pid"):
+        return pid_alive(status["pid"])
+    return time.time() - status.get("updated", 0) < STALE_SECONDS
+
+
+def start_prefetch(
+    jobs: list,
+    path=DEFAULT_STATUS_FILE,
+    max_jobs: int = DEFAULT_PREFETCH_JOBS,
+    wait: bool = False,
+    image_store: Optional[str] = None,
+    force: bool = False
+) -> Optional[dict]:
+    """
+    Function to pull the images for a list of BuildJobs. Unless wait is set
+    this is done by a detached background process and the function returns
+    straight away, with None. Otherwise it returns the final status. Set
+    force to pull images even if they are already up to date.
+    """
+    status = {
+        "pid": None,
+        "host": socket.gethostname(),
+        "started": time.time(),
+        "finished": None,
+        "max_jobs": max_jobs,
+        "force": force,
+        "image_store": store_file(image_store),
+        "models": {
+            job.model_name: {
+                "status": "queued",
+                "image": job.image_file,
+                "command": job.command,
+                "manifest": job.manifest,
+                "log_file": job.log_file,
+                "layer_cache": job.layer_cache,
+            }
+            for job in jobs
+        },
+    }
+    write_status(status, path)
+    if wait:
+        return run_prefetch(path)
+    subprocess.Popen(
+        [sys.executable, __file__, "run", str(Path(path).resolve())],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    return None
+
+
+def run_prefetch(path=DEFAULT_STATUS_FILE) -> dict:
+    """
+    Pull every queued image in the status file using at most max_jobs
+    threads, updating the status of each as it goes. Images that are
+    being built by another process are waited for (see BuildLock).
+    """
+    status = read_status(path)
+    status["pid"] = os.getpid()
+    status["host"] = socket.gethostname()
+    lock = threading.Lock()
+    with lock:
+        write_status(status, path)
+
+    def update(model_name: str, **values):
+        with lock:
+            status["models"][model_name].update(values)
+            write_status(status, path)
+
+    def pull(model_name: str, info: dict):
+        update(model_name, status="pulling", pulling_since=time.time())
+        job = BuildJob(
+            model_name, info["image"], info["command"], info["manifest"], info["log_file"], info["layer_cache"]
+        )
+        result = run_build(job, status.get("force", False))
+        if result.status == "built":
+            record_use(status["image_store"], info["image"], model_name)
+        update(model_name, status=result.status, returncode=result.returncode, seconds=result.seconds)
+
+    queued = {key: value for key, value in status["models"].items() if value["status"] == "queued"}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, status["max_jobs"])) as pool:
+        futures = [pool.submit(pull, model_name, info) for model_name, info in queued.items()]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Prefetch failed: {e}")
+    with lock:
+        for info in status["models"].values():
+            if info["status"] in ["queued", "pulling"]:
+                info["status"] = "failed"
+        status["finished"] = time.time()
+        write_status(status, path)
+    return status
+
+
+def print_prefetch_status(status: Optional[dict], running: bool = False):
+    """
+    Function to print the progress of a prefetch from its status file.
+    """
+    if status is None:
+        print("No prefetch has been started")
+        return
+    print("*******************************")
+    if status.get("finished") is not None:
+        print(f"Prefetch finished in {status['finished'] - status['started']:.1f} s")
+    elif running:
+        print(f"Prefetch running (pid {status.get('pid')} on {status.get('host')})")
+    else:
+        print(f"Prefetch stopped before it finished (pid {status.get('pid')} on {status.get('host')})")
+    print("*******************************")
+    print(f"{'Name:':<30} {'Status:':<10} {'Time (s):':>10}  Image:")
+    print("-----------------------------")
+    for model_name, info in status["models"].items():
+        seconds = info.get("seconds")
+        if seconds is None and info.get("pulling_since") is not None:
+            seconds = time.time() - info["pulling_since"]
+        seconds = f"{seconds:.1f}" if seconds is not None else "-"
+        print(f"{model_name:<30} {info['status']:<10} {seconds:>10}  {info['image']}")
+
+
+if __name__ == "__main__":
+    # background prefetch, see start_prefetch
+    if len(sys.argv) == 3 and sys.argv[1] == "run":
+        run_prefetch(sys.argv[2])
+    else:
+        sys.exit(f"usage: {sys.argv[0]} run status_file")
@@ -0,0 +1,28 @@
+# Checks on whether the process a file belongs to is still running, shared
+# by the build locks, the log files, the prefetch status file and the
+# daemon's table of instances, which all record the pid of that process.
+import os
+from pathlib import Path
+
+# files (e.g. locks) of a process on another host are assumed to be stale if
+# they have not been refreshed for this long (we can't check if it is alive).
+STALE_SECONDS = 300
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Function to check if the process with the given pid, on this host,
+    is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process exists but belongs to someone else
+        return True
+    try:
+        # a zombie has exited, it is only waiting for its parent to reap it
+        return Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
@@ -0,0 +1,137 @@
+# Staging of a container's shared directory to node-local scratch. Jobs
+# that read lots of small files hammer the parallel filesystem if they
+# read them in place, so the directory is copied to scratch once (in one
+# sequential pass), the copy is bound into the container in its place and
+# any declared outputs are copied back once the container exits. Each run
+# gets its own copy, which is removed afterwards, so concurrent runs can't
+# see each other's outputs and outputs left by an earlier run are never
+# copied back as if this run had made them.
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path, PurePosixPath
+from typing import List, Optional
+from defaults import SCRATCH_ENV
+
+STAGE_PREFIX = "bede_stage_"
+
+
+class StagingError(Exception):
+    """
+    Custom Exception to be raised when the shared directory can't be
+    copied to, or the outputs copied back from, scratch.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def scratch_root(path: Optional[str] = None) -> Path:
+    """
+    Function to get the node-local scratch directory to stage into.
+    """
+    return Path(path or os.environ.get(SCRATCH_ENV) or os.environ.get("TMPDIR") or "/tmp")
+
+
+def stage_path(source, scratch: Optional[str] = None) -> Path:
+    """
+    Function to get the prefix of the directories source is staged to,
+    each run stages into a new directory whose name starts with it.
+    """
+    source = os.path.abspath(source)
+    digest = hashlib.sha256(source.encode()).hexdigest()[:12]
+    return scratch_root(scratch) / f"{STAGE_PREFIX}{Path(source).name}_{digest}"
+
+
+def check_output_path(path: str) -> str:
+    """
+    Function to check an output path is relative and stays inside the
+    shared directory, raises ValueError if not.
+    """
+    P = PurePosixPath(path)
+    if path == "" or P.is_absolute() or ".." in P.parts:
+        raise ValueError(
+            f"output path {path} must be relative to the shared directory and not contain .."
+        )
+    return path
+
+
+def sync(src: Path, dst: Path):
+    """
+    Function to make dst an up to date copy of src (a file or directory).
+    rsync is used if available as it only copies files that have changed,
+    otherwise fall back to copying everything. Files in dst that are not
+    in src are left alone.
+    """
+    if shutil.which("rsync"):
+        if src.is_dir():
+            args = [f"{src}/", f"{dst}/"]
+        else:
+            args = [str(src), str(dst)]
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        proc = subprocess.run(["rsync", "-a", *args], capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise StagingError(f"Could not copy {src} to {dst}: {proc.stderr.strip()}")
+        return
+    try:
+        if src.is_dir():
+            shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+        else:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(src, dst)
+    except (OSError, shutil.Error) as e:
+        raise StagingError(f"Could not copy {src} to {dst}: {e}")
+
+
+def stage_in(source, scratch: Optional[str] = None) -> Path:
+    """
+    Function to copy source into a new directory on node-local scratch,
+    unique to this run, and return its path. Use remove_stage once the
+    run is done with it.
+    """
+    prefix = stage_path(source, scratch)
+    try:
+        prefix.parent.mkdir(parents=True, exist_ok=True)
+        target = Path(tempfile.mkdtemp(prefix=f"{prefix.name}_", dir=prefix.parent))
+    except OSError as e:
+        raise StagingError(f"Could not create a directory in {prefix.parent} to stage into: {e}")
+    logging.info(f"Staging {source} to {target}")
+    try:
+        sync(Path(source), target)
+    except StagingError:
+        remove_stage(target)
+        raise
+    return target
+
+
+def remove_stage(staged):
+    """
+    Function to remove the staged copy made by stage_in.
+    """
+    logging.info(f"Removing staged copy {staged}")
+    shutil.rmtree(staged, ignore_errors=True)
+
+
+def stage_out(staged, source, outputs: List[str]) -> List[str]:
+    """
+    Function to copy each of the outputs (paths relative to the shared
+    directory) from the staged copy back to source. Returns the outputs
+    that were not found, i.e. the container did not create them.
+    """
+    missing = []
+    for output in outputs:
+        src = Path(staged) / check_output_path(output)
+        if not src.exists():
+            logging.warning(f"Output {output} was not found in {staged}")
+            missing.append(output)
+            continue
+        logging.info(f"Copying {src} back to {source}")
+        sync(src, Path(source) / output)
+    return missing
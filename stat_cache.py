@@ -0,0 +1,49 @@
+import os
+import stat
+from functools import lru_cache
+
+# default number of threads used to stat paths. Stat calls on the
+# parallel filesystem are mostly waiting on the network so this can
+# be a fair bit larger than the number of cores.
+DEFAULT_JOBS = 16
+
+
+@lru_cache(maxsize=None)
+def path_kind(path: str) -> str:
+    """
+    Function to stat a path and return what kind of thing it is, one of
+    "file", "dir", "other" or "missing". Results are cached for the life
+    of the process so each path is only ever stat'ed once.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    if stat.S_ISREG(st.st_mode):
+        return "file"
+    if stat.S_ISDIR(st.st_mode):
+        return "dir"
+    return "other"
+
+
+def prefetch(paths, jobs: int = DEFAULT_JOBS):
+    """
+    Function to warm the stat cache for a collection of paths using a
+    bounded pool of threads. Duplicate paths are only stat'ed once.
+    """
+    paths = sorted({str(p) for p in paths})
+    if jobs <= 1 or len(paths) < 2:
+        for path in paths:
+            path_kind(path)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(jobs, len(paths))) as pool:
+        # consume the iterator so any unexpected exceptions are raised here
+        list(pool.map(path_kind, paths))
+
+
+def clear_stat_cache():
+    """
+    Forget all cached stat results, e.g. after files have been created.
+    """
+    path_kind.cache_clear()
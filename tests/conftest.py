@@ -1,3 +1,124 @@
+import json
+import os
+import signal
+import sys
+from pathlib import Path
+import pytest
+
+STUB_APPTAINER = Path(__file__).parent / "stub_apptainer.py"
+
+
+class StubApptainer:
+    """
+    Handle to the stub apptainer installed by the stub_apptainer fixture.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+    def calls(self, command=None):
+        """
+        Return the argv of every call made to the stub, optionally
+        only those for a given sub-command e.g. "build".
+        """
+        if not self.log_file.exists():
+            return []
+        calls = [json.loads(line)["argv"] for line in self.log_file.read_text().splitlines()]
+        if command is not None:
+            calls = [argv for argv in calls if argv[0] == command]
+        return calls
+
+
+@pytest.fixture(autouse=True)
+def history_file(tmp_path, monkeypatch):
+    """
+    Keep the history of runs made by the tests out of the real one.
+    """
+    path = tmp_path / "history.sqlite"
+    monkeypatch.setenv("BEDE_CONTAINERS_HISTORY", str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def image_store(tmp_path, monkeypatch):
+    """
+    Keep the record of image use made by the tests out of the real one.
+    """
+    path = tmp_path / "images.sqlite"
+    monkeypatch.setenv("BEDE_CONTAINERS_IMAGE_STORE", str(path))
+    monkeypatch.delenv("BEDE_CONTAINERS_IMAGE_QUOTA", raising=False)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    """
+    Keep the log files written by the tests (the cli's own and the output
+    of bulk builds) out of the checkout.
+    """
+    path = tmp_path / "logs"
+    monkeypatch.setenv("BEDE_CONTAINERS_LOG_DIR", str(path))
+    monkeypatch.setattr("builds.BUILD_LOG_DIR", str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def config_cache_file(tmp_path, monkeypatch):
+    """
+    Keep the config cache written by the tests out of the checkout.
+    """
+    path = tmp_path / "config_cache.json"
+    monkeypatch.setattr("run_container.DEFAULT_CACHE_FILE", str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def instance_state_dir(tmp_path, monkeypatch):
+    """
+    Keep the records of the instances started by the tests out of the real ones.
+    """
+    path = tmp_path / "instances"
+    monkeypatch.setattr("instances.INSTANCE_STATE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """
+    Run the cli with a config file and the given arguments, returns the exit
+    code. The config cache is not used so nothing is written to the checkout.
+    """
+    from run_container import main
+
+    def run(conf_file, *args):
+        monkeypatch.setattr("sys.argv", [sys.argv[0], "--no_cache", f"--config_file={conf_file}", *args])
+        return main()
+    return run
+
+
+@pytest.fixture
+def stub_apptainer(tmp_path, monkeypatch):
+    """
+    Put a stub apptainer (see stub_apptainer.py) first on the PATH.
+    """
+    bin_dir = tmp_path / "stub_bin"
+    bin_dir.mkdir()
+    script = bin_dir / "apptainer"
+    script.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_APPTAINER}" "$@"\n')
+    script.chmod(0o755)
+    log_file = tmp_path / "apptainer_calls.log"
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_APPTAINER_LOG", str(log_file))
+    yield StubApptainer(log_file)
+    # stop any instances the test left running
+    instance_file = tmp_path / "stub_instances.json"
+    if instance_file.exists():
+        for info in json.loads(instance_file.read_text()).values():
+            try:
+                os.kill(info["pid"], signal.SIGTERM)
+            except OSError:
+                pass
+
 import pytest
 
 @pytest.hookimpl()
@@ -0,0 +1,161 @@
+# Stub version of the apptainer command line tool, used so that tests can
+# exercise building and running containers without apptainer installed.
+# Every call is appended as a json line to $STUB_APPTAINER_LOG.
+import fcntl
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+STUB_VERSION = "apptainer version 1.3.0-stub"
+# flags that are followed by a value, e.g. --bind src:dst
+FLAGS_WITH_VALUES = {"--pem-path", "--bind", "--env"}
+
+
+def log_call(argv):
+    log_file = os.environ.get("STUB_APPTAINER_LOG")
+    if log_file:
+        with open(log_file, "a") as file:
+            file.write(json.dumps({"argv": argv, "pid": os.getpid(), "time": time.time()}) + "\n")
+
+
+def build(argv):
+    # apptainer build [flags] image definition
+    image, definition = argv[-2], argv[-1]
+    time.sleep(float(os.environ.get("STUB_APPTAINER_BUILD_SECONDS", "0")))
+    # fail every build, or only those whose image path contains the given string
+    fail = os.environ.get("STUB_APPTAINER_FAIL")
+    if fail and (fail == "1" or fail in image):
+        print(f"FATAL: stub build of {image} failed", file=sys.stderr)
+        return 255
+    if os.path.exists(image) and "--force" not in argv:
+        # apptainer asks before overwriting, which fails without a terminal
+        print(f"FATAL: Build target '{image}' already exists, use --force to overwrite", file=sys.stderr)
+        return 255
+    cache_dir = os.environ.get("APPTAINER_CACHEDIR")
+    if cache_dir and "://" in definition:
+        # pretend to pull a base layer shared by every image and one for this image
+        # same layout as apptainer, an OCI layout in cache/blob
+        blob_root = os.path.join(cache_dir, "cache", "blob")
+        blob_dir = os.path.join(blob_root, "blobs", "sha256")
+        os.makedirs(blob_dir, exist_ok=True)
+        for name, text in [("oci-layout", '{"imageLayoutVersion": "1.0.0"}'), ("index.json", '{"manifests": []}')]:
+            if not os.path.exists(os.path.join(blob_root, name)):
+                with open(os.path.join(blob_root, name), "w") as file:
+                    file.write(text)
+        for layer in ["base", definition]:
+            digest = hashlib.sha256(layer.encode()).hexdigest()
+            if not os.path.exists(os.path.join(blob_dir, digest)):
+                with open(os.path.join(blob_dir, digest), "w") as file:
+                    file.write(f"stub layer {layer}\n")
+    if "--sandbox" in argv:
+        os.makedirs(image, exist_ok=True)
+        image = os.path.join(image, "stub_sandbox")
+    with open(image, "w") as file:
+        file.write(f"stub image built from {definition}\n")
+    return 0
+
+
+def instance_file():
+    # running instances are recorded in a json file next to the call log
+    log_file = os.environ.get("STUB_APPTAINER_LOG", "apptainer_calls.log")
+    return os.path.join(os.path.dirname(os.path.abspath(log_file)), "stub_instances.json")
+
+
+def read_instances():
+    try:
+        with open(instance_file()) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_instances(instances):
+    with open(instance_file(), "w") as file:
+        json.dump(instances, file)
+
+
+def stop_process(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def instance(argv):
+    # apptainer instance start [flags] image name | stop name | list --json [name]
+    # hold a lock while updating the instances file as calls can run concurrently
+    with open(instance_file() + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _instance(argv)
+
+
+def _instance(argv):
+    instances = read_instances()
+    if argv[1] == "start":
+        image, name = argv[-2], argv[-1]
+        if not os.path.exists(image):
+            print(f"FATAL: could not open image {image}", file=sys.stderr)
+            return 255
+        # like apptainer, the instance is a process that runs until it is stopped
+        pid = subprocess.Popen(
+            [sys.executable, "-c", "import time; time.sleep(600)"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        ).pid
+        instances[name] = {"instance": name, "pid": pid, "img": os.path.abspath(image)}
+        write_instances(instances)
+    elif argv[1] == "stop":
+        name = argv[-1]
+        if name not in instances:
+            print(f"FATAL: no instance found with name {name}", file=sys.stderr)
+            return 255
+        stop_process(instances.pop(name)["pid"])
+        write_instances(instances)
+    elif argv[1] == "list":
+        names = [arg for arg in argv[2:] if not arg.startswith("-")]
+        found = [value for key, value in instances.items() if not names or key in names]
+        print(json.dumps({"instances": found}))
+    return 0
+
+
+def exec_(argv):
+    # apptainer exec [flags] image|instance://name command...
+    args = argv[1:]
+    while args[0].startswith("-"):
+        if args[0] == "--env":
+            # set inside the container, so for the command we run
+            key, _, value = args[1].partition("=")
+            os.environ[key] = value
+        args = args[2:] if args[0] in FLAGS_WITH_VALUES else args[1:]
+    target, command = args[0], args[1:]
+    if target.startswith("instance://") and target[len("instance://"):] not in read_instances():
+        print(f"FATAL: instance {target} not found", file=sys.stderr)
+        return 255
+    if "STUB_APPTAINER_EXIT_CODE" in os.environ or not command:
+        print(" ".join(argv))
+        return int(os.environ.get("STUB_APPTAINER_EXIT_CODE", "0"))
+    # run the command on the host as if it was inside the container
+    sys.stdout.flush()
+    os.execvp(command[0], command)
+
+
+def main(argv):
+    log_call(argv)
+    if argv[0] == "--version":
+        print(os.environ.get("STUB_APPTAINER_VERSION", STUB_VERSION))
+        return 0
+    if argv[0] == "build":
+        return build(argv)
+    if argv[0] == "exec":
+        return exec_(argv)
+    if argv[0] == "instance":
+        return instance(argv)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+# tests for pinning containers to cpus and NUMA nodes and setting their thread counts
+import pytest
+import affinity
+from affinity import format_cpu_list, parse_cpu_list, pin_prefix, split_domains, thread_env
+from run_container import format_command, load_container_config_file
+
+
+@pytest.fixture
+def two_nodes(tmp_path, monkeypatch):
+    '''
+    pretend the machine has two NUMA nodes, with cpu 0 in node 0 and cpu 1
+    in node 1, and that numactl is not installed
+    '''
+    node_dir = tmp_path / "node"
+    for node in [0, 1]:
+        (node_dir / f"node{node}").mkdir(parents=True)
+        (node_dir / f"node{node}" / "cpulist").write_text(f"{node}\n")
+    monkeypatch.setattr(affinity, "NODE_DIR", str(node_dir))
+    monkeypatch.setattr(affinity.os, "sched_getaffinity", lambda pid: {0, 1})
+    monkeypatch.setattr(affinity, "have_numactl", lambda: False)
+
+
+@pytest.fixture
+def stub_taskset(stub_apptainer, tmp_path):
+    '''
+    put a taskset first on the PATH that only records the cpus it was
+    given in $STUB_TASKSET_CPUS, as the tests may only have one cpu
+    '''
+    script = tmp_path / "stub_bin" / "taskset"
+    script.write_text('#!/bin/sh\nshift\nexport STUB_TASKSET_CPUS="$1"\nshift\nexec "$@"\n')
+    script.chmod(0o755)
+    return stub_apptainer
+
+
+@pytest.fixture
+def pinned_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    image = tmp_path / "Pinned.sif"
+    image.write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Pinned:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n  cpus: '0'\n"
+        f"Unpinned:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n"
+    )
+    return conf_file
+
+
+def test_cpu_lists():
+    assert parse_cpu_list("0-3,8, 10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpu_list([11, 0, 1, 2, 3, 8, 10]) == "0-3,8,10-11"
+    for bad in ["", "a", "3-1", "-1"]:
+        with pytest.raises(ValueError):
+            parse_cpu_list(bad)
+
+
+def test_pin_prefix(two_nodes, monkeypatch):
+    assert pin_prefix() == []
+    assert pin_prefix("0-1") == ["taskset", "-c", "0-1"]
+    # without numactl only the cpus of the node can be pinned
+    assert pin_prefix(numa_node="1") == ["taskset", "-c", "1"]
+    with pytest.raises(ValueError, match="NUMA node"):
+        pin_prefix(numa_node="5")
+    monkeypatch.setattr(affinity, "have_numactl", lambda: True)
+    assert pin_prefix(numa_node="1") == ["numactl", "--cpunodebind=1", "--membind=1"]
+    assert pin_prefix("1", "1") == ["numactl", "--physcpubind=1", "--membind=1"]
+
+
+def test_thread_env(two_nodes):
+    assert thread_env() == {}
+    assert thread_env(numa_node="0")["OMP_NUM_THREADS"] == "1"
+    assert thread_env(cpus="0-1")["MKL_NUM_THREADS"] == "2"
+    assert thread_env(threads=4) == {name: "4" for name in affinity.THREAD_ENV_VARS}
+
+
+def test_split_domains(two_nodes):
+    assert split_domains(2) == [(0, [0]), (1, [1])]
+    assert split_domains(1) == [(0, [0])]
+    assert split_domains(1, numa_node="1") == [(1, [1])]
+    # node 0 only has one cpu
+    with pytest.raises(ValueError, match="only has 1 cpus"):
+        split_domains(3)
+    with pytest.raises(ValueError, match="no cpus"):
+        split_domains(1, cpus="7")
+
+
+def test_format_command(two_nodes, pinned_config):
+    Containers = load_container_config_file(pinned_config)
+    command = format_command("run", "Pinned", Containers["Pinned"], ["ls"])
+    assert command[:4] == ["taskset", "-c", "0", "apptainer"]
+    assert "--env" in command and "OMP_NUM_THREADS=1" in command
+    assert format_command("run", "Unpinned", Containers["Unpinned"], ["ls"])[0] == "apptainer"
+
+
+def test_run_pinned(two_nodes, pinned_config, stub_taskset, capfd, run):
+    assert run(pinned_config, "--no_daemon", "run", "--cold", "Pinned", "printenv", "OMP_NUM_THREADS") == 0
+    assert capfd.readouterr().out.splitlines()[-1] == "1"
+    # the command line overrides the config
+    assert run(pinned_config, "--no_daemon", "run", "--cold", "--threads=3", "Unpinned",
+               "printenv", "MKL_NUM_THREADS") == 0
+    assert capfd.readouterr().out.splitlines()[-1] == "3"
+    assert "OMP_NUM_THREADS=3" in stub_taskset.calls("exec")[-1]
+    assert run(pinned_config, "--no_daemon", "--debug", "start", "--numa_node=1", "Unpinned") == 0
+    assert "taskset -c 1 apptainer instance start --env OMP_NUM_THREADS=1" in capfd.readouterr().out
+
+
+def test_run_split(two_nodes, pinned_config, stub_taskset, tmp_path, monkeypatch, capfd, run):
+    script = tmp_path / "copy.sh"
+    script.write_text(f'#!/bin/sh\necho "$BEDE_CONTAINERS_SPLIT_INDEX/$BEDE_CONTAINERS_SPLIT_COUNT '
+                      f'$OMP_NUM_THREADS $STUB_TASKSET_CPUS" > {tmp_path}/copy_$BEDE_CONTAINERS_SPLIT_INDEX\n')
+    script.chmod(0o755)
+    assert run(pinned_config, "--no_daemon", "run", "--cold", "--split=2", "Unpinned", str(script)) == 0
+    assert (tmp_path / "copy_0").read_text().split() == ["0/2", "1", "0"]
+    assert (tmp_path / "copy_1").read_text().split() == ["1/2", "1", "1"]
+    assert sorted(argv[:3] for argv in stub_taskset.calls("exec")) == [
+        ["exec", "--env", "OMP_NUM_THREADS=1"]
+    ] * 2
+
+    # a failing copy fails the run
+    monkeypatch.setenv("STUB_APPTAINER_EXIT_CODE", "3")
+    assert run(pinned_config, "--no_daemon", "run", "--cold", "--split=2", "Unpinned", "true") == 3
+    monkeypatch.delenv("STUB_APPTAINER_EXIT_CODE")
+
+    # the config's pinning limits the cpus that are split up
+    assert run(pinned_config, "--no_daemon", "--debug", "run", "--split=1", "Pinned", "true") == 0
+    with pytest.raises(ValueError, match="can't split"):
+        run(pinned_config, "--no_daemon", "run", "--split=2", "Pinned", "true")
+
+
+def test_build_and_stop_pinned_elsewhere(two_nodes, stub_apptainer, tmp_path, monkeypatch, capfd, run):
+    '''
+    pinning only applies to run and start, so a container pinned to a NUMA
+    node this host doesn't have (e.g. a login node) can still be built and stopped
+    '''
+    monkeypatch.chdir(tmp_path)
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Pin:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'Pin.sif'}'\n  numa_node: '5'\n"
+    )
+    assert run(conf_file, "--no_daemon", "--debug", "build", "Pin") == 0
+    assert run(conf_file, "--no_daemon", "build", "--all") == 0
+    assert (tmp_path / "Pin.sif").exists()
+    assert run(conf_file, "--no_daemon", "--debug", "stop", "Pin") == 0
+    assert "apptainer instance stop Pin" in capfd.readouterr().out
+    with pytest.raises(ValueError, match="NUMA node"):
+        run(conf_file, "--no_daemon", "run", "Pin", "true")
+
+
+def test_invalid_pinning(tmp_path, run):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("Bad:\n  description: 'test'\n  container_definition: 'alpine:latest'\n  cpus: '0-a'\n")
+    with pytest.raises(ValueError, match="cpu list"):
+        run(conf_file, "list")
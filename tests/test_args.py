@@ -2,6 +2,7 @@
 import pytest
 import sys
 import os
+import shutil
 from util_functions import check_test_output
 from run_container import main, format_command,CMD_FormatError 
 from run_container import check_container_config
@@ -99,4 +100,52 @@ def test_model_name_flag(monkeypatch):
     conf_file = "tests/test_configs/valid.yaml"
     monkeypatch.setattr("sys.argv", [prog,f"--config_file={conf_file}", "run", "Test","hostname"])
     with pytest.raises(ValueError):
-        return_code = main()
\ No newline at end of file
+        return_code = main()
+
+def test_validate(capfd, monkeypatch, tmp_path):
+    '''
+    check validate reports errors from all config files
+    '''
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "--no_cache", "--config_file=tests/test_configs/", "validate"])
+    assert main() == 1
+    out = capfd.readouterr().out
+    assert "test9.yaml" in out and "test7.yaml" in out
+    # missing shared directories are only found with --deep
+    assert "does not exist" not in out
+    shutil.copy("tests/test_configs/test4.yaml", tmp_path)
+    shutil.copy("tests/test_configs/test10.yaml", tmp_path)
+    monkeypatch.setattr("sys.argv", [prog, "--no_cache", f"--config_file={tmp_path}", "validate", "--deep"])
+    assert main() == 1
+    out = capfd.readouterr().out
+    assert "does not exist" in out and "test10.yaml" in out
+
+def test_validate_deep_ok(monkeypatch):
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "validate", "--deep"])
+    assert main() == 0
+
+def test_run_exit_code_and_arguments(stub_apptainer, tmp_path):
+    '''
+    check run passes arguments to the container unchanged (no shell
+    re-splitting them) and exits with the container's exit code
+    '''
+    import subprocess
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "Exec_Test.sif").write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Exec_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'Exec_Test.sif'}'\n"
+    )
+    script = os.path.abspath("run_container.py")
+    for flags in [[], ["--no_history"]]:
+        proc = subprocess.run(
+            [sys.executable, script, "--no_daemon", "--no_cache", f"--config_file={conf_file}", *flags,
+             "run", "Exec_Test", "--", "sh", "-c", 'echo "$1"; exit 3', "sh", "two  spaces"],
+            cwd=tmp_path, capture_output=True, text=True,
+        )
+        assert proc.returncode == 3
+        assert "\ntwo  spaces\n" in proc.stdout
+    # without the history the container replaced the process so we printed nothing after it
+    assert proc.stdout.endswith("two  spaces\n")
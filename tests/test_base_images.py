@@ -0,0 +1,82 @@
+# tests for building containers on top of a base image
+import pytest
+from pathlib import Path
+from base_images import base_image, strip_header
+from build_manifest import read_manifest
+
+
+@pytest.fixture
+def base_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "base.def").write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n\n%post\n    apt-get install -y python3\n")
+    for name in ["model_a", "model_b"]:
+        (tmp_path / f"{name}.def").write_text(f"Bootstrap: docker\nFrom: ubuntu:24.04\n\n%post\n    echo {name}\n")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("".join(
+        f"{name}:\n  description: 'test'\n  container_definition: '{tmp_path / f'{name}.def'}'\n"
+        f"  base: '{tmp_path / 'base.def'}'\n  image_file: '{tmp_path / 'Images' / f'{name}.sif'}'\n"
+        for name in ["model_a", "model_b"]
+    ))
+    return conf_file
+
+
+def built(stub_apptainer):
+    return [argv[-2].rsplit("/", 1)[-1] for argv in stub_apptainer.calls("build")]
+
+
+def test_strip_header():
+    assert strip_header("Bootstrap: docker\nFrom: ubuntu\n\n%post\n  ls\n") == "%post\n  ls\n"
+    assert strip_header("Bootstrap: docker\n") == ""
+
+
+def test_layered_build(base_config, stub_apptainer, tmp_path, run):
+    base = Path(base_image(tmp_path / "Images" / "model_a.sif", str(tmp_path / "base.def")))
+    assert run(base_config, "build", "model_a") == 0
+    assert built(stub_apptainer) == [base.name, "model_a.sif"]
+    definition = stub_apptainer.calls("build")[-1][-1]
+    text = (tmp_path / definition).read_text()
+    assert f"Bootstrap: localimage\nFrom: {base}\n" in text
+    assert "echo model_a" in text and "Bootstrap: docker" not in text
+
+    # the base is shared and only built once
+    assert run(base_config, "build", "model_b") == 0
+    assert built(stub_apptainer) == [base.name, "model_a.sif", "model_b.sif"]
+
+    # changing the model only rebuilds the model
+    (tmp_path / "model_a.def").write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n\n%post\n    echo changed\n")
+    assert run(base_config, "build", "model_a") == 0
+    assert built(stub_apptainer)[3:] == ["model_a.sif"]
+    # --force rebuilds the model but not the base
+    assert run(base_config, "build", "--force", "model_a") == 0
+    assert built(stub_apptainer)[4:] == ["model_a.sif"]
+
+    # changing the base rebuilds it, then everything built on it
+    (tmp_path / "base.def").write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n\n%post\n    apt-get install -y git\n")
+    assert run(base_config, "build", "--all") == 0
+    assert built(stub_apptainer)[5:6] == [base.name]
+    assert sorted(built(stub_apptainer)[6:]) == ["model_a.sif", "model_b.sif"]
+    assert read_manifest(base)["definition"] == str(tmp_path / "base.def")
+    assert run(base_config, "build", "--all") == 0
+    assert len(built(stub_apptainer)) == 8
+
+
+def test_base_names():
+    # bases with the same file name in different directories don't share an image
+    assert Path(base_image("Images/model.sif", "a/base.def")).parent == Path("Images/base")
+    assert base_image("Images/model.sif", "a/base.def") != base_image("Images/model.sif", "b/base.def")
+    assert base_image("Images/model.sif", "a/base.def") == base_image("Images/model.sif", "a/../a/base.def")
+
+
+def test_failed_base(base_config, stub_apptainer, tmp_path, monkeypatch, run):
+    base = Path(base_image(tmp_path / "Images" / "model_a.sif", str(tmp_path / "base.def")))
+    monkeypatch.setenv("STUB_APPTAINER_FAIL", "base")
+    assert run(base_config, "build", "model_a") == 255
+    assert run(base_config, "build", "--all") == 1
+    assert built(stub_apptainer) == [base.name, base.name]
+
+
+def test_invalid_base(tmp_path, run):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("Bad:\n  description: 'test'\n  container_definition: 'ubuntu:24.04'\n  base: 'base.def'\n")
+    with pytest.raises(ValueError, match="base"):
+        run(conf_file, "list")
@@ -0,0 +1,115 @@
+# tests for running many commands through a few container sessions
+import io
+import json
+import sys
+import time
+import pytest
+from batch import TIMEOUT_EXIT_CODE, ContainerSession, read_batch_commands, run_batch
+from run_container import main
+
+
+@pytest.fixture
+def batch_config(tmp_path):
+    image = tmp_path / "Batch_Test.sif"
+    image.write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Batch_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n"
+    )
+    return conf_file
+
+
+def test_read_batch_commands(tmp_path, monkeypatch):
+    batch_file = tmp_path / "commands.txt"
+    batch_file.write_text("# a comment\necho 1\n\n  echo 2  \n")
+    assert read_batch_commands(str(batch_file)) == ["echo 1", "echo 2"]
+    monkeypatch.setattr("sys.stdin", io.StringIO("echo 3\n"))
+    assert read_batch_commands("-") == ["echo 3"]
+
+
+def test_session():
+    session = ContainerSession(["/bin/sh"])
+    assert session.run("echo hello") == (0, "hello\n")
+    assert session.run("echo oops >&2; exit 3") == (3, "oops\n")
+    # commands can't read the rest of the batch from stdin
+    assert session.run("cat") == (0, "")
+    assert session.run("echo still here") == (0, "still here\n")
+    assert session.starts == 1
+    session.close()
+
+
+def test_session_restarts():
+    session = ContainerSession(["/bin/sh"])
+    # kill the session itself rather than the shell running the command
+    returncode, _ = session.run("kill -9 $PPID")
+    assert returncode != 0
+    assert session.run("echo back") == (0, "back\n")
+    assert session.starts == 2
+    session.close()
+
+
+def test_session_unusual_output():
+    session = ContainerSession(["/bin/sh"])
+    # output without a newline at the end
+    assert session.run("printf foo") == (0, "foo")
+    assert session.run("echo after") == (0, "after\n")
+    # a syntax error only fails that command
+    returncode, output = session.run('echo "unterminated')
+    assert returncode != 0 and output
+    assert session.run("echo after") == (0, "after\n")
+    assert session.starts == 1
+    session.close()
+
+
+def test_session_timeout():
+    session = ContainerSession(["/bin/sh"])
+    start = time.perf_counter()
+    returncode, output = session.run("echo started; sleep 30", timeout=0.5)
+    assert time.perf_counter() - start < 10
+    assert returncode == TIMEOUT_EXIT_CODE
+    assert output.startswith("started\n") and "timed out" in output
+    assert session.run("echo back", timeout=5) == (0, "back\n")
+    assert session.starts == 2
+    session.close()
+
+
+def test_run_batch(tmp_path):
+    results = run_batch(["echo ok", "printf foo", 'echo "unterminated', "sleep 30", "echo after"],
+                        ["/bin/sh"], 1, tmp_path / "results.jsonl", timeout=2)
+    assert [result["output"] for result in results[:2] + results[-1:]] == ["ok\n", "foo", "after\n"]
+    assert [result["returncode"] for result in results] == [0, 0, 2, TIMEOUT_EXIT_CODE, 0]
+
+
+def test_batch_run(batch_config, stub_apptainer, tmp_path, monkeypatch):
+    '''
+    check a batch of commands only starts one container per session
+    '''
+    batch_file = tmp_path / "commands.txt"
+    commands = [f"echo command {I}" for I in range(20)] + ["exit 7"]
+    batch_file.write_text("\n".join(commands) + "\n")
+    results_file = tmp_path / "results.jsonl"
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [
+        prog, "--no_cache", f"--config_file={batch_config}", "run", "Batch_Test",
+        "--batch", str(batch_file), "--sessions", "3", "--results", str(results_file)
+    ])
+    assert main() == 1
+    assert len(stub_apptainer.calls("exec")) == 3
+    results = sorted((json.loads(line) for line in results_file.read_text().splitlines()), key=lambda r: r["index"])
+    assert [r["command"] for r in results] == commands
+    assert [r["output"] for r in results[:20]] == [f"command {I}\n" for I in range(20)]
+    assert results[-1]["returncode"] == 7
+
+
+def test_batch_needs_commands(batch_config, monkeypatch):
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "run", "Batch_Test"])
+    with pytest.raises(SystemExit):
+        main()
+    monkeypatch.setattr("sys.argv", [prog, "run", "Batch_Test", "hostname", "--batch", "-"])
+    with pytest.raises(SystemExit):
+        main()
+    monkeypatch.setattr("sys.argv", [prog, "run", "Batch_Test", "--batch", "-", "--command_timeout=0"])
+    with pytest.raises(SystemExit):
+        main()
@@ -0,0 +1,144 @@
+# tests for skipping builds of images that are already up to date
+import pytest
+import sys
+from build_manifest import read_manifest, manifest_path, make_manifest, is_up_to_date, write_manifest
+from run_container import main
+
+
+def write_config(tmp_path, definition):
+    '''
+    create a config for a single model that builds into tmp_path
+    '''
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Build_Test:\n  description: 'test'\n"
+        f"  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Build_Test.sif'}'\n"
+    )
+    return conf_file
+
+
+def build(monkeypatch, conf_file, *flags):
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "--no_cache", f"--config_file={conf_file}", "build", "Build_Test", *flags])
+    return main()
+
+
+def test_manifest_staleness(tmp_path, stub_apptainer, monkeypatch):
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    image = tmp_path / "test.sif"
+    manifest = make_manifest(str(definition), "")
+    assert manifest["apptainer_version"] == "apptainer version 1.3.0-stub"
+    assert manifest["definition_sha256"] is not None
+    # no image yet
+    assert not is_up_to_date(image, manifest)
+    image.write_text("image")
+    # no manifest yet
+    assert not is_up_to_date(image, manifest)
+    manifest_path(image).write_text('{"definition": "other.def"}')
+    assert not is_up_to_date(image, manifest)
+    write_manifest(image, manifest)
+    assert is_up_to_date(image, manifest)
+    # change the definition, flags or apptainer version
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:22.04\n")
+    assert not is_up_to_date(image, make_manifest(str(definition), ""))
+    assert not is_up_to_date(image, dict(manifest, build_flags="--passkey"))
+    monkeypatch.setenv("STUB_APPTAINER_VERSION", "apptainer version 1.4.0")
+    assert not is_up_to_date(image, make_manifest(str(definition), ""))
+
+
+def test_uri_manifest(stub_apptainer):
+    manifest = make_manifest("docker://alpine:latest", "")
+    assert manifest["definition"] == "docker://alpine:latest"
+    assert manifest["definition_sha256"] is None
+
+
+def test_build_skip(tmp_path, stub_apptainer, monkeypatch):
+    '''
+    check build is skipped unless the definition changes or --force is used
+    '''
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    conf_file = write_config(tmp_path, definition)
+    image = tmp_path / "Build_Test.sif"
+
+    assert build(monkeypatch, conf_file) == 0
+    assert len(stub_apptainer.calls("build")) == 1
+    assert read_manifest(image)["definition"] == str(definition)
+
+    # nothing has changed so this should not call apptainer build
+    assert build(monkeypatch, conf_file) == 0
+    assert len(stub_apptainer.calls("build")) == 1
+
+    # changing the definition should trigger a rebuild
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:22.04\n")
+    assert build(monkeypatch, conf_file) == 0
+    assert len(stub_apptainer.calls("build")) == 2
+
+    assert build(monkeypatch, conf_file, "--force") == 0
+    assert len(stub_apptainer.calls("build")) == 3
+
+
+def test_failed_build_no_manifest(tmp_path, stub_apptainer, monkeypatch):
+    conf_file = write_config(tmp_path, "alpine:latest")
+    monkeypatch.setenv("STUB_APPTAINER_FAIL", "1")
+    assert build(monkeypatch, conf_file) != 0
+    assert read_manifest(tmp_path / "Build_Test.sif") is None
+
+
+def write_group_config(tmp_path):
+    conf_file = tmp_path / "group.yaml"
+    conf_file.write_text(
+        f"Model_A:\n  description: 'a'\n  group: Bulk\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'A.sif'}'\n"
+        f"Model_B:\n  description: 'b'\n  group: Bulk\n  container_definition: 'ubuntu:latest'\n"
+        f"  image_file: '{tmp_path / 'B.sif'}'\n"
+        f"Model_B2:\n  description: 'same image as b'\n  group: Bulk\n  container_definition: 'ubuntu:latest'\n"
+        f"  image_file: '{tmp_path / 'B.sif'}'\n"
+        f"Model_C:\n  description: 'not in group'\n  group: Other\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'C.sif'}'\n"
+    )
+    return conf_file
+
+
+def test_build_group(tmp_path, stub_apptainer, monkeypatch, capfd, log_dir):
+    '''
+    check building a group builds each image once and prints a summary
+    '''
+    conf_file = write_group_config(tmp_path)
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "--no_cache", f"--config_file={conf_file}", "build", "--group", "Bulk", "--jobs", "2"])
+    assert main() == 0
+    images = sorted(argv[-2] for argv in stub_apptainer.calls("build"))
+    assert images == [str(tmp_path / "A.sif"), str(tmp_path / "B.sif")]
+    out = capfd.readouterr().out
+    assert "Model_B2" in out and "duplicate" in out and "Model_C" not in out.split("Build summary:")[1]
+    assert (log_dir / "build_Model_A.log").exists()
+
+    # second time round everything is up to date
+    assert main() == 0
+    assert len(stub_apptainer.calls("build")) == 2
+    assert "skipped" in capfd.readouterr().out
+
+
+def test_build_all_failure(tmp_path, stub_apptainer, monkeypatch, capfd):
+    monkeypatch.setenv("STUB_APPTAINER_FAIL", "B.sif")
+    conf_file = write_group_config(tmp_path)
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "--no_cache", f"--config_file={conf_file}", "build", "--all"])
+    assert main() == 1
+    assert len(stub_apptainer.calls("build")) == 3
+    summary = capfd.readouterr().out.split("Build summary:")[1]
+    assert "failed" in summary and "built" in summary
+    assert (tmp_path / "A.sif").exists() and not (tmp_path / "B.sif").exists()
+
+
+def test_build_needs_one_target(monkeypatch):
+    prog = sys.argv[0]
+    monkeypatch.setattr("sys.argv", [prog, "build", "TestContainer", "--all"])
+    with pytest.raises(SystemExit):
+        main()
+    monkeypatch.setattr("sys.argv", [prog, "build"])
+    with pytest.raises(SystemExit):
+        main()
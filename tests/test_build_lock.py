@@ -0,0 +1,90 @@
+# tests for locking images so only one process builds them at once
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+import pytest
+from build_lock import STALE_SECONDS, BuildLock, BuildLockTimeout, lock_path
+
+RUN_CONTAINER = Path(__file__).parents[1] / "run_container.py"
+
+
+def test_concurrent_builds(tmp_path, stub_apptainer):
+    '''
+    start several builds of the same model at once and check that
+    only one of them actually runs apptainer build.
+    '''
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Lock_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'Lock_Test.sif'}'\n"
+    )
+    (tmp_path / "logs").mkdir()
+    env = dict(os.environ, STUB_APPTAINER_BUILD_SECONDS="1")
+    procs = [
+        subprocess.Popen(
+            [sys.executable, str(RUN_CONTAINER), "--no_cache", f"--config_file={conf_file}", "build", "Lock_Test"],
+            cwd=tmp_path,
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for I in range(3)
+    ]
+    outputs = [proc.communicate(timeout=60)[0] for proc in procs]
+    assert [proc.returncode for proc in procs] == [0, 0, 0]
+    assert len(stub_apptainer.calls("build")) == 1
+    assert sum("reusing it" in out for out in outputs) == 2
+    assert not lock_path(tmp_path / "Lock_Test.sif").exists()
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_stale_lock(tmp_path):
+    # lock left behind by a process that is no longer running
+    image = tmp_path / "test.sif"
+    lock_path(image).write_text(json.dumps({"pid": dead_pid(), "host": socket.gethostname(), "started": 0}))
+    with BuildLock(image, timeout=5) as lock:
+        assert not lock.waited
+        assert json.loads(lock_path(image).read_text())["pid"] == os.getpid()
+    assert not lock_path(image).exists()
+
+
+def test_stale_lock_other_host(tmp_path, monkeypatch):
+    image = tmp_path / "test.sif"
+    lock_path(image).write_text(json.dumps({"pid": 1, "host": "some-other-node", "started": 0}))
+    with pytest.raises(BuildLockTimeout):
+        BuildLock(image, timeout=0.1).acquire()
+    # once it is old enough it is treated as stale
+    monkeypatch.setattr("build_lock.STALE_SECONDS", 0)
+    with BuildLock(image, timeout=5) as lock:
+        assert lock_path(image).exists()
+
+
+@pytest.mark.parametrize("text", ["", '{"pid": 12'])
+def test_unreadable_lock(tmp_path, monkeypatch, text):
+    # lock left behind by a process that died before it finished writing it
+    image = tmp_path / "test.sif"
+    lock_path(image).write_text(text)
+    # it may still be being written, so wait while it is new
+    with pytest.raises(BuildLockTimeout):
+        BuildLock(image, timeout=0.1).acquire()
+    old = time.time() - 2 * STALE_SECONDS
+    os.utime(lock_path(image), (old, old))
+    with BuildLock(image, timeout=5) as lock:
+        assert json.loads(lock_path(image).read_text())["pid"] == os.getpid()
+    assert not lock_path(image).exists()
+
+
+def test_live_lock_waits(tmp_path):
+    image = tmp_path / "test.sif"
+    with BuildLock(image):
+        with pytest.raises(BuildLockTimeout):
+            BuildLock(image, timeout=0.1).acquire()
@@ -0,0 +1,74 @@
+# tests for the cache of parsed config files
+import pytest
+import shutil
+import yaml
+from check_yaml import DuplicateKeyError
+from config_cache import ConfigCache
+from run_container import load_container_config_file
+
+
+def setup_configs(tmp_path):
+    # copy some valid config files into a temporary directory
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    shutil.copy("tests/test_configs/valid.yaml", conf_dir / "valid.yaml")
+    shutil.copy("tests/test_configs/multiple_files_test/valid2.yaml", conf_dir / "valid2.yaml")
+    return conf_dir
+
+
+def no_yaml(*args, **kwargs):
+    raise AssertionError("yaml file was parsed when it should have come from the cache")
+
+
+def test_warm_cache_skips_yaml(tmp_path, monkeypatch):
+    '''
+    check that a warm load does not parse any yaml at all
+    '''
+    conf_dir = setup_configs(tmp_path)
+    cache_file = tmp_path / "cache.json"
+    cold = load_container_config_file(conf_dir, ConfigCache(cache_file))
+    assert cache_file.exists()
+
+    monkeypatch.setattr(yaml, "load", no_yaml)
+    cache = ConfigCache(cache_file)
+    warm = load_container_config_file(conf_dir, cache)
+    assert warm == cold
+    assert cache.hits == 2 and cache.misses == 0
+
+
+def test_changed_file_is_reparsed(tmp_path):
+    '''
+    check that only the file that has changed is re-parsed
+    '''
+    conf_dir = setup_configs(tmp_path)
+    cache_file = tmp_path / "cache.json"
+    load_container_config_file(conf_dir, ConfigCache(cache_file))
+
+    with open(conf_dir / "valid2.yaml", "a") as file:
+        file.write("\n  group: Changed\n")
+    cache = ConfigCache(cache_file)
+    Containers = load_container_config_file(conf_dir, cache)
+    assert Containers["Example_Model2"].group == "Changed"
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_rebuild_cache(tmp_path):
+    conf_dir = setup_configs(tmp_path)
+    cache_file = tmp_path / "cache.json"
+    load_container_config_file(conf_dir, ConfigCache(cache_file))
+    cache = ConfigCache(cache_file, rebuild=True)
+    load_container_config_file(conf_dir, cache)
+    assert cache.hits == 0 and cache.misses == 2
+
+
+def test_cache_duplicate_names(tmp_path):
+    '''
+    check duplicate model names across files are still caught
+    when the configs come from the cache
+    '''
+    conf_dir = setup_configs(tmp_path)
+    cache_file = tmp_path / "cache.json"
+    load_container_config_file(conf_dir, ConfigCache(cache_file))
+    shutil.copy(conf_dir / "valid.yaml", conf_dir / "copy.yaml")
+    with pytest.raises(DuplicateKeyError):
+        load_container_config_file(conf_dir, ConfigCache(cache_file))
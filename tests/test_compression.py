@@ -0,0 +1,79 @@
+# tests for choosing the compression of sif images and benchmarking it
+import pytest
+from build_manifest import read_manifest
+from compression import parse_compression, mksquashfs_args
+
+
+@pytest.fixture
+def compression_config(tmp_path):
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Zstd_Test:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Zstd_Test.sif'}'\n  compression: zstd\n  compression_level: 3\n"
+        f"Default_Test:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Default_Test.sif'}'\n"
+    )
+    return conf_file
+
+
+def test_parse_compression():
+    assert parse_compression("zstd:3") == ("zstd", 3)
+    assert parse_compression("lz4") == ("lz4", 0)
+    assert mksquashfs_args("zstd", 3) == ["--mksquashfs-args", "-comp zstd -Xcompression-level 3"]
+    assert mksquashfs_args("", 0) == []
+    for spec in ["zip", "zstd:23", "lz4:1", "gzip:fast", ":3"]:
+        with pytest.raises(ValueError):
+            parse_compression(spec)
+
+
+def test_invalid_config(tmp_path, run):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("Bad_Test:\n  description: 'test'\n  compression: xz\n  compression_level: 5\n")
+    with pytest.raises(ValueError, match="does not take a compression_level"):
+        run(conf_file, "list")
+
+
+def test_build_compression(compression_config, stub_apptainer, tmp_path, capfd, run):
+    assert run(compression_config, "build", "Zstd_Test") == 0
+    assert stub_apptainer.calls("build")[-1][1:4] == ["--force", "--mksquashfs-args", "-comp zstd -Xcompression-level 3"]
+    assert read_manifest(tmp_path / "Zstd_Test.sif")["compression"] == "zstd-3"
+    # changing the compression on the command line needs a rebuild
+    assert run(compression_config, "build", "Zstd_Test", "--compression=lz4") == 0
+    assert len(stub_apptainer.calls("build")) == 2
+    assert read_manifest(tmp_path / "Zstd_Test.sif")["compression"] == "lz4"
+
+    capfd.readouterr()
+    assert run(compression_config, "list", "--show_compression") == 0
+    out = capfd.readouterr().out
+    assert "Zstd_Test    None   lz4   test" in out
+    assert "Default_Test    None   -   test" in out
+    # the manifests are only read when asked for
+    assert run(compression_config, "list") == 0
+    assert "Zstd_Test    None   test" in capfd.readouterr().out
+
+    with pytest.raises(SystemExit):
+        run(compression_config, "build", "Zstd_Test", "--compression=zstd:99")
+
+
+def test_benchmark(compression_config, stub_apptainer, tmp_path, monkeypatch, capfd, run):
+    assert run(compression_config, "benchmark", "Default_Test",
+               "--compressions", "gzip", "zstd:3", "--repeats=2") == 0
+    builds = stub_apptainer.calls("build")
+    assert [argv[-2] for argv in builds] == [
+        str(tmp_path / "Default_Test.gzip.sif"), str(tmp_path / "Default_Test.zstd-3.sif")
+    ]
+    assert len(stub_apptainer.calls("exec")) == 4
+    out = capfd.readouterr().out
+    assert "gzip" in out and "zstd-3" in out
+    # the images are removed unless --keep is given
+    assert list(tmp_path.glob("Default_Test.*")) == []
+
+    assert run(compression_config, "benchmark", "Default_Test",
+               "--compressions", "none", "--repeats=1", "--keep") == 0
+    assert read_manifest(tmp_path / "Default_Test.none.sif")["compression"] == "none"
+
+    monkeypatch.setenv("STUB_APPTAINER_FAIL", "lz4")
+    assert run(compression_config, "benchmark", "Default_Test",
+               "--compressions", "lz4", "--repeats=1") == 1
@@ -3,10 +3,10 @@ import pytest
 import sys
 from dacite import exceptions
 from check_yaml import DuplicateKeyError
-from run_container import format_command
+from run_container import format_command, command_string
 
 sys.path.append("../")
-from run_container import load_container_config_file, check_container_config
+from run_container import load_container_config_file, check_container_config, check_container_paths
 
 
 def test_config_not_exist():
@@ -38,11 +38,11 @@ def test_invaild_model_name():
 
 def test_no_shared_dir():
     with pytest.raises(FileNotFoundError):
-        load_container_config_file("tests/test_configs/test4.yaml")
+        load_container_config_file("tests/test_configs/test4.yaml", deep=True)
 
 def test_shared_dir_is_file():
     with pytest.raises(FileNotFoundError):
-        load_container_config_file("tests/test_configs/test4b.yaml")
+        load_container_config_file("tests/test_configs/test4b.yaml", deep=True)
 
 def test_multi_definition_1():
     load_container_config_file("tests/test_configs/test5.yaml")
@@ -64,19 +64,71 @@ def test_format_command():
     test to check function that creates Apptainer commands
     '''
     valid_commands = [
-        "apptainer exec Images/Example_Model1.sif hostname",
-        "apptainer build Images/Example_Model1.sif docker://alpine:latest",
-        "apptainer instance start Images/Example_Model1.sif Test",
-        "apptainer instance stop Test"
+        ["apptainer", "exec", "Images/Example_Model1.sif", "hostname"],
+        ["apptainer", "build", "--force", "Images/Example_Model1.sif", "docker://alpine:latest"],
+        ["apptainer", "instance", "start", "Images/Example_Model1.sif", "Test"],
+        ["apptainer", "instance", "stop", "Test"]
     ]
 
     Containers = load_container_config_file("tests/test_configs/valid.yaml")
     for I,operation in enumerate(['run','build','start','stop']):
         Apptainer_command = format_command(operation,"Test",Containers['Example_Model1'],["hostname"])
-        assert Apptainer_command in valid_commands
+        assert Apptainer_command == valid_commands[I]
+
+def test_format_command_keeps_arguments():
+    # arguments with spaces or shell characters are passed through unchanged
+    Containers = load_container_config_file("tests/test_configs/valid.yaml")
+    cmd = ["echo", "hello world", "$HOME;", "|"]
+    Apptainer_command = format_command("run","Test",Containers['Example_Model1'],cmd)
+    assert Apptainer_command[-4:] == cmd
+    assert command_string(Apptainer_command) == \
+        "apptainer exec Images/Example_Model1.sif echo 'hello world' '$HOME;' '|'"
 
 def test_run_with_no_image():
     # this checks that running with an image file that does not exist raises a FileNotFoundError
     with pytest.raises(FileNotFoundError):
         Containers = load_container_config_file("tests/test_configs/test8.yaml")
         format_command('run',"Test",Containers['Example_Model1'],["hostname"])
+
+def test_shared_dir_not_checked_on_load():
+    # filesystem checks are deferred so loading should work
+    Containers = load_container_config_file("tests/test_configs/test4.yaml")
+    assert Containers["Example_Model2"].shared_directories == "/path/does/not/exist"
+
+def test_no_definition_file():
+    Containers = load_container_config_file("tests/test_configs/test10.yaml")
+    assert Containers["Example_Model1"].container_definition == "Definitions/does_not_exist.def"
+    with pytest.raises(FileNotFoundError):
+        check_container_paths("Example_Model1", Containers["Example_Model1"])
+    # definition is only checked if asked for
+    check_container_paths("Example_Model1", Containers["Example_Model1"], definition=False)
+
+def test_fast_loader_line_numbers():
+    # both yaml loaders should give the same error message
+    import yaml
+    from check_yaml import DuplicateKeyDetector, FastDuplicateKeyDetector
+    messages = []
+    for Loader in [DuplicateKeyDetector, FastDuplicateKeyDetector]:
+        with open("tests/test_configs/test6.yaml") as file:
+            with pytest.raises(DuplicateKeyError) as err:
+                yaml.load(file, Loader=Loader)
+        messages.append(str(err.value))
+    assert messages[0] == messages[1] == "Duplicate key found: 'Example_Model1' at line 12"
+
+def test_parallel_parse(monkeypatch):
+    '''
+    check parsing config files in worker processes gives the
+    same result (and errors) as parsing them one at a time.
+    '''
+    import run_container
+    from run_container import load_config_files, find_config_files
+    config_files = find_config_files("tests/test_configs/")
+    serial = load_config_files(config_files, workers=1)
+    monkeypatch.setattr(run_container, "PARALLEL_PARSE_MIN_FILES", 2)
+    parallel = load_config_files(config_files, workers=2)
+    assert [f for f, _ in serial] == [f for f, _ in parallel] == config_files
+    for (_, a), (_, b) in zip(serial, parallel):
+        if isinstance(a, Exception):
+            assert type(a) == type(b) and str(a) == str(b)
+        else:
+            assert a == b
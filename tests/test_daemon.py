@@ -0,0 +1,153 @@
+# tests for the serve daemon and its thin client
+import asyncio
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import pytest
+import daemon
+from daemon import ContainerDaemon
+from image_store import load_records, record_eviction
+from run_container import main
+
+
+@pytest.fixture
+def running_daemon(tmp_path, monkeypatch):
+    '''
+    run a daemon in a background thread serving a copy of the test configs
+    '''
+    monkeypatch.setattr(daemon, "WATCH_SECONDS", 0.05)
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    shutil.copy("tests/test_configs/valid.yaml", conf_dir)
+    (tmp_path / "Daemon_Test.sif").write_text("stub image")
+    (conf_dir / "daemon.yaml").write_text(
+        f"Daemon_Test:\n  description: 'served by the daemon'\n  group: Daemon\n"
+        f"  container_definition: 'alpine:latest'\n  image_file: '{tmp_path / 'Daemon_Test.sif'}'\n"
+        f"Pinned_Test:\n  description: 'pinned'\n  group: Daemon\n  numa_node: '0'\n"
+        f"  container_definition: 'alpine:latest'\n  image_file: '{tmp_path / 'Daemon_Test.sif'}'\n"
+    )
+    sock = tmp_path / "daemon.sock"
+    monkeypatch.setenv("BEDE_CONTAINERS_SOCKET", str(sock))
+    server = ContainerDaemon(conf_dir, sock)
+    thread = threading.Thread(target=asyncio.run, args=(server.run(),), daemon=True)
+    thread.start()
+    for I in range(100):
+        if sock.exists():
+            break
+        time.sleep(0.05)
+    yield server, conf_dir
+    server.stop()
+    thread.join(timeout=5)
+
+
+def call(monkeypatch, conf_dir, *args):
+    monkeypatch.setattr("sys.argv", [sys.argv[0], f"--config_file={conf_dir}", *args])
+    return main()
+
+
+def test_daemon_list(running_daemon, monkeypatch, capfd):
+    server, conf_dir = running_daemon
+    assert call(monkeypatch, conf_dir, "list") == 0
+    assert server.requests == 1
+    out = capfd.readouterr().out
+    assert "Daemon_Test    Daemon   served by the daemon" in out
+    assert "Example_Model1" in out
+
+    # output is the same as without the daemon
+    call(monkeypatch, conf_dir, "--no_daemon", "list")
+    assert server.requests == 1
+    assert capfd.readouterr().out == out
+
+
+def test_daemon_run_start_stop(running_daemon, stub_apptainer, monkeypatch):
+    server, conf_dir = running_daemon
+    assert call(monkeypatch, conf_dir, "run", "Daemon_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][1].endswith("Daemon_Test.sif")
+    assert call(monkeypatch, conf_dir, "start", "Daemon_Test") == 0
+    assert "Daemon_Test" in server.instances
+    # the daemon knows the instance is running without asking apptainer
+    n_calls = len(stub_apptainer.calls())
+    assert call(monkeypatch, conf_dir, "run", "Daemon_Test", "true") == 0
+    assert stub_apptainer.calls()[n_calls:] == [["exec", "instance://Daemon_Test", "true"]]
+    assert call(monkeypatch, conf_dir, "stop", "Daemon_Test") == 0
+    assert server.instances == {}
+    assert server.requests == 4
+
+
+def test_daemon_errors_and_fallback(running_daemon, monkeypatch, capfd):
+    server, conf_dir = running_daemon
+    assert call(monkeypatch, conf_dir, "run", "Not_A_Model", "true") == 1
+    assert "no model named Not_A_Model" in capfd.readouterr().err
+    # validate is not handled by the daemon so runs as normal
+    assert call(monkeypatch, conf_dir, "validate") == 0
+    assert server.requests == 2
+
+
+def test_daemon_reloads_configs(running_daemon, monkeypatch, capfd):
+    server, conf_dir = running_daemon
+    shutil.copy("tests/test_configs/multiple_files_test/valid2.yaml", conf_dir)
+    for I in range(100):
+        if "Example_Model2" in server.Containers:
+            break
+        time.sleep(0.05)
+    assert call(monkeypatch, conf_dir, "list") == 0
+    assert "Example_Model2" in capfd.readouterr().out
+
+
+def test_daemon_metrics(running_daemon, stub_apptainer, tmp_path, monkeypatch):
+    server, conf_dir = running_daemon
+    metrics_path = tmp_path / "m.jsonl"
+    assert call(monkeypatch, conf_dir, f"--metrics={metrics_path}", "run", "Daemon_Test", "true") == 0
+    assert server.requests == 1
+    record = json.loads(metrics_path.read_text())
+    assert record["daemon"] is True
+    assert record["model"] == "Daemon_Test" and record["operation"] == "run"
+    assert set(record["phases"]) == {"daemon", "container"}
+
+
+def test_daemon_evicted_image(running_daemon, stub_apptainer, tmp_path, monkeypatch):
+    server, conf_dir = running_daemon
+    assert call(monkeypatch, conf_dir, "run", "Daemon_Test", "true") == 0
+    assert load_records(tmp_path / "images.sqlite")[str(tmp_path / "Daemon_Test.sif")]["evicted"] is None
+    (tmp_path / "Daemon_Test.sif").unlink()
+    record_eviction(tmp_path / "images.sqlite", tmp_path / "Daemon_Test.sif", "Daemon_Test")
+    # the client rebuilds the image itself
+    assert call(monkeypatch, conf_dir, "run", "Daemon_Test", "true") == 0
+    assert stub_apptainer.calls("build")[-1][-2:] == [str(tmp_path / "Daemon_Test.sif"), "docker://alpine:latest"]
+    assert server.requests == 2
+
+
+def test_daemon_instance_stopped_elsewhere(running_daemon, stub_apptainer, monkeypatch):
+    server, conf_dir = running_daemon
+    assert call(monkeypatch, conf_dir, "start", "Daemon_Test") == 0
+    assert server.instances["Daemon_Test"]["pid"]
+    # e.g. the idle watcher stops it, without the daemon hearing about it
+    assert call(monkeypatch, conf_dir, "--no_daemon", "stop", "Daemon_Test") == 0
+    assert "Daemon_Test" in server.instances
+    # so it runs in a new container rather than the instance that is gone
+    assert call(monkeypatch, conf_dir, "run", "Daemon_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][1].endswith("Daemon_Test.sif")
+    assert server.instances == {}
+    assert server.requests == 2
+
+
+def test_daemon_client_environment(running_daemon, tmp_path):
+    '''
+    the daemon plans commands with its own environment and cpus, so it
+    leaves requests from a client whose differ to the client
+    '''
+    server, conf_dir = running_daemon
+    env = {key: os.environ.get(key, "") for key in daemon.PLAN_ENV_VARS}
+    assert "command" in server.plan(["run", "Daemon_Test", "true"], server.cwd, env, server.cpus)
+    other_env = dict(env, BEDE_CONTAINERS_HISTORY=str(tmp_path / "other.sqlite"))
+    assert server.plan(["run", "Daemon_Test", "true"], server.cwd, other_env, server.cpus).get("fallback")
+
+    # e.g. a slurm job step only allowed some of the cpus
+    assert "command" in server.plan(["run", "Pinned_Test", "true"], server.cwd, env, server.cpus)
+    other_cpus = server.cpus[:1] + [max(server.cpus) + 1]
+    assert server.plan(["run", "Pinned_Test", "true"], server.cwd, env, other_cpus).get("fallback")
+    # which doesn't matter if the container is not pinned to a NUMA node
+    assert "command" in server.plan(["run", "Daemon_Test", "true"], server.cwd, env, other_cpus)
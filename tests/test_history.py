@@ -0,0 +1,92 @@
+# tests for the history of resources used by each run and the stats operation
+import os
+import signal
+import sys
+import threading
+import pytest
+from history import run_with_rusage, record_run, load_runs, percentile, run_stats
+
+
+@pytest.fixture
+def stats_config(tmp_path):
+    lines = []
+    for name, group in [("Stats_A", "Stats"), ("Stats_B", "Stats"), ("Stats_C", "Other")]:
+        (tmp_path / f"{name}.sif").write_text("stub image")
+        lines.append(
+            f"{name}:\n  description: 'test'\n  group: {group}\n  container_definition: 'alpine:latest'\n"
+            f"  image_file: '{tmp_path / f'{name}.sif'}'\n"
+        )
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("".join(lines))
+    return conf_file
+
+
+def test_rusage():
+    returncode, usage = run_with_rusage(
+        [sys.executable, "-c", "import sys; x = bytearray(64 * 1024 * 1024); sys.exit(4)"]
+    )
+    assert returncode == 4
+    assert usage["max_rss_kb"] >= 64 * 1024
+    assert usage["wall_seconds"] >= usage["user_seconds"] > 0
+
+
+def test_signals_are_forwarded():
+    # a SIGTERM sent to us while waiting should end up at the container
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    returncode, usage = run_with_rusage(["sleep", "10"])
+    timer.join()
+    assert returncode == -signal.SIGTERM
+    assert usage["wall_seconds"] < 10
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([1, 2, 3, 4], 100) == 4
+    assert percentile([5], 99) == 5
+
+
+def test_record_and_load(history_file):
+    assert load_runs(str(history_file)) == {}
+    for I in range(10):
+        usage = {"wall_seconds": 2.0, "user_seconds": 1.0 + I, "sys_seconds": 1.0,
+                 "max_rss_kb": 1024 * (I + 1), "major_faults": 0}
+        record_run(str(history_file), "Model_A" if I % 2 else "Model_B", "run", I % 3, usage)
+    runs = load_runs(str(history_file), ["Model_A"])
+    assert list(runs) == ["Model_A"] and len(runs["Model_A"]) == 5
+    stats = run_stats(runs["Model_A"])
+    assert stats["Peak memory (MB)"]["max"] == 10
+    assert stats["Peak memory (MB)"]["p50"] == 6
+    assert stats["CPU usage (cores)"]["p50"] == 3.5
+
+
+def test_record_failure_is_logged(tmp_path, caplog):
+    '''
+    check a history that can't be written is logged rather than raised
+    '''
+    (tmp_path / "not_a_dir").write_text("")
+    usage = {"wall_seconds": 1.0, "user_seconds": 1.0, "sys_seconds": 0.0, "max_rss_kb": 1024, "major_faults": 0}
+    record_run(str(tmp_path / "not_a_dir" / "history.sqlite"), "Model_A", "run", 0, usage)
+    assert "Could not record history" in caplog.text
+
+
+def test_stats(stats_config, stub_apptainer, history_file, capfd, run):
+    assert run(stats_config, "run", "--cold", "Stats_A", "true") == 0
+    assert run(stats_config, "run", "--cold", "Stats_A", "false") == 1
+    assert run(stats_config, "run", "--cold", "Stats_C", "true") == 0
+    assert run(stats_config, "--no_history", "run", "--cold", "Stats_B", "true") == 0
+    runs = load_runs(str(history_file))
+    assert sorted(runs) == ["Stats_A", "Stats_C"]
+    assert [run["returncode"] for run in runs["Stats_A"]] == [0, 1]
+    capfd.readouterr()
+
+    assert run(stats_config, "stats", "--group", "Stats") == 0
+    out = capfd.readouterr().out
+    assert "Stats_A: 2 runs, 1 failed" in out
+    assert "Peak memory (MB)" in out
+    assert "Stats_C" not in out
+
+    assert run(stats_config, "stats", "Stats_C") == 0
+    out = capfd.readouterr().out
+    assert "Stats_C: 1 runs, 0 failed" in out and "Stats_A" not in out
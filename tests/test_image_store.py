@@ -0,0 +1,108 @@
+# tests for keeping the images under a quota by removing the least recently used
+import pytest
+from image_store import StoredImage, parse_size, plan_eviction, load_records, record_use
+from run_container import ContainerRegistry, find_config_files, store_images
+
+
+@pytest.fixture
+def store_config(tmp_path):
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("".join(
+        f"{name}:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / f'{name}.sif'}'\n  pinned: {'true' if name == 'Pinned' else 'false'}\n"
+        for name in ["Model_A", "Model_B", "Pinned"]
+    ))
+    return conf_file
+
+
+def test_parse_size():
+    assert parse_size("1024") == 1024
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5G") == 3 * 2**29
+    assert parse_size("500GiB") == 500 * 2**30
+    for size in ["lots", "-1G", ""]:
+        with pytest.raises(ValueError):
+            parse_size(size)
+
+
+def test_plan_eviction():
+    images = [
+        StoredImage("old", "old.sif", 10, last_used=1.0),
+        StoredImage("pinned", "pinned.sif", 10, last_used=0.0, pinned=True),
+        StoredImage("in_use", "in_use.sif", 10, last_used=0.5, in_use=True),
+        StoredImage("new", "new.sif", 10, last_used=3.0),
+        StoredImage("middle", "middle.sif", 10, last_used=2.0),
+        StoredImage("missing", "missing.sif", None, last_used=0.1),
+    ]
+    assert [image.model_name for image in plan_eviction(images, 30)] == ["old", "middle"]
+    assert plan_eviction(images, 50) == []
+    # pinned and in use images are kept even if that leaves us over the quota
+    assert [image.model_name for image in plan_eviction(images, 0)] == ["old", "middle", "new"]
+
+
+def test_prune_and_rebuild(store_config, stub_apptainer, tmp_path, capfd, run):
+    assert run(store_config, "build", "--all") == 0
+    size = (tmp_path / "Model_A.sif").stat().st_size
+    # Model_A is used after Model_B was built so Model_B is the least recently used
+    assert run(store_config, "run", "--cold", "Model_A", "true") == 0
+
+    assert run(store_config, "prune", f"--quota={2 * size}", "--dry_run") == 0
+    assert "Would remove" in capfd.readouterr().out
+    assert (tmp_path / "Model_B.sif").exists()
+    assert run(store_config, "prune", f"--quota={2 * size}") == 0
+    assert not (tmp_path / "Model_B.sif").exists()
+    assert not (tmp_path / "Model_B.sif.manifest.json").exists()
+    assert (tmp_path / "Model_A.sif").exists() and (tmp_path / "Pinned.sif").exists()
+
+    capfd.readouterr()
+    assert run(store_config, "images") == 0
+    out = capfd.readouterr().out
+    assert [line.split()[-1] for line in out.splitlines() if line.startswith("Model_B")] == ["evicted"]
+
+    # running an evicted image rebuilds it
+    n_builds = len(stub_apptainer.calls("build"))
+    assert run(store_config, "run", "--cold", "Model_B", "true") == 0
+    assert len(stub_apptainer.calls("build")) == n_builds + 1
+    assert (tmp_path / "Model_B.sif").exists()
+    record = load_records(tmp_path / "images.sqlite")[str(tmp_path / "Model_B.sif")]
+    assert record["evicted"] is None
+
+    # images that were never built are not rebuilt by run
+    (tmp_path / "Pinned.sif").unlink()
+    with pytest.raises(FileNotFoundError):
+        run(store_config, "run", "--cold", "Pinned", "true")
+
+    # pinned images are kept even if they are over the quota on their own
+    assert run(store_config, "build", "Pinned") == 0
+    assert run(store_config, "prune", "--quota=0") == 1
+    assert (tmp_path / "Pinned.sif").exists()
+    assert not (tmp_path / "Model_A.sif").exists()
+
+
+def test_build_quota(store_config, stub_apptainer, tmp_path, monkeypatch, run):
+    monkeypatch.setenv("BEDE_CONTAINERS_IMAGE_QUOTA", "1")
+    assert run(store_config, "build", "Model_A") == 0
+    # the image that was just built is kept
+    assert (tmp_path / "Model_A.sif").exists()
+    assert run(store_config, "build", "Model_B") == 0
+    assert (tmp_path / "Model_B.sif").exists()
+    assert not (tmp_path / "Model_A.sif").exists()
+
+
+def test_store_images_only_loads_stored(store_config, tmp_path):
+    '''
+    only the config files of containers whose images are in the store are
+    parsed to enforce the quota
+    '''
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    store_config.rename(conf_dir / "conf.yaml")
+    (conf_dir / "other.yaml").write_text("Other:\n  description: 'test'\n  container_definition: 'alpine:latest'\n")
+    Containers = ContainerRegistry(find_config_files(conf_dir))
+    (tmp_path / "Model_A.sif").write_text("image")
+    record_use(str(tmp_path / "images.sqlite"), tmp_path / "Model_A.sif", "Model_A")
+    images = store_images(Containers, str(tmp_path / "images.sqlite"))
+    assert [image.model_name for image in images] == ["Model_A"]
+    assert "Other" not in Containers._loaded
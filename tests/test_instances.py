@@ -0,0 +1,123 @@
+# tests for running commands in warm (already running) instances
+import sys
+import time
+import pytest
+from instances import running_instances, read_state, record_start
+from run_container import main
+
+
+@pytest.fixture
+def warm_config(tmp_path):
+    '''
+    config for a model with an (empty) image that the stub apptainer can use
+    '''
+    image = tmp_path / "Warm_Test.sif"
+    image.write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Warm_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n"
+    )
+    return conf_file
+
+
+def test_run_without_instance(warm_config, stub_apptainer, run):
+    assert run(warm_config, "run", "Warm_Test", "hostname") == 0
+    [call] = stub_apptainer.calls("exec")
+    assert call[1].endswith("Warm_Test.sif")
+    # with no record of an instance apptainer is not asked for one
+    assert stub_apptainer.calls("instance") == []
+
+
+def test_run_with_stale_record(warm_config, stub_apptainer, run):
+    '''
+    check a record of an instance that has since stopped is removed
+    '''
+    record_start("Warm_Test", "Warm_Test.sif")
+    assert run(warm_config, "run", "Warm_Test", "hostname") == 0
+    assert stub_apptainer.calls("exec")[-1][1].endswith("Warm_Test.sif")
+    assert read_state("Warm_Test") is None
+    assert run(warm_config, "run", "Warm_Test", "hostname") == 0
+    assert len(stub_apptainer.calls("instance")) == 1
+
+
+def test_run_uses_running_instance(warm_config, stub_apptainer, run):
+    assert run(warm_config, "start", "Warm_Test") == 0
+    assert "Warm_Test" in running_instances()
+    assert read_state("Warm_Test")["started"] is not None
+
+    assert run(warm_config, "run", "Warm_Test", "hostname") == 0
+    assert stub_apptainer.calls("exec")[-1][:2] == ["exec", "instance://Warm_Test"]
+    # --cold ignores the instance
+    assert run(warm_config, "run", "--cold", "Warm_Test", "hostname") == 0
+    assert stub_apptainer.calls("exec")[-1][1].endswith("Warm_Test.sif")
+
+    assert run(warm_config, "stop", "Warm_Test") == 0
+    assert running_instances() == {}
+    assert read_state("Warm_Test") is None
+
+
+def test_warm_run_starts_and_reaps(warm_config, stub_apptainer, run):
+    '''
+    check run --warm starts an instance which is then stopped once idle
+    '''
+    assert run(warm_config, "run", "--warm", "--idle_timeout", "0.01", "Warm_Test", "hostname") == 0
+    assert len(stub_apptainer.calls("instance")) >= 2
+    assert stub_apptainer.calls("exec")[-1][:2] == ["exec", "instance://Warm_Test"]
+
+    # idle timeout is 0.6s so the watcher should stop it soon
+    for I in range(100):
+        if "Warm_Test" not in running_instances():
+            break
+        time.sleep(0.1)
+    assert "Warm_Test" not in running_instances()
+    assert read_state("Warm_Test") is None
+
+
+@pytest.fixture
+def group_config(tmp_path):
+    lines = []
+    for name, group in [("Inst_A", "Grp"), ("Inst_B", "Grp"), ("Inst_C", "Other")]:
+        (tmp_path / f"{name}.sif").write_text("stub image")
+        lines.append(
+            f"{name}:\n  description: 'test'\n  group: {group}\n  container_definition: 'alpine:latest'\n"
+            f"  image_file: '{tmp_path / name}.sif'\n"
+        )
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("".join(lines))
+    return conf_file
+
+
+def test_start_all_stop_group(group_config, stub_apptainer, capfd, run):
+    assert run(group_config, "start", "--all") == 0
+    assert sorted(running_instances()) == ["Inst_A", "Inst_B", "Inst_C"]
+    assert read_state("Inst_A")["pid"] is not None
+    # starting again skips everything that is already running
+    n_starts = len([argv for argv in stub_apptainer.calls("instance") if argv[1] == "start"])
+    assert run(group_config, "start", "--group", "Grp") == 0
+    assert n_starts == len([argv for argv in stub_apptainer.calls("instance") if argv[1] == "start"]) == 3
+    assert "already running" in capfd.readouterr().out
+
+    assert run(group_config, "stop", "--group", "Grp") == 0
+    assert sorted(running_instances()) == ["Inst_C"]
+    assert read_state("Inst_A") is None and read_state("Inst_C") is not None
+
+
+def test_status_and_reap(group_config, stub_apptainer, monkeypatch, capfd, run):
+    from instances import write_state
+    assert run(group_config, "start", "--all") == 0
+    capfd.readouterr()
+    # pretend Inst_B was last used an hour ago
+    state = read_state("Inst_B")
+    state["last_used"] -= 3600
+    write_state("Inst_B", state)
+
+    monkeypatch.setattr("sys.argv", [sys.argv[0], "status"])
+    assert main() == 0
+    out = capfd.readouterr().out
+    assert all(name in out for name in ["Inst_A", "Inst_B", "Inst_C"])
+
+    monkeypatch.setattr("sys.argv", [sys.argv[0], "reap", "--idle", "30"])
+    assert main() == 0
+    assert sorted(running_instances()) == ["Inst_A", "Inst_C"]
+    assert read_state("Inst_B") is None
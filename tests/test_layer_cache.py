@@ -0,0 +1,77 @@
+# tests for the layer cache shared between builds
+import os
+import stat
+import time
+import pytest
+from layer_cache import BLOB_DIR, CacheLock, cache_stats, load_builds
+
+
+@pytest.fixture
+def cache_config(tmp_path):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("".join(
+        f"{name}:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / f'{name}.sif'}'\n  layer_cache: '{tmp_path / 'layers'}'\n"
+        for name, definition in [("Ubuntu_A", "ubuntu:24.04"), ("Ubuntu_B", "ubuntu:24.04"), ("Alpine", "alpine:3.20")]
+    ))
+    return conf_file
+
+
+def test_shared_cache(cache_config, stub_apptainer, tmp_path, capfd, run):
+    layers = tmp_path / "layers"
+    for model in ["Ubuntu_A", "Ubuntu_B", "Alpine"]:
+        assert run(cache_config, "build", model) == 0
+    assert stat.S_IMODE(layers.stat().st_mode) == 0o2775
+    # the first build downloads the base layer, the second one needs nothing new
+    assert [build["new_layers"] for build in load_builds(layers)] == [2, 0, 1]
+    stats = cache_stats(layers)
+    assert stats["layers"] == 3 and stats["builds"] == 3 and stats["hits"] == 1
+    assert stats["reclaimable_bytes"] == 0
+
+    capfd.readouterr()
+    assert run(cache_config, "cache", "stats") == 0
+    out = capfd.readouterr().out
+    assert str(layers) in out and "33% of 3 builds" in out
+
+    # nothing has been unused for long enough to prune
+    assert run(cache_config, "cache", "prune") == 0
+    assert cache_stats(layers)["layers"] == 3
+    # only old layers are pruned, never the OCI layout metadata or the
+    # sif files apptainer has converted from images
+    old = time.time() - 40 * 86400
+    (layers / "cache" / "oci-tmp").mkdir()
+    (layers / "cache" / "oci-tmp" / "converted").write_text("sif converted from an image")
+    for P in [*(layers / BLOB_DIR).iterdir(), layers / "cache" / "blob" / "index.json",
+              layers / "cache" / "blob" / "oci-layout", layers / "cache" / "oci-tmp" / "converted"]:
+        os.utime(P, (old, old))
+    assert run(cache_config, "cache", "prune", "--dry_run") == 0
+    assert cache_stats(layers)["reclaimable_files"] == 3
+    assert run(cache_config, "cache", "prune") == 0
+    stats = cache_stats(layers)
+    assert stats["layers"] == 0 and stats["files"] == 3
+    assert (layers / "cache" / "blob" / "index.json").exists()
+    assert (layers / "cache" / "oci-tmp" / "converted").exists()
+
+
+def test_layer_cache_flag(tmp_path, stub_apptainer, monkeypatch, capfd, run):
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(f"Plain:\n  description: 'test'\n  container_definition: 'alpine:3.20'\n"
+                         f"  image_file: '{tmp_path / 'Plain.sif'}'\n")
+    # no layer cache so apptainer's own is used
+    assert run(conf_file, "build", "Plain") == 0
+    assert run(conf_file, "cache", "stats") == 1
+    monkeypatch.setenv("BEDE_CONTAINERS_LAYER_CACHE", str(tmp_path / "site"))
+    assert run(conf_file, "build", "--force", "Plain") == 0
+    assert len(load_builds(tmp_path / "site")) == 1
+    assert run(conf_file, f"--layer_cache={tmp_path / 'mine'}", "build", "--force", "--all") == 0
+    assert len(load_builds(tmp_path / "mine")) == 1
+
+
+def test_prune_waits_for_builds(tmp_path):
+    # prune takes an exclusive lock so can't run while a build holds the cache
+    import fcntl
+    with CacheLock(tmp_path / "layers"):
+        with open(tmp_path / "layers" / ".bede_cache.lock") as file:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
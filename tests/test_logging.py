@@ -0,0 +1,90 @@
+# tests for logging to a file per invocation through a background thread
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from log_config import LOG_PREFIX, prune_logs, setup_logging, stop_logging
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def test_concurrent_invocations(tmp_path):
+    '''
+    check invocations running at the same time each get a complete log
+    '''
+    shutil.copy("tests/test_configs/valid.yaml", tmp_path)
+    log_dir = tmp_path / "logs"
+    procs = [
+        subprocess.Popen(
+            [sys.executable, str(REPO / "run_container.py"), "--no_daemon", "--rebuild_cache",
+             f"--cache_file={tmp_path / f'cache{I}.json'}", f"--log_dir={log_dir}",
+             "--log_format=json", f"--config_file={tmp_path / 'valid.yaml'}", "list"],
+            cwd=tmp_path, stdout=subprocess.DEVNULL,
+        )
+        for I in range(8)
+    ]
+    assert [proc.wait() for proc in procs] == [0] * 8
+
+    log_files = sorted(log_dir.glob(f"{LOG_PREFIX}*.log"))
+    assert len(log_files) == 8
+    pids = set()
+    for log_file in log_files:
+        records = [json.loads(line) for line in log_file.read_text().splitlines()]
+        assert any(record["message"].startswith("Rebuilding config cache") for record in records)
+        pids |= {record["pid"] for record in records}
+    assert pids == {proc.pid for proc in procs}
+
+
+def test_records_written_on_stop(tmp_path):
+    # logging may already have been set up by other tests calling main
+    stop_logging()
+    log_file = setup_logging(str(tmp_path / "logs"), "text")
+    try:
+        assert setup_logging(str(tmp_path / "other")) == log_file
+        for I in range(1000):
+            logging.info(f"record {I}")
+    finally:
+        stop_logging()
+    lines = log_file.read_text().splitlines()
+    assert len(lines) == 1000
+    assert lines[-1].endswith("INFO - record 999")
+
+
+def test_prune_logs(tmp_path):
+    for I in range(5):
+        (tmp_path / f"{LOG_PREFIX}2024010{I}-000000_host_1.log").write_text("")
+        os.utime(tmp_path / f"{LOG_PREFIX}2024010{I}-000000_host_1.log", (0, 0))
+    (tmp_path / "build_model.log").write_text("")
+    prune_logs(tmp_path, 3)
+    assert sorted(P.name for P in tmp_path.iterdir()) == [
+        "build_model.log",
+        f"{LOG_PREFIX}20240102-000000_host_1.log",
+        f"{LOG_PREFIX}20240103-000000_host_1.log",
+        f"{LOG_PREFIX}20240104-000000_host_1.log",
+    ]
+
+
+def test_prune_logs_in_use(tmp_path):
+    this_host = socket.gethostname()
+    stopped = subprocess.Popen([sys.executable, "-c", "pass"])
+    stopped.wait()
+    names = [
+        # a long running process on this host, e.g. serve
+        f"{LOG_PREFIX}20240100-000000_{this_host}_{os.getpid()}.log",
+        f"{LOG_PREFIX}20240101-000000_{this_host}_{stopped.pid}.log",
+        # another host has written to it recently
+        f"{LOG_PREFIX}20240102-000000_other_host_1.log",
+        f"{LOG_PREFIX}20240103-000000_other_host_2.log",
+        f"{LOG_PREFIX}20240104-000000_{this_host}_{stopped.pid}.log",
+    ]
+    for name in names:
+        (tmp_path / name).write_text("")
+        os.utime(tmp_path / name, (0, 0))
+    os.utime(tmp_path / names[2], (time.time(), time.time()))
+    prune_logs(tmp_path, 1)
+    assert sorted(P.name for P in tmp_path.iterdir()) == [names[0], names[2], names[4]]
@@ -0,0 +1,74 @@
+# tests for the per invocation timing metrics
+import json
+import socket
+import pytest
+from metrics import Metrics, metrics_file
+
+
+@pytest.fixture
+def metrics_config(tmp_path, monkeypatch):
+    monkeypatch.delenv("BEDE_CONTAINERS_METRICS", raising=False)
+    image = tmp_path / "Metrics_Test.sif"
+    image.write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Metrics_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n"
+    )
+    return conf_file
+
+
+def read_records(metrics_path):
+    return [json.loads(line) for line in metrics_path.read_text().splitlines()]
+
+
+def test_metrics_file(monkeypatch):
+    monkeypatch.delenv("BEDE_CONTAINERS_METRICS", raising=False)
+    assert metrics_file(["run", "model"]) is None
+    assert metrics_file(["--metrics", "m.jsonl", "run", "model"]) == "m.jsonl"
+    assert metrics_file(["--metrics=m.jsonl", "run", "model"]) == "m.jsonl"
+    # arguments meant for the container are left alone
+    assert metrics_file(["run", "model", "--", "--metrics=m.jsonl"]) is None
+    monkeypatch.setenv("BEDE_CONTAINERS_METRICS", "env.jsonl")
+    assert metrics_file(["run", "model"]) == "env.jsonl"
+    assert metrics_file(["--metrics", "m.jsonl"]) == "m.jsonl"
+
+
+def test_spans_add_up(tmp_path):
+    metrics = Metrics(str(tmp_path / "m.jsonl"))
+    for I in range(2):
+        with metrics.span("load"):
+            pass
+    with pytest.raises(ValueError):
+        with metrics.span("check"):
+            raise ValueError("the span is still recorded")
+    assert set(metrics.phases) == {"load", "check"}
+    assert Metrics().record(0) is None
+
+
+def test_run_metrics(metrics_config, stub_apptainer, tmp_path, monkeypatch, run):
+    metrics_path = tmp_path / "metrics" / "m.jsonl"
+    assert run(metrics_config, f"--metrics={metrics_path}",
+               "run", "--cold", "Metrics_Test", "true") == 0
+    monkeypatch.setenv("BEDE_CONTAINERS_METRICS", str(metrics_path))
+    assert run(metrics_config, "run", "--cold", "Metrics_Test", "false") == 1
+
+    records = read_records(metrics_path)
+    assert len(records) == 2
+    for record, returncode in zip(records, [0, 1]):
+        assert record["model"] == "Metrics_Test"
+        assert record["operation"] == "run"
+        assert record["returncode"] == returncode
+        assert record["host"] == socket.gethostname()
+        assert set(record["phases"]) == {"load", "check", "format", "container"}
+        assert record["total"] >= sum(record["phases"].values())
+
+
+def test_error_metrics(metrics_config, tmp_path, run):
+    metrics_path = tmp_path / "m.jsonl"
+    with pytest.raises(ValueError):
+        run(metrics_config, f"--metrics={metrics_path}", "run", "Not_A_Model", "true")
+    record, = read_records(metrics_path)
+    assert record["returncode"] == 1
+    assert record["model"] == "Not_A_Model"
+    assert "no model named Not_A_Model" in record["error"]
@@ -0,0 +1,104 @@
+# tests for pulling the images of containers defined by a URI in the background
+import time
+import pytest
+from prefetch import read_status, prefetch_running
+
+
+@pytest.fixture
+def prefetch_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Docker_Test:\n  description: 'test'\n  group: Remote\n  container_definition: 'ubuntu:24.04'\n"
+        f"  image_file: '{tmp_path / 'Docker_Test.sif'}'\n"
+        f"Oras_Test:\n  description: 'test'\n  group: Remote\n  container_definition: 'oras://ghcr.io/test/image'\n"
+        f"  image_file: '{tmp_path / 'Oras_Test.sif'}'\n"
+        f"Local_Test:\n  description: 'test'\n  group: Remote\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Local_Test.sif'}'\n"
+    )
+    return conf_file
+
+
+def wait_for_prefetch(status_file, timeout=10):
+    for I in range(int(timeout / 0.05)):
+        status = read_status(status_file)
+        if status is not None and status.get("finished") is not None:
+            return status
+        time.sleep(0.05)
+    raise TimeoutError("prefetch did not finish")
+
+
+def test_prefetch_wait(prefetch_config, stub_apptainer, tmp_path, monkeypatch, capfd, run):
+    assert run(prefetch_config, "prefetch", "--group=Remote", "--wait") == 0
+    # only the remote containers are pulled
+    assert sorted(argv[-1] for argv in stub_apptainer.calls("build")) == [
+        "docker://ubuntu:24.04", "oras://ghcr.io/test/image"
+    ]
+    status = read_status(tmp_path / ".cache/prefetch.json")
+    assert {key: value["status"] for key, value in status["models"].items()} == {
+        "Docker_Test": "built", "Oras_Test": "built"
+    }
+    # they are now up to date
+    capfd.readouterr()
+    assert run(prefetch_config, "prefetch", "--all") == 0
+    assert "Nothing to prefetch" in capfd.readouterr().out
+    assert len(stub_apptainer.calls("build")) == 2
+    # --force pulls again over the existing image
+    assert run(prefetch_config, "prefetch", "Oras_Test", "--force", "--wait") == 0
+    assert len(stub_apptainer.calls("build")) == 3
+
+    monkeypatch.setenv("STUB_APPTAINER_FAIL", "Oras")
+    assert run(prefetch_config, "prefetch", "Oras_Test", "--force", "--wait") == 1
+
+
+def test_prefetch_background(prefetch_config, stub_apptainer, tmp_path, monkeypatch, capfd, run):
+    monkeypatch.setenv("STUB_APPTAINER_BUILD_SECONDS", "0.5")
+    status_file = tmp_path / "status.json"
+    start = time.perf_counter()
+    assert run(prefetch_config, "prefetch", "--all", f"--status_file={status_file}") == 0
+    # we don't wait for the pulls
+    assert time.perf_counter() - start < 0.5
+    assert prefetch_running(status_file)
+    # only one prefetch at a time
+    assert run(prefetch_config, "prefetch", "--all", f"--status_file={status_file}") == 1
+    capfd.readouterr()
+    assert run(prefetch_config, "prefetch", "--status", f"--status_file={status_file}") == 0
+    assert "Prefetch running" in capfd.readouterr().out
+
+    status = wait_for_prefetch(status_file)
+    assert [value["status"] for value in status["models"].values()] == ["built", "built"]
+    assert (tmp_path / "Docker_Test.sif").exists() and (tmp_path / "Oras_Test.sif").exists()
+    assert not prefetch_running(status_file)
+
+
+def test_auto_prefetch(prefetch_config, stub_apptainer, tmp_path, monkeypatch, run):
+    # without auto prefetch the image has to be built first
+    with pytest.raises(FileNotFoundError):
+        run(prefetch_config, "run", "--cold", "Docker_Test", "true")
+    monkeypatch.setenv("BEDE_CONTAINERS_AUTO_PREFETCH", "1")
+    assert run(prefetch_config, "run", "--cold", "Docker_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][-2:] == [str(tmp_path / "Docker_Test.sif"), "true"]
+    # and the rest of the group is pulled in the background
+    status = wait_for_prefetch(tmp_path / ".cache/prefetch.json")
+    assert list(status["models"]) == ["Oras_Test"]
+    assert (tmp_path / "Oras_Test.sif").exists()
+
+
+def test_auto_prefetch_other_files(prefetch_config, stub_apptainer, tmp_path, monkeypatch, run):
+    '''
+    the rest of the group is only looked for in the same config file and
+    the store, other config files are not parsed to find it
+    '''
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    prefetch_config.rename(conf_dir / "conf.yaml")
+    (conf_dir / "other.yaml").write_text(
+        f"Other_Test:\n  description: 'test'\n  group: Remote\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{tmp_path / 'Other_Test.sif'}'\n"
+    )
+    monkeypatch.setenv("BEDE_CONTAINERS_AUTO_PREFETCH", "1")
+    assert run(conf_dir, "run", "--cold", "Docker_Test", "true") == 0
+    status = wait_for_prefetch(tmp_path / ".cache/prefetch.json")
+    assert list(status["models"]) == ["Oras_Test"]
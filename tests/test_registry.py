@@ -0,0 +1,75 @@
+# tests for the model name index and lazily loaded registry
+import pytest
+import shutil
+import run_container
+from check_yaml import DuplicateKeyError
+from config_cache import ConfigCache, build_index
+from run_container import ContainerRegistry, find_config_files
+
+
+def setup_configs(tmp_path, n_files=5):
+    # create a directory with lots of single model config files
+    conf_dir = tmp_path / "configs"
+    conf_dir.mkdir()
+    for I in range(n_files):
+        (conf_dir / f"model{I}.yaml").write_text(
+            f"Model_{I}:\n  description: 'model number {I}'\n  container_definition: 'alpine:latest'\n"
+        )
+    return conf_dir
+
+
+def test_index():
+    index = build_index(find_config_files("tests/test_configs/multiple_files_test/"))
+    assert index["Example_Model1"].name == "valid.yaml"
+    assert index["Example_Model2"].name == "valid2.yaml"
+
+
+def test_index_duplicates():
+    # duplicate names across files are caught when the index is built
+    with pytest.raises(DuplicateKeyError):
+        build_index(["tests/test_configs/valid.yaml", "tests/test_configs/valid.yaml"])
+
+
+def test_registry_loads_one_file(tmp_path, monkeypatch):
+    '''
+    check that looking up a model only parses the file it is defined in
+    '''
+    conf_dir = setup_configs(tmp_path)
+    parsed = []
+    parse_config_file = run_container.parse_config_file
+
+    def counting_parse(conf_file):
+        parsed.append(conf_file)
+        return parse_config_file(conf_file)
+
+    monkeypatch.setattr(run_container, "parse_config_file", counting_parse)
+    Containers = ContainerRegistry(find_config_files(conf_dir))
+    assert len(Containers) == 5
+    assert Containers["Model_3"].description == "model number 3"
+    assert [p.name for p in parsed] == ["model3.yaml"]
+
+
+def test_registry_ignores_broken_files(tmp_path):
+    # a broken config for a different model should not stop us using this one
+    conf_dir = setup_configs(tmp_path)
+    shutil.copy("tests/test_configs/test9.yaml", conf_dir / "broken.yaml")
+    Containers = ContainerRegistry(find_config_files(conf_dir))
+    assert Containers["Model_0"].image_file == "Images/Model_0.sif"
+    with pytest.raises(ValueError):
+        Containers["Example_Model1"]
+
+
+def test_registry_index_cached(tmp_path, monkeypatch):
+    '''
+    check that with a warm cache the index is rebuilt without reading any files
+    '''
+    conf_dir = setup_configs(tmp_path)
+    cache_file = tmp_path / "cache.json"
+    ContainerRegistry(find_config_files(conf_dir), ConfigCache(cache_file))
+
+    def no_scan(conf_file):
+        raise AssertionError("config file was scanned when index should be cached")
+
+    monkeypatch.setattr("config_cache.scan_model_names", no_scan)
+    Containers = ContainerRegistry(find_config_files(conf_dir), ConfigCache(cache_file))
+    assert "Model_4" in Containers
@@ -0,0 +1,63 @@
+# tests for building, running and finalizing sandbox images
+import pytest
+from build_manifest import read_manifest
+from instances import read_state
+
+
+@pytest.fixture
+def sandbox_config(tmp_path):
+    definition = tmp_path / "test.def"
+    definition.write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Sandbox_Test:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Sandbox_Test.sif'}'\n  sandbox: true\n"
+        f"Flag_Test:\n  description: 'test'\n  container_definition: '{definition}'\n"
+        f"  image_file: '{tmp_path / 'Flag_Test.sif'}'\n"
+    )
+    return conf_file
+
+
+def test_sandbox_lifecycle(sandbox_config, stub_apptainer, tmp_path, run):
+    sandbox = tmp_path / "Sandbox_Test.sandbox"
+    image = tmp_path / "Sandbox_Test.sif"
+    assert run(sandbox_config, "build", "Sandbox_Test") == 0
+    assert sandbox.is_dir() and not image.exists()
+    call, = stub_apptainer.calls("build")
+    assert call[:4] == ["build", "--force", "--sandbox", str(sandbox)]
+    assert read_manifest(sandbox)["build_flags"] == "--sandbox"
+    # the sandbox is up to date so is not rebuilt
+    assert run(sandbox_config, "build", "Sandbox_Test") == 0
+    assert len(stub_apptainer.calls("build")) == 1
+
+    assert run(sandbox_config, "run", "--cold", "Sandbox_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][1:] == [str(sandbox), "true"]
+    assert run(sandbox_config, "start", "Sandbox_Test") == 0
+    assert read_state("Sandbox_Test")["image"] == str(sandbox)
+    assert run(sandbox_config, "stop", "Sandbox_Test") == 0
+
+    # finalize always builds the sif from the sandbox, even if it looks up to date
+    for I in range(2):
+        assert run(sandbox_config, "finalize", "Sandbox_Test") == 0
+        assert stub_apptainer.calls("build")[-1] == ["build", "--force", str(image), str(sandbox)]
+    assert len(stub_apptainer.calls("build")) == 3
+    assert image.is_file() and sandbox.is_dir()
+    assert read_manifest(image)["build_flags"] == ""
+
+
+def test_sandbox_flag(sandbox_config, stub_apptainer, tmp_path, run):
+    sandbox = tmp_path / "Flag_Test.sandbox"
+    # there is no sandbox to finalize yet
+    with pytest.raises(FileNotFoundError):
+        run(sandbox_config, "finalize", "Flag_Test")
+    assert run(sandbox_config, "build", "--sandbox", "Flag_Test") == 0
+    assert sandbox.is_dir()
+    assert run(sandbox_config, "run", "--cold", "--sandbox", "Flag_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][1:] == [str(sandbox), "true"]
+    # without the flag the sif file is used, which has not been built
+    with pytest.raises(FileNotFoundError):
+        run(sandbox_config, "run", "--cold", "Flag_Test", "true")
+    # bulk builds of a group take the flag too
+    assert run(sandbox_config, "build", "--all", "--sandbox", "--force") == 0
+    assert (tmp_path / "Sandbox_Test.sandbox").is_dir()
+    assert not (tmp_path / "Flag_Test.sif").exists()
@@ -0,0 +1,108 @@
+# tests for binding the shared directory and staging it to node-local scratch
+import shutil
+import pytest
+from run_container import format_command, load_container_config_file
+from staging import check_output_path, remove_stage, stage_in, stage_out, stage_path
+
+
+@pytest.fixture
+def shared_config(tmp_path):
+    '''
+    config for a model with a shared directory of input files, the
+    model Stage_Test stages it and copies results/ back afterwards
+    '''
+    shared = tmp_path / "shared"
+    (shared / "inputs").mkdir(parents=True)
+    for I in range(10):
+        (shared / "inputs" / f"{I}.txt").write_text(f"input {I}\n")
+    image = tmp_path / "Shared.sif"
+    image.write_text("stub image")
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text(
+        f"Bind_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n  shared_directories: '{shared}'\n"
+        f"Stage_Test:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+        f"  image_file: '{image}'\n  shared_directories: '{shared}'\n"
+        f"  stage_shared: true\n  stage_outputs: ['results', 'summary.txt']\n"
+    )
+    return conf_file, shared
+
+
+def test_bind_shared_directory(shared_config):
+    conf_file, shared = shared_config
+    Containers = load_container_config_file(conf_file)
+    command = format_command("run", "Bind_Test", Containers["Bind_Test"], ["ls"])
+    assert command[:4] == ["apptainer", "exec", "--bind", f"{shared}:{shared}"]
+    command = format_command("start", "Bind_Test", Containers["Bind_Test"])
+    assert ["--bind", f"{shared}:{shared}"] == command[3:5]
+    command = format_command("run", "Bind_Test", Containers["Bind_Test"], ["ls"], shared_source="/scratch/copy")
+    assert command[2:4] == ["--bind", f"/scratch/copy:{shared}"]
+
+
+@pytest.mark.parametrize("rsync", [True, False])
+def test_stage_in_and_out(shared_config, tmp_path, monkeypatch, rsync):
+    if not rsync:
+        # check the fall back for nodes without rsync
+        monkeypatch.setattr("staging.shutil.which", lambda name: None)
+    _, shared = shared_config
+    scratch = tmp_path / "scratch"
+    staged = stage_in(shared, scratch)
+    assert staged.name.startswith(stage_path(shared, scratch).name) and staged.parent == scratch
+    assert (staged / "inputs" / "3.txt").read_text() == "input 3\n"
+
+    # each run gets its own copy, with any changes to the inputs
+    (shared / "inputs" / "new.txt").write_text("new\n")
+    other = stage_in(shared, scratch)
+    assert other != staged and (other / "inputs" / "new.txt").exists()
+
+    (staged / "results").mkdir()
+    (staged / "results" / "out.txt").write_text("result\n")
+    assert stage_out(staged, shared, ["results", "missing.txt"]) == ["missing.txt"]
+    assert (shared / "results" / "out.txt").read_text() == "result\n"
+    # the other run's copy doesn't have the outputs of this one
+    assert stage_out(other, shared, ["results"]) == ["results"]
+    for P in [staged, other]:
+        remove_stage(P)
+    assert list(scratch.iterdir()) == []
+
+
+def test_output_paths(tmp_path):
+    assert check_output_path("results/run1") == "results/run1"
+    for path in ["/abs/path", "../outside", "a/../../b", ""]:
+        with pytest.raises(ValueError):
+            check_output_path(path)
+    conf_file = tmp_path / "conf.yaml"
+    conf_file.write_text("Bad_Stage:\n  description: 'test'\n  container_definition: 'alpine:latest'\n"
+                         "  stage_shared: true\n")
+    with pytest.raises(ValueError, match="stage_shared needs shared_directories"):
+        load_container_config_file(conf_file)
+
+
+def test_staged_run(shared_config, stub_apptainer, tmp_path, capfd, run):
+    conf_file, shared = shared_config
+    scratch = tmp_path / "scratch"
+    # the stub runs commands on the host so write to the staged copy directly
+    staged = f"$(ls -d {stage_path(shared, scratch)}_*)"
+    cmd = f"mkdir -p {staged}/results && cat {staged}/inputs/*.txt > {staged}/results/all.txt"
+    assert run(conf_file, "run", "--scratch_dir", str(scratch), "Stage_Test", "--", "sh", "-c", cmd) == 0
+
+    call, = stub_apptainer.calls("exec")
+    source, _, target = call[2].partition(":")
+    assert call[1] == "--bind" and target == str(shared)
+    assert source.startswith(f"{stage_path(shared, scratch)}_")
+    assert (shared / "results" / "all.txt").read_text().count("input") == 10
+    assert not (shared / "summary.txt").exists()
+    # the staged copy is removed after the run
+    assert list(scratch.iterdir()) == []
+
+    # a second run that doesn't make the outputs copies nothing back,
+    # rather than the outputs left in scratch by the first run
+    shutil.rmtree(shared / "results")
+    capfd.readouterr()
+    assert run(conf_file, "run", "--scratch_dir", str(scratch), "Stage_Test", "true") == 0
+    assert not (shared / "results").exists()
+    assert "results was not created by the container" in capfd.readouterr().out
+
+    # --no_stage binds the shared directory in place
+    assert run(conf_file, "run", "--no_stage", "Stage_Test", "true") == 0
+    assert stub_apptainer.calls("exec")[-1][1:3] == ["--bind", f"{shared}:{shared}"]
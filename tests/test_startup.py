@@ -0,0 +1,71 @@
+# tests that starting the cli stays cheap
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+# what the cli imported when it started before the imports were made lazy,
+# starting it now should take less time than just importing these did
+BASELINE_IMPORTS = "import argparse, subprocess, yaml, dataclasses, typing, dacite, logging"
+
+
+def min_wall_ms(commands: list, repeats: int = 10) -> list:
+    '''
+    Fastest wall clock time in ms of repeats runs of each command, which
+    is the least affected by whatever else the machine is doing. The runs
+    of the commands are interleaved so they all see the same load.
+    '''
+    # let the compiled bytecode be cached, as it would be for a user
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    times = [[] for command in commands]
+    for I in range(repeats):
+        for command, command_times in zip(commands, times):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=REPO, env=env, stdout=subprocess.DEVNULL, check=True)
+            command_times.append((time.perf_counter() - start) * 1000)
+    return [min(command_times) for command_times in times]
+
+
+def test_heavy_modules_not_imported():
+    '''
+    check that importing run_container does not pull in the modules
+    that are only needed to parse config files or run jobs in parallel
+    '''
+    code = (
+        "import sys, run_container\n"
+        "heavy = ['yaml', 'dacite', 'check_yaml', 'multiprocessing', 'concurrent.futures']\n"
+        "print(' '.join(m for m in heavy if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
+
+def test_help_does_not_touch_log(tmp_path):
+    '''
+    check that --help does not create a log file
+    '''
+    log_dir = tmp_path / "logs"
+    result = subprocess.run([sys.executable, str(REPO / "run_container.py"), "--help"],
+                            cwd=tmp_path, capture_output=True, text=True,
+                            env=dict(os.environ, BEDE_CONTAINERS_LOG_DIR=str(log_dir)))
+    assert result.returncode == 0
+    assert not log_dir.exists()
+
+
+def test_help_faster_than_baseline():
+    '''
+    check that starting the cli (with --help) takes less wall clock time
+    than importing what it imported at startup before the imports were
+    made lazy
+    '''
+    help_command = [sys.executable, str(REPO / "run_container.py"), "--help"]
+    baseline_command = [sys.executable, "-c", BASELINE_IMPORTS]
+    # a busy machine can make either one slow, a real regression is slower every time
+    for attempt in range(3):
+        help_ms, baseline_ms = min_wall_ms([help_command, baseline_command])
+        if help_ms < baseline_ms:
+            break
+    assert help_ms < baseline_ms, f"--help took {help_ms:.1f} ms, baseline imports {baseline_ms:.1f} ms"
@@ -0,0 +1,77 @@
+# tests for the cached, parallel filesystem checks
+import os
+import pytest
+import stat_cache
+from stat_cache import path_kind, prefetch, clear_stat_cache
+from run_container import load_container_config_file, validate_container_configs
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    clear_stat_cache()
+    yield
+    clear_stat_cache()
+
+
+def make_configs(tmp_path, n_files=4, n_models=25):
+    '''
+    create some config files which all share the same definition
+    file and shared directory, with one missing shared directory
+    per file.
+    '''
+    (tmp_path / "shared").mkdir()
+    (tmp_path / "test.def").write_text("Bootstrap: docker\nFrom: ubuntu:24.04\n")
+    config_files = []
+    for I in range(n_files):
+        conf_file = tmp_path / f"conf{I}.yaml"
+        lines = []
+        for J in range(n_models):
+            shared = tmp_path / ("missing" if J == 7 else "shared")
+            lines.append(
+                f"Model_{I}_{J}:\n  description: 'test'\n"
+                f"  container_definition: '{tmp_path / 'test.def'}'\n"
+                f"  shared_directories: '{shared}'\n"
+            )
+        conf_file.write_text("".join(lines))
+        config_files.append(conf_file)
+    return config_files
+
+
+def test_path_kind(tmp_path):
+    assert path_kind(str(tmp_path)) == "dir"
+    assert path_kind("tests/test_configs/valid.yaml") == "file"
+    assert path_kind(str(tmp_path / "nope")) == "missing"
+
+
+def test_each_path_checked_once(tmp_path, monkeypatch):
+    config_files = make_configs(tmp_path)
+    calls = []
+    real_stat = os.stat
+
+    def counting_stat(path, *args, **kwargs):
+        calls.append(str(path))
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(stat_cache.os, "stat", counting_stat)
+    errors = validate_container_configs(config_files, deep=True, jobs=8)
+    assert len(errors) == 4
+    # shared dir, missing dir and definition file
+    assert sorted(calls) == sorted(set(calls))
+    assert len(calls) == 3
+
+
+def test_errors_are_deterministic(tmp_path):
+    config_files = make_configs(tmp_path)
+    serial = validate_container_configs(config_files, deep=True, jobs=1)
+    clear_stat_cache()
+    parallel = validate_container_configs(config_files, deep=True, jobs=8)
+    assert serial == parallel
+    # grouped by file in the order given
+    assert [err.split(":")[0] for err in parallel] == [str(f) for f in config_files]
+    assert all("Model_" in err and "_7:" in err for err in parallel)
+
+
+def test_deep_load_parallel(tmp_path):
+    make_configs(tmp_path, n_files=1)
+    with pytest.raises(FileNotFoundError):
+        load_container_config_file(tmp_path, deep=True, jobs=4)